@@ -0,0 +1,131 @@
+"""
+Local stand-in for a DistGit lookaside cache serving files over HTTP
+in the old (name/filename/hash/filename) and/or the new
+(name/filename/hashtype/hash/filename) download layout.
+"""
+
+import os
+import re
+import shutil
+import threading
+import time
+
+from six.moves import BaseHTTPServer, socketserver
+
+HASHTYPES = ('md5', 'sha1', 'sha256', 'sha512')
+
+
+class FakeLookaside(object):
+    """
+    Serve registered files on http://127.0.0.1:<port>/repo/pkgs
+
+    :param str layout: 'old', 'new' or 'both'
+    :param float latency: seconds to wait before answering each request
+    """
+    prefix = '/repo/pkgs/'
+
+    def __init__(self, layout='both', latency=0):
+        self.layout = layout
+        self.latency = latency
+        self.files = {}
+        self.requests = []
+        self._lock = threading.Lock()
+        self.httpd = _ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.httpd.lookaside = self
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}{}'.format(
+            self.httpd.server_address[1], self.prefix.rstrip('/'))
+
+    def add(self, name, filename, hash, path):
+        """Serve the file in path as filename of module name with hash"""
+        self.files[(name, filename, hash)] = path
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.httpd.stopping = True
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self._thread.join()
+
+    def lookup(self, url_path):
+        """Return path of the file url_path refers to, None if unknown"""
+        if not url_path.startswith(self.prefix):
+            return None
+        parts = url_path[len(self.prefix):].split('/')
+        candidates = []
+        if self.layout in ('new', 'both') and len(parts) >= 5 \
+                and parts[-3] in HASHTYPES:
+            candidates.append(('/'.join(parts[:-4]), parts[-4], parts[-2]))
+        if self.layout in ('old', 'both') and len(parts) >= 4:
+            candidates.append(('/'.join(parts[:-3]), parts[-3], parts[-2]))
+        for (name, filename, hash) in candidates:
+            filename = filename.replace('%20', ' ')
+            if filename == parts[-1].replace('%20', ' ') and \
+                    (name, filename, hash) in self.files:
+                return self.files[(name, filename, hash)]
+        return None
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    stopping = False
+
+    def handle_error(self, request, client_address):
+        # kept-alive connections are cut off when stopping
+        if not self.stopping:
+            BaseHTTPServer.HTTPServer.handle_error(
+                self, request, client_address)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def respond(self, send_body):
+        lookaside = self.server.lookaside
+        with lookaside._lock:
+            lookaside.requests.append((self.command, self.path))
+        if lookaside.latency:
+            time.sleep(lookaside.latency)
+
+        path = lookaside.lookup(self.path)
+        if path is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        size = os.path.getsize(path)
+        offset = 0
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if match and int(match.group(1)) < size:
+            offset = int(match.group(1))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                offset, size - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(size - offset))
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.end_headers()
+        if not send_body:
+            return
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            shutil.copyfileobj(f, self.wfile, 1024*1024)
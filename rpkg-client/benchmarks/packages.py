@@ -0,0 +1,141 @@
+"""
+Synthetic packages for the benchmarks, built from the spec templates of
+the test suite.
+
+    patches   packed, a small Source0 from lookaside and many patches
+    tarballs  packed, a few big source tarballs from lookaside
+    tree      unpacked, a deep directory tree packed into Source0
+"""
+
+import hashlib
+import os
+import subprocess
+
+from spec_templates import SPEC_TEMPLATE
+
+HASHTYPE = 'sha512'
+GITBASEURL = 'ssh://%(user)s@localhost/%(module)s'
+ANONGITURL = 'git://localhost/%(module)s'
+
+
+def write_random(path, size):
+    """Write size bytes of incompressible data to path"""
+    with open(path, 'wb') as f:
+        while size > 0:
+            chunk = os.urandom(min(size, 1024*1024))
+            f.write(chunk)
+            size -= len(chunk)
+
+
+def write_text(path, size, seed):
+    """Write size bytes of compressible text to path"""
+    line = 'line {} of a synthetic source file\n'.format(seed)
+    with open(path, 'w') as f:
+        f.write((line * (size // len(line) + 1))[:size])
+
+
+def file_hash(path):
+    checksum = hashlib.new(HASHTYPE)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+class Package(object):
+    """A generated package directory and what it expects from lookaside"""
+    def __init__(self, root, name, profile):
+        self.path = os.path.join(root, name)
+        self.name = name
+        self.profile = profile
+        # files of the sources file: (filename, hash, path of the content)
+        self.lookaside_files = []
+        os.makedirs(self.path)
+
+    @property
+    def ns_module_name(self):
+        return 'rpms/' + self.name
+
+    def write_spec(self, source0, sources=(), patches=()):
+        spec = SPEC_TEMPLATE.substitute(pkgname=self.name, source0=source0)
+        extra = ''.join('Source{}:    {}\n'.format(num, filename)
+                        for (num, filename) in enumerate(sources, 1))
+        extra += ''.join('Patch{}:    {}\n'.format(num, filename)
+                         for (num, filename) in enumerate(patches))
+        spec = spec.replace('%description', extra + '\n%description')
+        with open(os.path.join(self.path, self.name + '.spec'), 'w') as f:
+            f.write(spec)
+
+    def add_lookaside_file(self, filename, content_path):
+        self.lookaside_files.append(
+            (filename, file_hash(content_path), content_path))
+
+    def write_sources_file(self):
+        with open(os.path.join(self.path, 'sources'), 'w') as f:
+            for (filename, hash, _) in self.lookaside_files:
+                f.write('{} ({}) = {}\n'.format(
+                    HASHTYPE.upper(), filename, hash))
+
+    def init_git(self):
+        """Git checkout with a push url the lookaside namespace is read from"""
+        def git(*args):
+            subprocess.check_call(('git',) + args, cwd=self.path,
+                                  stdout=open(os.devnull, 'w'))
+        git('init', '-q')
+        git('remote', 'add', 'origin', GITBASEURL % {
+            'user': 'bench', 'module': self.ns_module_name})
+
+    def downloaded_files(self):
+        return [os.path.join(self.path, filename)
+                for (filename, _, _) in self.lookaside_files]
+
+
+def make_patches_package(root, name, store, patches=200, patch_size=4096):
+    package = Package(root, name, 'patches')
+    source0 = name + '-1.tar.gz'
+    write_random(os.path.join(store, source0), 64*1024)
+    package.add_lookaside_file(source0, os.path.join(store, source0))
+
+    patch_names = ['{:04d}.patch'.format(num) for num in range(patches)]
+    for (num, patch_name) in enumerate(patch_names):
+        write_text(os.path.join(package.path, patch_name), patch_size, num)
+    package.write_spec(source0, patches=patch_names)
+    package.write_sources_file()
+    package.init_git()
+    return package
+
+
+def make_tarballs_package(root, name, store, tarballs=3,
+                          tarball_size=256*1024*1024):
+    package = Package(root, name, 'tarballs')
+    filenames = ['{}-part{}.tar.xz'.format(name, num)
+                 for num in range(tarballs)]
+    for filename in filenames:
+        content_path = os.path.join(store, filename)
+        write_random(content_path, tarball_size)
+        package.add_lookaside_file(filename, content_path)
+    package.write_spec(filenames[0], sources=filenames[1:])
+    package.write_sources_file()
+    package.init_git()
+    return package
+
+
+def make_tree_package(root, name, depth=6, width=3, files=4,
+                      file_size=8192):
+    package = Package(root, name, 'tree')
+    package.write_spec(name + '-1.tar.gz')
+
+    def fill(dirpath, level, seed):
+        for num in range(files):
+            write_text(os.path.join(dirpath, 'file{}.c'.format(num)),
+                       file_size, '{}.{}'.format(seed, num))
+        if level == depth:
+            return
+        for num in range(width):
+            subdir = os.path.join(dirpath, 'dir{}'.format(num))
+            os.mkdir(subdir)
+            fill(subdir, level + 1, '{}.{}'.format(seed, num))
+
+    fill(os.path.join(package.path), 1, 'root')
+    package.init_git()
+    return package
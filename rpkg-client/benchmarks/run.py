@@ -0,0 +1,253 @@
+#!/usr/bin/python
+"""
+Benchmarks of the srpm pipeline against a local fake lookaside.
+
+Synthetic packages (see packages.py) are generated into a temporary
+directory, their sources are served by a FakeLookaside and the sources,
+make-source, is-packed and srpm steps are timed in-process with a cold
+cache directory for every repetition. The results are written as JSON
+together with the current commit so that runs of different commits can
+be compared:
+
+    python2 benchmarks/run.py --output before.json
+    git checkout other-branch
+    python2 benchmarks/run.py --output after.json
+
+srpm is skipped when rpmbuild is not installed.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [HERE, os.path.join(HERE, '..'), os.path.join(HERE, '..', 'tests')]
+
+import pyrpkg
+
+import rpkglib
+from rpkglib.exceptions import NotUnpackedException
+
+import packages
+from fake_lookaside import FakeLookaside
+
+PROFILES = ('patches', 'tarballs', 'tree')
+OPERATIONS = ('sources', 'make-source', 'is-packed', 'srpm')
+
+# operations which make sense for packages of the given profile
+PROFILE_OPERATIONS = {
+    'patches': ('sources', 'is-packed', 'srpm'),
+    'tarballs': ('sources', 'is-packed', 'srpm'),
+    'tree': ('make-source', 'is-packed', 'srpm'),
+}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Time the rpkg srpm pipeline on synthetic packages')
+    parser.add_argument('--output', '-o', default='benchmark-results.json',
+                        help='where to write the JSON results')
+    parser.add_argument('--repeat', '-r', type=int, default=3,
+                        help='repetitions of every measurement')
+    parser.add_argument('--profile', action='append', choices=PROFILES,
+                        help='package profiles to run, all by default')
+    parser.add_argument('--operation', action='append', choices=OPERATIONS,
+                        help='operations to measure, all by default')
+    parser.add_argument('--layout', choices=('old', 'new', 'both'),
+                        default='both',
+                        help='download url layouts served by the lookaside')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='milliseconds added to every lookaside request')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='parallel downloads of sources')
+    parser.add_argument('--patches', type=int, default=200,
+                        help='number of patches of the patches package')
+    parser.add_argument('--tarballs', type=int, default=3,
+                        help='number of tarballs of the tarballs package')
+    parser.add_argument('--tarball-size', type=int, default=32,
+                        help='size of every tarball in MiB')
+    parser.add_argument('--tree-depth', type=int, default=5,
+                        help='directory depth of the tree package')
+    parser.add_argument('--tree-width', type=int, default=3,
+                        help='subdirectories in every tree directory')
+    parser.add_argument('--tree-files', type=int, default=8,
+                        help='files in every tree directory')
+    parser.add_argument('--file-size', type=int, default=8,
+                        help='size of patches and tree files in KiB')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the generated packages')
+    return parser.parse_args(argv)
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=HERE).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def have_rpmbuild():
+    return any(os.access(os.path.join(path, 'rpmbuild'), os.X_OK)
+               for path in os.environ.get('PATH', '').split(os.pathsep))
+
+
+class Benchmark(object):
+    def __init__(self, args, workdir):
+        self.args = args
+        self.workdir = workdir
+        self.lookaside = FakeLookaside(args.layout, args.latency / 1000.0)
+
+    def generate(self, profile):
+        root = os.path.join(self.workdir, 'packages')
+        store = os.path.join(self.workdir, 'lookaside')
+        for path in (root, store):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        name = 'bench-' + profile
+        file_size = self.args.file_size*1024
+        if profile == 'patches':
+            package = packages.make_patches_package(
+                root, name, store, self.args.patches, file_size)
+        elif profile == 'tarballs':
+            package = packages.make_tarballs_package(
+                root, name, store, self.args.tarballs,
+                self.args.tarball_size*1024*1024)
+        else:
+            package = packages.make_tree_package(
+                root, name, self.args.tree_depth, self.args.tree_width,
+                self.args.tree_files, file_size)
+
+        for (filename, hash, content_path) in package.lookaside_files:
+            self.lookaside.add(package.ns_module_name, filename, hash,
+                               content_path)
+        return package
+
+    def make_cmd(self, package, cache_dir):
+        cmd = rpkglib.Commands(package.path,
+                               self.lookaside.url,
+                               packages.HASHTYPE,
+                               self.lookaside.url + '/upload.cgi',
+                               packages.GITBASEURL,
+                               packages.ANONGITURL,
+                               branchre='.*',
+                               kojiconfig='',
+                               build_client=None,
+                               quiet=True)
+        cmd.cache_dir = cache_dir
+        cmd.download_jobs = self.args.jobs
+        return cmd
+
+    def clean(self, package):
+        """Remove what earlier operations left in the package"""
+        for path in package.downloaded_files():
+            if os.path.exists(path):
+                os.unlink(path)
+        for filename in os.listdir(package.path):
+            if filename.endswith(('.src.rpm', '.tar.gz')):
+                os.unlink(os.path.join(package.path, filename))
+
+    def operation(self, name, cmd):
+        if name == 'sources':
+            cmd.sources()
+        elif name == 'make-source':
+            cmd.make_source()
+        elif name == 'is-packed':
+            cmd.is_unpacked(cmd.path, cmd.spec_info().sources)
+        elif name == 'srpm':
+            cmd.sources()
+            try:
+                cmd.make_source()
+            except NotUnpackedException:
+                pass
+            cmd.srpm()
+
+    def measure(self, package, operation):
+        times = []
+        requests = []
+        for _ in range(self.args.repeat):
+            self.clean(package)
+            cache_dir = tempfile.mkdtemp(dir=self.workdir)
+            try:
+                cmd = self.make_cmd(package, cache_dir)
+                del self.lookaside.requests[:]
+                start = time.time()
+                self.operation(operation, cmd)
+                times.append(time.time() - start)
+                requests.append(len(self.lookaside.requests))
+            finally:
+                shutil.rmtree(cache_dir)
+        times.sort()
+        return {
+            'profile': package.profile,
+            'operation': operation,
+            'times': times,
+            'min': times[0],
+            'median': times[len(times) // 2],
+            'mean': sum(times) / len(times),
+            'lookaside_requests': max(requests),
+        }
+
+    def run(self):
+        profiles = self.args.profile or PROFILES
+        operations = self.args.operation or OPERATIONS
+        if 'srpm' in operations and not have_rpmbuild():
+            sys.stderr.write('rpmbuild not found, skipping srpm\n')
+            operations = [op for op in operations if op != 'srpm']
+
+        results = []
+        self.lookaside.start()
+        try:
+            for profile in profiles:
+                package = self.generate(profile)
+                for operation in operations:
+                    if operation not in PROFILE_OPERATIONS[profile]:
+                        continue
+                    result = self.measure(package, operation)
+                    sys.stderr.write('{:10} {:12} min {:.3f}s median {:.3f}s\n'
+                                     .format(profile, operation,
+                                             result['min'], result['median']))
+                    results.append(result)
+        finally:
+            self.lookaside.stop()
+        return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    pyrpkg.log.addHandler(logging.NullHandler())
+
+    workdir = tempfile.mkdtemp(prefix='rpkg-bench-')
+    try:
+        results = Benchmark(args, workdir).run()
+    finally:
+        if args.keep:
+            sys.stderr.write('Packages kept in {}\n'.format(workdir))
+        else:
+            shutil.rmtree(workdir)
+
+    settings = dict(vars(args))
+    for option in ('output', 'keep'):
+        del settings[option]
+    with open(args.output, 'w') as f:
+        json.dump({
+            'commit': current_commit(),
+            'date': datetime.datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'settings': settings,
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
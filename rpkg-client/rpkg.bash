@@ -30,13 +30,17 @@ _rpkg()
         prev="${COMP_WORDS[COMP_CWORD-1]}"
     fi
 
-    # global options
+    # global options and commands, see _rpkg_load_completion
 
-    local options="--help -v -q"
-    local options_value="--dist --release --user --path"
-    local commands="build chain-build ci clean clog clone co container-build container-build-config commit compile copr-build diff gimmespec giturl help \
-    gitbuildhash import install lint local mockbuild mock-config new new-sources patch prep pull push scratch-build sources \
-    srpm switch-branch tag unused-patches upload verify-files verrel"
+    local path_arg= i
+    for (( i = 1; i < ${#COMP_WORDS[*]} - 1; i++ )); do
+        [[ ${COMP_WORDS[$i]} = --path ]] && path_arg="${COMP_WORDS[$i+1]}"
+    done
+    _rpkg_load_completion "$path_arg" || return 0
+
+    local options="$_rpkg_opts"
+    local options_value="$_rpkg_optv"
+    local commands="$_rpkg_commands"
 
     # parse main options and get command
 
@@ -70,7 +74,7 @@ _rpkg()
         fi
 
         case "$prev" in
-            --config)
+            --config|--trace)
                 _filedir_exclude_paths
                 ;;
             --dist)
@@ -90,123 +94,71 @@ _rpkg()
 
     # parse command specific options
 
-    local options=
-    local options_target= options_arches= options_branch= options_string= options_file= options_dir= options_srpm=
+    local key="${command//[^a-zA-Z0-9]/_}"
+    local options_var="_rpkg_opts_$key" options_value_var="_rpkg_optv_$key"
+    local options="${!options_var}"
+    local options_target= options_arches= options_branch= options_string= options_file= options_dir= options_srpm= options_spec=
     local after= after_more=
 
     case $command in
-        help|gimmespec|gitbuildhash|giturl|lint|new|unused-patches|verrel)
-            ;;
-        build)
-            options="--nowait --background --skip-tag --scratch --md5"
-            options_arches="--arches"
-            options_srpm="--srpm"
-            options_target="--target"
-            ;;
-        chain-build)
-            options="--nowait --background"
-            options_target="--target"
-            after="package"
+        batch)
+            options_file="--manifest"
+            options_dir="--outdir"
+            after="file"
             after_more=true
             ;;
-        clean)
-            options="--dry-run -x"
-            ;;
-        clog)
-            options="--raw"
-            ;;
         clone|co)
-            options="--branches --anonymous"
-            options_branch="-b"
+            options_branch="-b --branch"
             after="package"
             ;;
-        container-build)
-            options="--scratch --nowait"
-            options_target="--target"
-            options_string="--repo-url"
-            ;;
-        container-build-config)
-            options="--get-autorebuild"
-            options_bool="--set-autorebuild"
-            ;;
         commit|ci)
-            options="--push --clog --raw --tag"
-            options_string="--message"
-            options_file="--file"
+            options_string="-m --message"
+            options_file="-F --file"
             after="file"
             after_more=true
             ;;
-        compile|install)
-            options="--short-circuit --nocheck"
-            options_arch="--arch"
+        compile|install|local|prep|verify-files)
             options_dir="--builddir"
             ;;
         copr-build)
-            options="--nowait"
-            after="package"
-            after_more=true
+            options_spec="--spec"
+            options_file="--config"
             ;;
         diff)
-            options="--cached"
             after="file"
             after_more=true
             ;;
         import)
-            options="--create"
             options_branch="--branch"
             after="srpm"
             ;;
+        is-packed)
+            options_spec="--spec"
+            after="file"
+            after_more=true
+            ;;
         lint)
-            options="--info"
             options_file="--rpmlintconf"
             ;;
-        local)
-            options="--md5"
-            options_arch="--arch"
-            options_dir="--builddir"
-            ;;
-        mock-config)
-            options="--target"
-            options_arch="--arch"
-            ;;
-        mockbuild)
-            options="--md5 --no-clean --no-cleanup-after --no-clean-all"
-            options_mroot="--root"
+        make-source|srpm)
+            options_spec="--spec"
+            options_dir="--outdir"
             ;;
         patch)
-            options="--rediff"
             options_string="--suffix"
             ;;
-        prep|verify-files)
-            options_arch="--arch"
-            options_dir="--builddir"
-            ;;
-        pull)
-            options="--rebase --no-rebase"
-            ;;
-        push)
-            options="--force"
-            ;;
-        scratch-build)
-            options="--nowait --background --md5"
-            options_target="--target"
-            options_arches="--arches"
-            options_srpm="--srpm"
+        serve)
+            options_file="--socket"
             ;;
         sources)
             options_dir="--outdir"
             ;;
-        srpm)
-            options="--md5"
-            ;;
         switch-branch)
-            options="--list"
             after="branch"
             ;;
         tag)
-            options="--clog --raw --force --list --delete"
-            options_string="--message"
-            options_file="--file"
+            options_string="-m --message"
+            options_file="-F --file"
             after_more=true
             ;;
         upload|new-sources)
@@ -215,8 +167,8 @@ _rpkg()
             ;;
     esac
 
-    local all_options="--help $options"
-    local all_options_value="$options_target $options_arches $options_branch $options_string $options_file $options_dir $options_srpm $options_bool"
+    local all_options="$options"
+    local all_options_value="${!options_value_var}"
 
     # count non-option parameters
 
@@ -240,7 +192,18 @@ _rpkg()
 
     # completion
 
-    if [[ -n $options_target ]] && in_array "$prev" "$options_target"; then
+    local prev_key="${prev#-}"
+    prev_key="${prev_key#-}"
+    local choices_var="_rpkg_choices_${key}__${prev_key//[^a-zA-Z0-9]/_}"
+
+    if [[ ${prev:0:1} = - ]] && [[ -n ${!choices_var} ]]; then
+        COMPREPLY=( $(compgen -W "${!choices_var}" -- "$cur") )
+
+    elif [[ -n $options_spec ]] && in_array "$prev" "$options_spec"; then
+        COMPREPLY=( $(compgen -W "$_rpkg_specs" -- "$cur") )
+        [[ ${#COMPREPLY[@]} -eq 0 ]] && _filedir_exclude_paths "spec"
+
+    elif [[ -n $options_target ]] && in_array "$prev" "$options_target"; then
         COMPREPLY=( $(compgen -W "$(_rpkg_target)" -- "$cur") )
 
     elif [[ -n $options_arches ]] && in_array "$last_option" "$options_arches"; then
@@ -258,9 +221,6 @@ _rpkg()
     elif [[ -n $options_dir ]] && in_array "$prev" "$options_dir"; then
         _filedir_exclude_paths -d
 
-    elif [[ -n $options_bool ]] && in_array "$prev" "$options_bool"; then
-        COMPREPLY=( $(compgen -W "true false" -- "$cur") )
-
     elif [[ -n $options_string ]] && in_array "$prev" "$options_string"; then
         COMPREPLY=( )
 
@@ -288,6 +248,38 @@ _rpkg()
 } &&
 complete -F _rpkg rpkg
 
+# Source the cached parser tree and checkout data written by
+# "rpkg --dump-completion", regenerating it only when rpkg was updated
+# or branches or files of the checkout changed. This keeps the python
+# interpreter out of the common TAB press.
+_rpkg_load_completion()
+{
+    local dir="${1:-$PWD}"
+    dir="$(cd "$dir" 2>/dev/null && pwd)" || return 1
+
+    local rpkg_bin stamp
+    rpkg_bin="$(type -P rpkg)" || return 1
+    stamp="$(stat -L -c %Y "$rpkg_bin" 2>/dev/null)"
+
+    local cache="${XDG_CACHE_HOME:-$HOME/.cache}/rpkg/completion/${dir//\//%}"
+    local stale= f
+    if [[ -r $cache ]]; then
+        . "$cache"
+        [[ $_rpkg_completion_format = 1 && $_rpkg_completion_stamp = "$stamp" ]] || stale=1
+        for f in "$dir" "$dir/.git/HEAD" "$dir/.git/packed-refs" \
+                 "$dir/.git/refs/heads" "$dir/.git/refs/remotes/origin"; do
+            [[ $f -nt $cache ]] && stale=1 && break
+        done
+    else
+        stale=1
+    fi
+
+    if [[ -n $stale ]]; then
+        "$rpkg_bin" --path "$dir" --dump-completion "$cache" &>/dev/null || return 1
+        . "$cache"
+    fi
+}
+
 _rpkg_target()
 {
     koji list-targets --quiet 2>/dev/null | cut -d" " -f1
@@ -300,11 +292,17 @@ _rpkg_arch()
 
 _rpkg_branch()
 {
-    local git_options= format="--format %(refname:short)"
+    if [[ -n $_rpkg_branches ]]; then
+        echo "$_rpkg_branches"
+        return
+    fi
+
+    local git_options= format="--format %(refname)"
     [[ -n $1 ]] && git_options="--git-dir=$1/.git"
 
-    git $git_options for-each-ref $format 'refs/remotes' | sed 's,.*/,,'
-    git $git_options for-each-ref $format 'refs/heads'
+    git $git_options for-each-ref $format 'refs/remotes' \
+        | sed 's,^refs/remotes/[^/]*/,,' | grep -vx HEAD
+    git $git_options for-each-ref $format 'refs/heads' | sed 's,^refs/heads/,,'
 }
 
 _rpkg_package()
@@ -1,17 +1,29 @@
 import os
-import rpm
+import sys
 import shutil
 import re
+import hashlib
+
+from multiprocessing.pool import ThreadPool
 
 import pyrpkg
 from pyrpkg.utils import cached_property
-from pyrpkg.errors import rpkgError
+from pyrpkg.errors import rpkgError, AlreadyUploadedError, \
+    HashtypeMixingError, UploadError
+from pyrpkg.gitignore import GitIgnore
 from pyrpkg.sources import SourcesFile
 
-from rpkglib.lookaside import CGILookasideCache
+from rpkglib.sourcecache import SourceStore, UnpackedCache, VerifiedIndex, \
+    stat_key
 from rpkglib import utils
+from rpkglib import ignore
+from rpkglib import compression
+from rpkglib.manifest import SourceManifest, SrpmFingerprint
+from rpkglib.spec import SpecCache, macros_from_rpmdefines
+from rpkglib.trace import span
 
-from exceptions import NotUnpackedException, RpmSpecParseException, NoSourceZeroException
+from rpkglib.exceptions import NotUnpackedException, NoSourceZeroException, SourceDownloadException, \
+    UnsupportedSrpmException
 
 class Commands(pyrpkg.Commands):
     def __init__(self, *args, **kwargs):
@@ -21,6 +33,25 @@ class Commands(pyrpkg.Commands):
         self.distgit_namespaced = True
         self.lookaside_namespaced = True
         self._ns_module_name = None
+        self.download_jobs = 1
+        self.upload_jobs = 4
+        self.cache_dir = utils.get_cache_dir()
+        self.layout_cache_ttl = 24*60*60
+        self.lookaside_pool_size = 10
+        self.source_store_enabled = False
+        self.source_store_size = 10*1024**3
+        self.source_store_hardlink = False
+        self.verified_index_enabled = True
+        self.source_compressor = None
+        self.compress_level = None
+        self.compress_threads = None
+        self.pack_threads = utils.DEFAULT_IO_THREADS
+        self.keep_source = True
+        self.native_srpm = False
+        self.deterministic_sources = False
+        self.spec_cache_persistent = False
+        self.reuse_srpm = False
+        self.async_lookaside = False
 
     def load_rpmdefines(self):
         """Populate rpmdefines"""
@@ -32,11 +63,90 @@ class Commands(pyrpkg.Commands):
             "--define '_rpmdir %s'" % self.path,
         ]
 
+    @cached_property
+    def spec_cache(self):
+        cache_dir = None
+        if self.spec_cache_persistent and self.cache_dir:
+            cache_dir = os.path.join(self.cache_dir, 'specs')
+        return SpecCache(cache_dir)
+
+    def spec_info(self):
+        """
+        Parsed content of the spec file (name, epoch, version, release,
+        sources and Source0 name). The spec is parsed only once for the
+        same file content and rpm defines.
+
+        The parsing evaluates %() constructs in the spec, see make_source.
+        """
+        return self.spec_cache.get(*self.spec_parse_args())
+
+    def spec_parse_args(self):
+        """(spec path, macros) the spec of this package is parsed with"""
+        return (os.path.join(self.path, self.spec),
+                macros_from_rpmdefines(self.rpmdefines))
+
+    def load_nameverrel(self):
+        """Set name, epoch, version and release from the parsed spec"""
+        info = self.spec_info()
+        self._module_name_spec = info.name
+        self._package_name_spec = info.name
+        self._epoch = info.epoch
+        self._ver = info.version
+        self._rel = info.release
+
+    @cached_property
+    def layout_cache(self):
+        from rpkglib.lookaside import LayoutCache
+
+        layout_cache_path = None
+        if self.cache_dir and self.layout_cache_ttl:
+            layout_cache_path = os.path.join(
+                self.cache_dir, 'lookaside-layouts.json')
+        return LayoutCache(layout_cache_path, self.layout_cache_ttl)
+
     @cached_property
     def lookasidecache(self):
+        # requests is only needed by the commands talking to lookaside
+        from rpkglib.lookaside import CGILookasideCache
+
         return CGILookasideCache(
             self.lookasidehash, self.lookaside, self.lookaside_cgi,
-            client_cert=self.cert_file, ca_cert=self.ca_cert)
+            client_cert=self.cert_file, ca_cert=self.ca_cert,
+            layout_cache=self.layout_cache,
+            pool_size=self.lookaside_pool_size)
+
+    def async_lookasidecache(self):
+        """
+        A new asyncio lookaside client, see rpkglib.aio.lookaside. It has
+        to be created and closed in the event loop it is used in.
+        """
+        from rpkglib.aio.lookaside import AsyncCGILookasideCache
+
+        return AsyncCGILookasideCache(
+            self.lookasidehash, self.lookaside, self.lookaside_cgi,
+            client_cert=self.cert_file, ca_cert=self.ca_cert,
+            layout_cache=self.layout_cache,
+            per_host=self.lookaside_pool_size)
+
+    @cached_property
+    def source_store(self):
+        if not self.source_store_enabled or not self.cache_dir:
+            return None
+        return SourceStore(os.path.join(self.cache_dir, 'sources'),
+                           self.source_store_size,
+                           hardlink=self.source_store_hardlink)
+
+    @cached_property
+    def verified_index(self):
+        if not self.verified_index_enabled or not self.cache_dir:
+            return VerifiedIndex()
+        return VerifiedIndex(os.path.join(self.cache_dir, 'verified.json'))
+
+    @cached_property
+    def unpacked_cache(self):
+        if not self.cache_dir:
+            return UnpackedCache()
+        return UnpackedCache(os.path.join(self.cache_dir, 'unpacked.json'))
 
     @property
     def ns_module_name(self):
@@ -44,30 +154,58 @@ class Commands(pyrpkg.Commands):
             self.load_ns_module_name()
         return self._ns_module_name
 
+    @cached_property
+    def ns_url_patterns(self):
+        """Compiled git url patterns capturing the namespaced module name"""
+        replacements = {'user': self.user, 'module':'(.*)/?'}
+        return [re.compile(self.gitbaseurl%replacements + '$'),
+                re.compile(self.anongiturl%replacements + '$')]
+
     def load_ns_module_name(self):
         """Loads the namespace module name"""
-        try:
-            replacements = {'user': self.user, 'module':'(.*)/?'}
-            gitbaseurl_pattern = self.gitbaseurl%replacements + '$'
-            anongiturl_pattern = self.anongiturl%replacements + '$'
-
-            match = re.match(gitbaseurl_pattern, self.push_url)
-            if not match:
-                match = re.match(anongiturl_pattern, self.push_url)
-
-            if match:
-                ns_module_name = match.group(1)
-                if ns_module_name.endswith('.git'):
-                    ns_module_name = ns_module_name[:-len('.git')]
-                self._ns_module_name = ns_module_name
-                return
-        except rpkgError:
-            pass
-
-        self._ns_module_name = self.module_name
+        with span('cmd.ns_module_name') as trace:
+            try:
+                push_url = self.push_url
+                for pattern in self.ns_url_patterns:
+                    match = pattern.match(push_url)
+                    if match:
+                        break
+
+                if match:
+                    ns_module_name = match.group(1)
+                    if ns_module_name.endswith('.git'):
+                        ns_module_name = ns_module_name[:-len('.git')]
+                    self._ns_module_name = ns_module_name
+                    trace['source'] = 'git url'
+                    return
+            except rpkgError:
+                pass
+
+            self._ns_module_name = self.module_name
+            trace['source'] = 'module name'
 
     def sources(self, outdir=None):
-        """Download source files"""
+        """Download source files
+
+        With download_jobs greater than one, the entries are fetched
+        concurrently by a bounded pool of worker threads. Every file is
+        verified against its hash as soon as it is downloaded and a failure
+        of one file does not stop downloading of the others. All failures
+        are reported together at the end.
+
+        With async_lookaside, the files are downloaded by the asyncio
+        lookaside client in an event loop of its own, see
+        rpkglib.aio.lookaside.sources. Without Python 3 and aiohttp the
+        worker threads are used instead.
+        """
+        if self.async_lookaside:
+            from rpkglib.lookaside import load_async_lookaside
+            aiolookaside = load_async_lookaside()
+            if aiolookaside:
+                return aiolookaside.run(aiolookaside.sources(self, outdir))
+            self.log.warning('async_lookaside needs Python 3 and aiohttp, '
+                             'downloading with threads')
+
         if not os.path.exists(self.sources_filename):
             return
 
@@ -76,42 +214,347 @@ class Commands(pyrpkg.Commands):
             outdir = self.path
 
         sourcesf = SourcesFile(self.sources_filename, self.source_entry_type)
+        entries = sourcesf.entries
+
+        jobs = min(self.download_jobs or 1, len(entries))
+        with span('sources', files=len(entries), jobs=jobs):
+            if jobs > 1:
+                # resolve the name up front so that workers do not race on it
+                ns_module_name = self.ns_module_name
+                pool = ThreadPool(jobs)
+                try:
+                    errors = pool.map(
+                        lambda entry: self._download_entry(
+                            entry, outdir, ns_module_name),
+                        entries)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                errors = [self._download_entry(entry, outdir,
+                                               self.ns_module_name)
+                          for entry in entries]
+
+            self.verified_index.save()
+
+        self.check_download_errors(entries, errors)
+
+    @staticmethod
+    def check_download_errors(entries, errors):
+        """Raise SourceDownloadException listing the failed entries"""
+        failed = [(entry, error) for (entry, error) in zip(entries, errors)
+                  if error]
+        if failed:
+            raise SourceDownloadException(
+                'Failed to download: {}'.format(', '.join(
+                    '{} ({})'.format(entry.file, error)
+                    for (entry, error) in failed)))
+
+    def _download_entry(self, entry, outdir, ns_module_name):
+        """
+        Download a single entry of the sources file.
 
-        for entry in sourcesf.entries:
-            outfile = os.path.join(outdir, entry.file)
-            self.lookasidecache.download(
-                self.ns_module_name,
-                entry.file, entry.hash, outfile,
-                hashtype=entry.hashtype)
+        :param entry: pyrpkg.sources entry to download
+        :param str outdir: directory to download the file into
+        :param str ns_module_name: namespaced module name on lookaside
+
+        :returns the raised exception or None on success
+        """
+        outfile = os.path.join(outdir, entry.file)
+        with span('sources.file', file=entry.file) as trace:
+            try:
+                trace['cache'] = self.local_source(entry, outfile)
+                if trace['cache'] == 'miss':
+                    self.lookasidecache.download(
+                        ns_module_name,
+                        entry.file, entry.hash, outfile,
+                        hashtype=entry.hashtype)
+                    self.downloaded_source(entry, outfile)
+            except Exception as e:
+                self.log.error('Download of {} failed: {}'.format(
+                    entry.file, e))
+                trace['error'] = str(e)
+                return e
+            return None
+
+    def local_source(self, entry, outfile):
+        """
+        Provide outfile of a sources file entry without downloading it.
+
+        :returns 'verified' if outfile is already present and verified,
+                'store' if it was taken from the source store and 'miss'
+                if it has to be downloaded
+        """
+        if self.verified_index.is_verified(outfile, entry.hashtype,
+                                           entry.hash):
+            self.log.debug('{} is already present and verified'
+                           .format(entry.file))
+            return 'verified'
+
+        store = self.source_store
+        if store and store.fetch(entry.hashtype, entry.hash, outfile,
+                                 self.verified_index):
+            self.log.info('Using {} from the local source store'
+                          .format(entry.file))
+            self.verified_index.record(outfile, entry.hashtype, entry.hash)
+            return 'store'
+        return 'miss'
+
+    def downloaded_source(self, entry, outfile):
+        """Keep a verified download of a sources file entry"""
+        if self.source_store:
+            self.source_store.add(entry.hashtype, entry.hash, outfile,
+                                  self.verified_index)
+        self.verified_index.record(outfile, entry.hashtype, entry.hash)
+
+    def upload(self, files, replace=False, offline=False):
+        """
+        Upload source files to the lookaside and add them to the sources
+        file and .gitignore.
+
+        The files are hashed in one chunked read each and the lookaside
+        is asked about all of them before anything is uploaded, both by
+        upload_jobs threads. Only the files the lookaside does not have
+        are uploaded, concurrently as well, with one progress bar for all
+        of them. The sources file and .gitignore are replaced in one
+        rename each once all the uploads succeeded.
+
+        :param list files: paths of the files to upload
+        :param bool replace: replace the entries of the sources file
+        :param bool offline: update the files only, upload nothing
+        :raises AlreadyUploadedError: if the lookaside had all the files
+        """
+        if not files:
+            raise rpkgError('There are no sources')
+
+        sourcesf = SourcesFile(self.sources_filename, self.source_entry_type,
+                               replace=replace)
+        gitignore = GitIgnore(os.path.join(self.path, '.gitignore'))
+
+        pool = ThreadPool(max(1, min(self.upload_jobs, len(files))))
+        try:
+            with span('upload.hash', files=len(files)) as trace:
+                hashes = pool.map(self.lookasidecache.hash_file, files)
+                trace['bytes'] = sum(os.path.getsize(f) for f in files)
+
+            for (path, file_hash) in zip(files, hashes):
+                filename = os.path.basename(path)
+                try:
+                    sourcesf.add_entry(self.lookasidehash, filename, file_hash)
+                except HashtypeMixingError as e:
+                    raise rpkgError(
+                        'Can not upload a new source file with a {} hash, as '
+                        'the sources file contains at least one line with a '
+                        '{} hash. Please redo the whole sources file using '
+                        'new-sources.'.format(e.new_hashtype,
+                                              e.existing_hashtype))
+                gitignore.add('/' + filename)
+                # so that sources does not hash the file again
+                self.verified_index.record(path, self.lookasidehash,
+                                           file_hash)
+
+            uploads = []
+            if offline:
+                self.log.info('Offline, not uploading anything')
+            else:
+                uploads = self._missing_uploads(pool, list(zip(files, hashes)))
+                self._send_files(pool, uploads)
+        finally:
+            pool.close()
+            pool.join()
+
+        with utils.replacing(self.sources_filename) as tmp_path:
+            sourcesf.sourcesfile = tmp_path
+            sourcesf.write()
+        if gitignore.modified:
+            gitignore_path = gitignore.path
+            with utils.replacing(gitignore_path) as tmp_path:
+                gitignore.path = tmp_path
+                gitignore.write()
+            gitignore.path = gitignore_path
+        self.verified_index.save()
+
+        self.repo.index.add(['sources', '.gitignore'])
+
+        if not offline and not uploads:
+            raise AlreadyUploadedError('File already uploaded')
+
+    def _missing_uploads(self, pool, files):
+        """
+        Ask the lookaside about all the (path, hash) files at once
+
+        :returns the (path, hash) files the lookaside does not have
+        """
+        name = self.ns_module_name
+        with span('upload.check', files=len(files)) as trace:
+            available = pool.map(
+                lambda item: self.lookasidecache.remote_file_exists(
+                    name, os.path.basename(item[0]), item[1]),
+                files)
+            trace['missing'] = available.count(False)
+
+        for ((path, _), present) in zip(files, available):
+            if present:
+                self.log.info('File already uploaded: {}'.format(path))
+        return [item for (item, present) in zip(files, available)
+                if not present]
+
+    def _send_files(self, pool, files):
+        """Upload the (path, hash) files, all failures are reported together"""
+        if not files:
+            return
+
+        from rpkglib.lookaside import Progress
+
+        name = self.ns_module_name
+        total = sum(os.path.getsize(path) for (path, _) in files)
+        show_progress = not self.quiet and sys.stdout.isatty()
+        progress = Progress(total, sys.stdout if show_progress else None)
+
+        def send(item):
+            (path, file_hash) = item
+            with span('upload.file', file=os.path.basename(path),
+                      bytes=os.path.getsize(path)) as trace:
+                try:
+                    self.lookasidecache.send_file(name, path, file_hash,
+                                                  progress=progress.update)
+                except Exception as e:
+                    trace['error'] = str(e)
+                    return e
+                return None
+
+        with span('upload.send', files=len(files), bytes=total):
+            errors = pool.map(send, files)
+        progress.finish()
+
+        failed = [(path, error) for ((path, _), error) in zip(files, errors)
+                  if error]
+        for (path, error) in failed:
+            self.log.error('Upload of {} failed: {}'.format(path, error))
+        if failed:
+            raise UploadError('Failed to upload: {}'.format(', '.join(
+                os.path.basename(path) for (path, _) in failed)))
 
     def srpm(self, outdir=None):
         """Create an srpm using hashtype from content in the module
 
         Requires sources already downloaded.
+
+        With reuse_srpm, an existing srpm is kept if it was built by the
+        same rpmbuild command (or the native writer) from the same spec
+        and sources, as recorded in its fingerprint in the cache directory.
+
+        With native_srpm, the srpm is written in-process by
+        rpkglib.srpm, rpmbuild is run only for what it does not support.
         """
 
         self.srpmname = os.path.join(self.path, "%s-%s-%s.src.rpm"
                                      % (self.module_name, self.ver, self.rel))
-
-        # See if we need to build the srpm
-        if os.path.exists(self.srpmname):
+        srpm_path = os.path.join(outdir or self.path, "%s-%s-%s.src.rpm"
+                                 % (self.spec_info().name, self.ver, self.rel))
+
+        cmd = self.srpm_command(outdir)
+        fingerprint = None
+        if self.reuse_srpm and self.cache_dir:
+            fingerprint = self.srpm_fingerprint(srpm_path)
+            inputs = self.srpm_inputs(cmd)
+            if fingerprint.matches(inputs):
+                self.log.info('{} is up to date'.format(
+                    fingerprint.srpm_path))
+                return
+            fingerprint.remove()
+        elif os.path.exists(self.srpmname):
             self.log.debug('Srpm found, rewriting it.')
 
+        written = False
+        if self.native_srpm:
+            try:
+                self.write_srpm(srpm_path)
+                written = True
+            except UnsupportedSrpmException as e:
+                self.log.debug('{}, running rpmbuild'.format(e))
+        if not written:
+            with span('rpmbuild', spec=self.spec):
+                self._run_command(cmd)
+
+        if fingerprint and os.path.exists(fingerprint.srpm_path):
+            fingerprint.write(inputs)
+
+    def write_srpm(self, srpm_path):
+        """
+        Write the srpm without rpmbuild, from the header rpm made when
+        parsing the spec for spec_info, see rpkglib.srpm.
+
+        :raises UnsupportedSrpmException: for specs with NoSource or
+                NoPatch and sources too big for the writer
+        """
+        from rpkglib import srpm
+
+        header = self.spec_cache.header(*self.spec_parse_args())
+        files = [srpm.SrpmFile(self.spec, os.path.join(self.path, self.spec),
+                               srpm.RPMFILE_SPECFILE)]
+        names = set([self.spec])
+        for (filepath, num, flags) in self.spec_info().sources:
+            if flags & srpm.RPMBUILD_ISNO:
+                raise UnsupportedSrpmException(
+                    'NoSource and NoPatch are not supported')
+            filename = os.path.basename(filepath)
+            if filename in names:
+                continue
+            names.add(filename)
+            try:
+                files.append(srpm.SrpmFile(
+                    filename, os.path.join(self.path, filename)))
+            except OSError as e:
+                raise rpkgError('Bad source {}: {}'.format(filename, e))
+
+        with span('srpm.write', spec=self.spec, files=len(files)):
+            srpm.write_srpm(srpm_path, srpm.entries_from_header(header),
+                            files, self.hashtype)
+
+    def srpm_fingerprint(self, srpm_path):
+        """Fingerprint of srpm_path, kept in the cache directory"""
+        key = hashlib.sha1(
+            os.path.abspath(srpm_path).encode('utf-8')).hexdigest()
+        return SrpmFingerprint(
+            os.path.join(self.cache_dir, 'srpms', key + '.json'), srpm_path)
+
+    def srpm_command(self, outdir=None):
+        """rpmbuild argv building the srpm, run without a shell"""
         cmd = ['rpmbuild']
-        cmd.extend(self.rpmdefines)
-        if self.quiet:
-            cmd.append('--quiet')
+        macros = macros_from_rpmdefines(self.rpmdefines)
         # This may need to get updated if we ever change our checksum default
         if not self.hashtype == 'sha256':
-            cmd.extend(["--define '_source_filedigest_algorithm %s'"
-                        % self.hashtype,
-                        "--define '_binary_filedigest_algorithm %s'"
-                        % self.hashtype])
+            macros.extend([('_source_filedigest_algorithm', self.hashtype),
+                           ('_binary_filedigest_algorithm', self.hashtype)])
         if outdir:
-            cmd.extend(["--define '_srcrpmdir %s'" % outdir])
+            macros.append(('_srcrpmdir', outdir))
+        for (name, value) in macros:
+            cmd.extend(['--define', '{} {}'.format(name, value)])
+        if self.quiet:
+            cmd.append('--quiet')
 
         cmd.extend(['--nodeps', '-bs', os.path.join(self.path, self.spec)])
-        self._run_command(cmd, shell=True)
+        return cmd
+
+    def srpm_inputs(self, cmd):
+        """
+        What an srpm built by cmd depends on: the command, whether it is
+        written natively, the spec content and the identity of the Source
+        and Patch files.
+        """
+        with open(os.path.join(self.path, self.spec), 'rb') as f:
+            spec_digest = hashlib.sha256(f.read()).hexdigest()
+        sources = {}
+        for (filepath, num, flags) in self.spec_info().sources:
+            filename = os.path.basename(filepath)
+            try:
+                sources[filename] = stat_key(
+                    os.stat(os.path.join(self.path, filename)))
+            except OSError:
+                sources[filename] = None
+        return {'command': cmd, 'native_srpm': self.native_srpm,
+                'spec': spec_digest, 'sources': sources}
 
     def is_unpacked(self, dirpath, rpm_sources):
         """
@@ -150,22 +593,80 @@ class Commands(pyrpkg.Commands):
 
         :returns True if the directory content is of the
                 unpacked type, False otherwise
-        """
-        for (filepath, num, flags) in rpm_sources:
-            filename = os.path.basename(filepath)
 
-            local_filepath = os.path.join(dirpath, filename)
-            if os.path.isfile(local_filepath):
-                return False
+        The directory is listed once and the result is kept in
+        unpacked_cache until the directory changes.
+        """
+        return self.scan_package_dir(dirpath, rpm_sources)[0]
 
-        ignore_file_regex = '(^README|.spec$|^\.|^tito.props$|^sources$)'
-        ignored_file_filter = lambda f: not re.search(
-            ignore_file_regex, f, re.IGNORECASE)
+    def scan_package_dir(self, dirpath, rpm_sources):
+        """
+        Whether dirpath holds unpacked content and which of rpm_sources
+        it holds, see ignore.scan_package_dir. The result is kept in
+        unpacked_cache until the directory changes.
 
-        if not list(filter(ignored_file_filter, os.listdir(dirpath))):
-            return False
+        :returns (unpacked, sources) with the sorted file names of the
+                sources present in dirpath
+        """
+        source_names = set(os.path.basename(filepath)
+                           for (filepath, num, flags) in rpm_sources)
+        st = os.stat(dirpath)
+        result = self.unpacked_cache.get(dirpath, st, source_names)
+        if result is None:
+            result = ignore.scan_package_dir(dirpath, source_names)
+            self.unpacked_cache.record(dirpath, st, source_names, *result)
+            self.unpacked_cache.save()
+        return result
+
+    def packed_status(self):
+        """
+        Packed state of the package as a dict: 'packed', 'sources' (the
+        spec sources present in the package directory) and 'source0'
+        (the name of Source0, None if the spec has none).
+        """
+        rpm_spec = self.spec_info()
+        (unpacked, sources) = self.scan_package_dir(self.path,
+                                                    rpm_spec.sources)
+        return {'packed': not unpacked, 'sources': list(sources),
+                'source0': rpm_spec.source_zero}
 
-        return True
+    def source_manifest(self, archive_path):
+        """
+        Manifest of the files a generated archive was packed from,
+        kept in the cache directory. None if there is no cache directory.
+        """
+        if not self.cache_dir:
+            return None
+        key = hashlib.sha1(
+            os.path.abspath(archive_path).encode('utf-8')).hexdigest()
+        return SourceManifest(os.path.join(
+            self.cache_dir, 'manifests', key + '.json'))
+
+    def remove_source(self, archive_path):
+        """Remove an archive generated by make_source and its manifest"""
+        if os.path.exists(archive_path):
+            os.unlink(archive_path)
+        manifest = self.source_manifest(archive_path)
+        if manifest:
+            manifest.remove()
+        self.log.debug('Removed {}'.format(archive_path))
+
+    def pack_options(self, packed_dir_name, archive_path):
+        """
+        Options affecting the content of the packed Source0. An archive
+        of the Source0 name in the package directory (e.g. generated
+        earlier into another destdir) is never packed.
+        """
+        return {
+            'pack_dir_as': packed_dir_name,
+            'excludes': [ignore.literal_pattern(
+                os.path.basename(archive_path))],
+            'compressor': compression.compressor_for(
+                archive_path, self.source_compressor),
+            'level': self.compress_level,
+            'threads': self.compress_threads,
+            'deterministic': self.deterministic_sources,
+        }
 
     def make_source(self, destdir=None):
         """
@@ -173,6 +674,9 @@ class Commands(pyrpkg.Commands):
         directive from an unpacked repository. Does nothing
         on a packed repo.
 
+        An archive generated earlier is reused when nothing in the
+        repository changed since and regenerated when something did.
+
         NOTE:
 
         This method calls rpm's parseSpec, evaluation
@@ -194,34 +698,56 @@ class Commands(pyrpkg.Commands):
 
         :returns path to the packed archive (alias Source0)
         """
-        spec_path = os.path.join(self.path, self.spec)
-
-        ts = rpm.ts()
-        try:
-            rpm.addMacro("_sourcedir", self.path)
-            rpm_spec = ts.parseSpec(spec_path)
-        except ValueError as e:
-            raise RpmSpecParseException(str(e))
+        rpm_spec = self.spec_info()
+        packed_dir_name = rpm_spec.name + '-' + rpm_spec.version
+        source_zero_name = rpm_spec.source_zero
+
+        if source_zero_name:
+            target_source_path = os.path.join(
+                destdir or self.path, source_zero_name)
+            pack_options = self.pack_options(packed_dir_name,
+                                             target_source_path)
+            manifest = self.source_manifest(target_source_path)
+            if manifest and manifest.describes(target_source_path):
+                with span('manifest.check', archive=source_zero_name) as trace:
+                    trace['current'] = manifest.is_current(
+                        target_source_path, self.path, pack_options)
+                if trace['current']:
+                    self.log.info('{} is up to date'.format(
+                        target_source_path))
+                    return target_source_path
+                self.log.info('Content changed, regenerating {}'.format(
+                    target_source_path))
+                os.unlink(target_source_path)
+                manifest.remove()
 
         if not self.is_unpacked(self.path, rpm_spec.sources):
             raise NotUnpackedException("Not an unpacked content.")
 
-        source_zero_name = utils.find_source_zero(rpm_spec.sources)
         if not source_zero_name:
             raise NoSourceZeroException("Source zero not found")
 
-        target_source_path = os.path.join(
-            destdir or self.path, source_zero_name)
-
-        name = rpm.expandMacro("%{name}")
-        version = rpm.expandMacro("%{version}")
-        rpm.reloadConfig()
-
-        packed_dir_name = name + '-' + version
+        manifest_files = {} if manifest else None
+        # hashed with the srpm file digest algorithm while it is written,
+        # the digest is known without reading the archive back
+        checksum = hashlib.new(self.hashtype)
         utils.pack_sources(
             self.path,
             target_source_path,
-            packed_dir_name
+            packed_dir_name,
+            compressor=self.source_compressor,
+            level=self.compress_level,
+            threads=self.compress_threads,
+            deterministic=self.deterministic_sources,
+            excludes=pack_options['excludes'],
+            manifest_files=manifest_files,
+            io_threads=self.pack_threads,
+            checksum=checksum
         )
+        self.verified_index.record(target_source_path, self.hashtype,
+                                   checksum.hexdigest())
+        self.verified_index.save()
+        if manifest:
+            manifest.write(target_source_path, manifest_files, pack_options)
         self.log.info('Wrote: {}'.format(target_source_path))
         return target_source_path
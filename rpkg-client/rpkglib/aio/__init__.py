@@ -0,0 +1,6 @@
+"""
+asyncio code, Python 3 only.
+
+The package is left out of Python 2 installs by setup.py, users check
+for it with rpkglib.lookaside.load_async_lookaside.
+"""
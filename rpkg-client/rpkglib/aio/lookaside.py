@@ -0,0 +1,381 @@
+"""
+asyncio client of a CGI-based lookaside cache.
+
+The counterpart of rpkglib.lookaside.CGILookasideCache for callers with
+an event loop: the layout probing, downloads and uploads are done with
+non-blocking aiohttp requests and the number of concurrent connections
+to one host is capped. Needs Python 3 and aiohttp.
+
+The synchronous Commands.sources uses it through run() when the
+async_lookaside option is set and the module can be loaded, see
+rpkglib.lookaside.load_async_lookaside.
+"""
+
+import asyncio
+import email.utils
+import hashlib
+import logging
+import os
+import ssl
+
+from pyrpkg.errors import rpkgError, DownloadError, UploadError
+from pyrpkg.sources import SourcesFile
+
+from rpkglib.lookaside import CHUNK_SIZE, DownloadNotFound, LayoutCache
+from rpkglib.trace import span
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+log = logging.getLogger("__main__")
+
+# errors of a request which did not get a response
+REQUEST_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError) if aiohttp \
+    else ()
+
+
+def update_checksum(checksum, path):
+    """Feed the content of the file in path into checksum"""
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            checksum.update(chunk)
+    return checksum
+
+
+def run(coroutine):
+    """Run coroutine in a new event loop, for synchronous callers"""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class AsyncCGILookasideCache(object):
+    """
+    A class to interact with a CGI-based lookaside cache from asyncio.
+
+    The aiohttp session is created on first use, so an instance belongs
+    to the event loop it is first used in and has to be closed there.
+    """
+    def __init__(self, hashtype, download_url, upload_url,
+                 client_cert=None, ca_cert=None, layout_cache=None,
+                 per_host=10):
+        """
+        :param int per_host: maximum number of concurrent connections to
+                one host, the other requests wait for a free one
+        """
+        if aiohttp is None:
+            raise rpkgError('The asyncio lookaside client needs aiohttp')
+
+        self.hashtype = hashtype
+        self.download_url = download_url
+        self.upload_url = upload_url
+        self.client_cert = client_cert
+        self.ca_cert = ca_cert
+
+        self.old_download_path = '%(name)s/%(filename)s/%(hash)s/%(filename)s'
+        self.new_download_path = '%(name)s/%(filename)s/%(hashtype)s/%(hash)s/%(filename)s'
+        self.download_path = self.new_download_path
+        self.layouts = {
+            'old': self.old_download_path,
+            'new': self.new_download_path,
+        }
+        self.layout_cache = layout_cache or LayoutCache()
+        self.per_host = per_host
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            connector_args = {'limit': 0, 'limit_per_host': self.per_host}
+            if self.client_cert or self.ca_cert:
+                context = ssl.create_default_context(cafile=self.ca_cert)
+                if self.client_cert:
+                    context.load_cert_chain(self.client_cert)
+                connector_args['ssl'] = context
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(**connector_args))
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def layout_key(self, name):
+        """Layouts are remembered per lookaside url and namespace"""
+        return '{} {}'.format(self.download_url, os.path.dirname(name))
+
+    async def file_is_valid(self, filename, hash, hashtype=None):
+        """Check the hash of a file, hashed in a worker thread"""
+        checksum = await asyncio.get_running_loop().run_in_executor(
+            None, update_checksum,
+            hashlib.new(hashtype or self.hashtype), filename)
+        return checksum.hexdigest() == hash
+
+    async def probe_layout(self, path_dict):
+        """
+        Find out which download path layout the lookaside uses
+        by sending HEAD requests for the given file.
+
+        :returns 'old', 'new' or None if no layout matched
+        """
+        for layout in ['old', 'new']:
+            url = '%s/%s' % (self.download_url, self.layouts[layout] % path_dict)
+            with span('lookaside.probe', url=url) as trace:
+                try:
+                    async with self.session.head(url) as response:
+                        trace['status'] = response.status
+                except REQUEST_ERRORS as e:
+                    raise DownloadError(str(e))
+            log.debug("URL %s returned status %s" % (url, trace['status']))
+            if trace['status'] == 200:
+                log.debug("This URL seems to be correct, using it")
+                return layout
+        return None
+
+    async def download(self, name, filename, hash, outfile, hashtype=None,
+                       **kwargs):
+        if hashtype is None:
+            hashtype = self.hashtype
+        urled_file = filename.replace(' ', '%20')
+        path_dict = {'name': name, 'filename': urled_file, 'hash': hash,
+                     'hashtype': hashtype}
+        path_dict.update(kwargs)
+
+        log.info("Downloading %s", filename)
+        if os.path.exists(outfile):
+            if await self.file_is_valid(outfile, hash, hashtype=hashtype):
+                return
+
+        # the layout cache is persisted on changes, in a worker thread
+        # not to block the other transfers
+        loop = asyncio.get_running_loop()
+        key = self.layout_key(name)
+        layout = await loop.run_in_executor(None, self.layout_cache.get, key)
+        if layout:
+            try:
+                return await self._download_url(
+                    self._url(layout, path_dict), filename, hash, outfile,
+                    hashtype)
+            except DownloadNotFound as e:
+                log.debug("Download with remembered layout '%s' failed (%s),"
+                          " probing again" % (layout, e))
+                await loop.run_in_executor(
+                    None, self.layout_cache.invalidate, key)
+
+        layout = await self.probe_layout(path_dict)
+        if layout:
+            await loop.run_in_executor(
+                None, self.layout_cache.set, key, layout)
+        return await self._download_url(
+            self._url(layout, path_dict), filename, hash, outfile, hashtype)
+
+    def _url(self, layout, path_dict):
+        download_path = self.layouts[layout] if layout else self.download_path
+        return '%s/%s' % (self.download_url, download_path % path_dict)
+
+    async def _download_url(self, url, filename, hash, outfile, hashtype):
+        """
+        Stream the file at url into outfile, the same way as
+        CGILookasideCache._download_url: into <outfile>.part hashed on
+        the fly, resumed with a Range request and renamed to outfile
+        only with the expected hash. The file is written in a worker
+        thread.
+        """
+        loop = asyncio.get_running_loop()
+        part_file = outfile + '.part'
+        offset = 0
+        headers = {'Accept-Encoding': 'identity'}
+        if os.path.exists(part_file):
+            offset = os.path.getsize(part_file)
+            if offset:
+                headers['Range'] = 'bytes=%d-' % offset
+
+        with span('lookaside.download', file=filename, url=url,
+                  offset=offset, bytes=0) as trace:
+            restart = False
+            try:
+                async with self.session.get(url, headers=headers) as response:
+                    if response.status == 404:
+                        raise DownloadNotFound('Server returned status code 404')
+
+                    resumed = offset and response.status == 206 and \
+                        response.headers.get('Content-Range', '').startswith(
+                            'bytes %d-' % offset)
+                    if offset and not resumed and response.status != 200:
+                        restart = True
+                    elif response.status not in (200, 206):
+                        raise DownloadError('Server returned status code %d'
+                                            % response.status)
+                    else:
+                        checksum = hashlib.new(hashtype)
+                        if resumed:
+                            log.info("Resuming download of %s from byte %d"
+                                     % (filename, offset))
+                            await loop.run_in_executor(
+                                None, update_checksum, checksum, part_file)
+
+                        f = await loop.run_in_executor(
+                            None, open, part_file, 'ab' if resumed else 'wb')
+                        try:
+                            async for chunk in response.content.iter_chunked(
+                                    CHUNK_SIZE):
+                                await loop.run_in_executor(None, f.write, chunk)
+                                checksum.update(chunk)
+                                trace['bytes'] += len(chunk)
+                        finally:
+                            await loop.run_in_executor(None, f.close)
+                        last_modified = response.headers.get('Last-Modified')
+            except REQUEST_ERRORS as e:
+                # keep the partial file to resume from it next time
+                raise DownloadError('Download of %s interrupted: %s'
+                                    % (filename, e))
+
+            if restart:
+                # the partial file does not fit the remote one, start over
+                # (after the response released its connection)
+                log.debug("Cannot resume %s (status %s), restarting"
+                          % (filename, response.status))
+                os.unlink(part_file)
+                return await self._download_url(url, filename, hash, outfile,
+                                                hashtype)
+
+            if checksum.hexdigest() != hash:
+                os.unlink(part_file)
+                if resumed:
+                    # the partial file is likely of another version of
+                    # the file, download the whole file once more
+                    log.debug("Resumed %s failed checksum, restarting"
+                              % filename)
+                    return await self._download_url(url, filename, hash,
+                                                    outfile, hashtype)
+                raise DownloadError('%s failed checksum' % filename)
+
+            if last_modified:
+                tstamp = email.utils.mktime_tz(
+                    email.utils.parsedate_tz(last_modified))
+                os.utime(part_file, (tstamp, tstamp))
+
+            os.rename(part_file, outfile)
+
+    async def _post(self, data, error_cls):
+        try:
+            async with self.session.post(self.upload_url, data=data) as response:
+                status = response.status
+                output = (await response.text()).strip()
+        except REQUEST_ERRORS as e:
+            raise error_cls(str(e))
+        if status != 200:
+            raise error_cls(output)
+        return output
+
+    async def remote_file_exists(self, name, filename, hash):
+        """Ask the lookaside CGI whether it already has the given file"""
+        output = await self._post([('name', name),
+                                   ('%ssum' % self.hashtype, hash),
+                                   ('filename', filename)],
+                                  UploadError)
+
+        # Lookaside CGI script returns these strings depending on
+        # whether or not the file exists
+        if output == 'Available':
+            return True
+        if output == 'Missing':
+            return False
+
+        log.debug(output)
+        raise UploadError('Error checking for %s at %s'
+                          % (filename, self.upload_url))
+
+    async def upload(self, name, filepath, hash):
+        """Upload a file to the lookaside unless it is already there"""
+        filename = os.path.basename(filepath)
+        if await self.remote_file_exists(name, filename, hash):
+            log.info("File already uploaded: %s", filepath)
+            return
+
+        log.info("Uploading: %s", filepath)
+        with open(filepath, 'rb') as f:
+            form = aiohttp.FormData()
+            form.add_field('name', name)
+            form.add_field('%ssum' % self.hashtype, hash)
+            # streamed from the file while being sent
+            form.add_field('file', f, filename=filename,
+                           content_type='application/octet-stream')
+            output = await self._post(form, UploadError)
+        if output:
+            log.debug(output)
+
+
+async def download_entry(cmd, lookaside, entry, outdir, ns_module_name):
+    """
+    Download a single entry of the sources file of cmd, see
+    Commands._download_entry.
+
+    :returns the raised exception or None on success
+    """
+    outfile = os.path.join(outdir, entry.file)
+    # the source store and verified index work with files, possibly
+    # copying or hashing them, so they are used in worker threads
+    loop = asyncio.get_running_loop()
+    with span('sources.file', file=entry.file) as trace:
+        try:
+            trace['cache'] = await loop.run_in_executor(
+                None, cmd.local_source, entry, outfile)
+            if trace['cache'] == 'miss':
+                await lookaside.download(ns_module_name,
+                                         entry.file, entry.hash, outfile,
+                                         hashtype=entry.hashtype)
+                await loop.run_in_executor(
+                    None, cmd.downloaded_source, entry, outfile)
+        except Exception as e:
+            log.error('Download of {} failed: {}'.format(entry.file, e))
+            trace['error'] = str(e)
+            return e
+        return None
+
+
+async def sources(cmd, outdir=None, lookaside=None):
+    """
+    Download the source files of the package of cmd (a Commands object)
+    like Commands.sources, with all the files requested at once. The
+    number of concurrent connections is capped by the lookaside client.
+
+    :param str outdir: where to download the files, the package by default
+    :param lookaside: AsyncCGILookasideCache to use, by default a new one
+            closed at the end is created
+    """
+    if not os.path.exists(cmd.sources_filename):
+        return
+
+    if not outdir:
+        outdir = cmd.path
+
+    entries = SourcesFile(cmd.sources_filename, cmd.source_entry_type).entries
+    ns_module_name = cmd.ns_module_name
+
+    own_lookaside = lookaside is None
+    if own_lookaside:
+        lookaside = cmd.async_lookasidecache()
+    try:
+        with span('sources', files=len(entries), jobs='async'):
+            errors = await asyncio.gather(*[
+                download_entry(cmd, lookaside, entry, outdir, ns_module_name)
+                for entry in entries])
+            await asyncio.get_running_loop().run_in_executor(
+                None, cmd.verified_index.save)
+    finally:
+        if own_lookaside:
+            await lookaside.close()
+
+    cmd.check_download_errors(entries, errors)
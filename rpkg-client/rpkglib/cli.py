@@ -1,15 +1,127 @@
 import argparse
+import collections
+import json
 import os
-import rpm
+import sys
+import time
+
+from multiprocessing.pool import ThreadPool
 
 from pyrpkg.cli import cliClient
 from pyrpkg import utils
 
-from exceptions import NotUnpackedException, RpmSpecParseException
+from rpkglib.spec import SpecEvaluator
+from rpkglib.trace import span
+
+from rpkglib.exceptions import NotUnpackedException
+
+# global options of rpkgClient.setup_argparser that take a value
+OPTIONS_WITH_VALUE = ('--config', '-C', '--module-name', '--user', '--path',
+                      '--trace')
+
+
+# Commands properties shared by all the packages of rpkg batch
+BATCH_SHARED = ['layout_cache', 'lookasidecache', 'source_store',
+                'verified_index', 'spec_cache', 'unpacked_cache']
+
+BatchResult = collections.namedtuple(
+    'BatchResult', ['path', 'output', 'error', 'seconds'])
+
+
+def read_manifest(manifest_path):
+    """
+    Read package directories listed one per line in manifest_path.
+    Empty lines and lines starting with # are skipped, relative paths
+    are relative to the manifest location.
+    """
+    basedir = os.path.dirname(os.path.abspath(manifest_path))
+    paths = []
+    with open(manifest_path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                paths.append(os.path.join(basedir, line))
+    return paths
+
+
+def format_batch_results(results):
+    """Lines of a table summarizing BatchResults"""
+    rows = [('PACKAGE', 'RESULT', 'TIME', 'OUTPUT')]
+    for result in results:
+        rows.append((
+            result.path,
+            'FAILED' if result.error else 'ok',
+            '{0:.1f}s'.format(result.seconds),
+            result.error or result.output or '',
+        ))
+    widths = [max(len(row[i]) for row in rows) for i in range(3)]
+    return ['{0:<{w[0]}}  {1:<{w[1]}}  {2:>{w[2]}}  {3}'.format(*row, w=widths)
+            for row in rows]
+
+
+def find_command(argv):
+    """
+    Return the subcommand named in argv (sys.argv[1:]), None when there
+    is none or when the main help is requested.
+    """
+    args = iter(argv)
+    for arg in args:
+        if arg in ('-h', '--help'):
+            return None
+        elif arg in OPTIONS_WITH_VALUE:
+            next(args, None)
+        elif not arg.startswith('-'):
+            return arg
+    return None
+
 
 class rpkgClient(cliClient):
-    def __init__(self, config, name=None):
+    # subcommand -> method registering its subparser, or a list of them
+    # when the subparser needs parents set up by other methods
+    COMMANDS = collections.OrderedDict([
+        ('make-source', 'register_make_source'),
+        ('batch', 'register_batch'),
+        ('clean', 'register_clean'),
+        ('clog', 'register_clog'),
+        ('clone', 'register_clone'),
+        ('co', 'register_clone'),
+        ('copr-build', 'register_copr_build'),
+        ('commit', 'register_commit'),
+        ('ci', 'register_commit'),
+        ('compile', 'register_compile'),
+        ('diff', 'register_diff'),
+        ('gimmespec', 'register_gimmespec'),
+        ('giturl', 'register_giturl'),
+        ('import', 'register_import_srpm'),
+        ('install', 'register_install'),
+        ('is-packed', 'register_is_packed'),
+        ('lint', 'register_lint'),
+        ('local', 'register_local'),
+        ('new', 'register_new'),
+        ('new-sources', 'register_new_sources'),
+        ('patch', 'register_patch'),
+        ('prep', 'register_prep'),
+        ('pull', 'register_pull'),
+        ('push', 'register_push'),
+        ('serve', 'register_serve'),
+        ('sources', 'register_sources'),
+        ('srpm', 'register_srpm'),
+        ('switch-branch', 'register_switch_branch'),
+        ('tag', 'register_tag'),
+        ('unused-patches', 'register_unused_patches'),
+        ('upload', ['register_new_sources', 'register_upload']),
+        ('verify-files', 'register_verify_files'),
+        ('verrel', 'register_verrel'),
+    ])
+
+    def __init__(self, config, name=None, command=None):
+        """
+        :param str command: subcommand about to be run (see find_command),
+                only its subparser is registered then. All subparsers
+                are registered if None or not known.
+        """
         self.DEFAULT_CLI_NAME = 'rpkg'
+        self.requested_command = command
         super(rpkgClient, self).__init__(config, name)
 
     def setup_argparser(self):
@@ -46,6 +158,13 @@ class rpkgClient(cliClient):
                                  help='Run with debug output')
         self.parser.add_argument('-q', action='store_true',
                                  help='Run quietly only displaying errors')
+        self.parser.add_argument('--startup-profile', action='store_true',
+                                 help='Print time spent importing each '
+                                 'module to stderr')
+        self.parser.add_argument('--trace', metavar='FILE', default=None,
+                                 help='Write timings of the command phases '
+                                 'to FILE, in Chrome trace format if FILE '
+                                 'ends with .json, as JSON lines otherwise')
 
     def setup_subparsers(self):
         """Setup basic subparsers that all clients should use"""
@@ -58,39 +177,36 @@ class rpkgClient(cliClient):
         # Add a common parsers
         self.register_rpm_common()
 
+        # Only the subparser of the requested command is needed to run it,
+        # building all of them is a noticeable part of the startup time
+        if self.requested_command in self.COMMANDS:
+            commands = [self.requested_command]
+        else:
+            commands = self.COMMANDS
+
         # Other targets
-        self.register_make_source()
-        self.register_clean()
-        self.register_clog()
-        self.register_clone()
-        self.register_copr_build()
-        self.register_commit()
-        self.register_compile()
-        self.register_diff()
-        self.register_gimmespec()
-        self.register_giturl()
-        self.register_import_srpm()
-        self.register_install()
-        self.register_is_packed()
-        self.register_lint()
-        self.register_local()
-        self.register_new()
-        self.register_new_sources()
-        self.register_patch()
-        self.register_prep()
-        self.register_pull()
-        self.register_push()
-        self.register_sources()
-        self.register_srpm()
-        self.register_switch_branch()
-        self.register_tag()
-        self.register_unused_patches()
-        self.register_upload()
-        self.register_verify_files()
-        self.register_verrel()
+        registered = set()
+        for command in commands:
+            for register in self.command_registers(command):
+                if register not in registered:
+                    getattr(self, register)()
+                    registered.add(register)
+
+    def command_registers(self, command):
+        """Names of the methods registering the subparser of command"""
+        registers = self.COMMANDS[command]
+        if isinstance(registers, list):
+            return registers
+        return [registers]
 
     def load_cmd(self):
         """This sets up the cmd object"""
+        with span('cmd.load'):
+            self._cmd = self.make_cmd(self.args.path)
+            self._cmd.module_name = self.args.module_name
+
+    def make_cmd(self, path):
+        """Create a Commands object for the package in path"""
 
         # load items from the config file
         items = dict(self.config.items(self.name, raw=True))
@@ -101,24 +217,61 @@ class rpkgClient(cliClient):
                   if realm]
 
         # Create the cmd object
-        self._cmd = self.site.Commands(self.args.path,
-                                       items.get('lookaside'),
-                                       items.get('lookasidehash', 'sha512'),
-                                       items.get('lookaside_cgi'),
-                                       items.get('gitbaseurl', ''),
-                                       items.get('anongiturl', ''),
-                                       branchre='.*',
-                                       kojiconfig='',
-                                       build_client=None,
-                                       user=self.args.user,
-                                       quiet=self.args.q,
-                                       realms=realms
-                                       )
-
-        self._cmd.module_name = self.args.module_name
-        self._cmd.debug = self.args.debug
-        self._cmd.verbose = self.args.v
-        self._cmd.clone_config = items.get('clone_config')
+        cmd = self.site.Commands(path,
+                                 items.get('lookaside'),
+                                 items.get('lookasidehash', 'sha512'),
+                                 items.get('lookaside_cgi'),
+                                 items.get('gitbaseurl', ''),
+                                 items.get('anongiturl', ''),
+                                 branchre='.*',
+                                 kojiconfig='',
+                                 build_client=None,
+                                 user=self.args.user,
+                                 quiet=self.args.q,
+                                 realms=realms
+                                 )
+
+        cmd.debug = self.args.debug
+        cmd.verbose = self.args.v
+        cmd.clone_config = items.get('clone_config')
+        cmd.download_jobs = int(items.get('download_jobs', 1))
+        cmd.upload_jobs = int(items.get('upload_jobs', cmd.upload_jobs))
+        if 'cache_dir' in items:
+            cmd.cache_dir = os.path.expanduser(items['cache_dir'])
+        cmd.layout_cache_ttl = int(
+            items.get('layout_cache_ttl', cmd.layout_cache_ttl))
+        cmd.lookaside_pool_size = int(
+            items.get('lookaside_pool_size', cmd.lookaside_pool_size))
+        cmd.source_store_enabled = self.get_config_boolean(
+            'source_cache', False)
+        cmd.verified_index_enabled = self.get_config_boolean(
+            'verified_index', True)
+        cmd.source_store_hardlink = self.get_config_boolean(
+            'source_cache_hardlink', False)
+        if 'source_cache_size' in items:
+            cmd.source_store_size = \
+                int(items['source_cache_size'])*1024**2
+        cmd.source_compressor = items.get('compressor')
+        if 'compress_level' in items:
+            cmd.compress_level = int(items['compress_level'])
+        if 'compress_threads' in items:
+            cmd.compress_threads = int(items['compress_threads'])
+        cmd.pack_threads = int(items.get('pack_threads', cmd.pack_threads))
+        cmd.keep_source = self.get_config_boolean('keep_source', True)
+        cmd.deterministic_sources = self.get_config_boolean(
+            'reproducible_sources', False)
+        cmd.spec_cache_persistent = self.get_config_boolean(
+            'spec_cache', False)
+        cmd.reuse_srpm = self.get_config_boolean('reuse_srpm', False)
+        cmd.native_srpm = self.get_config_boolean('native_srpm', False)
+        cmd.async_lookaside = self.get_config_boolean(
+            'async_lookaside', False)
+        return cmd
+
+    def get_config_boolean(self, option, default):
+        if not self.config.has_option(self.name, option):
+            return default
+        return self.config.getboolean(self.name, option)
 
     def register_make_source(self):
         make_source_parser = self.subparsers.add_parser(
@@ -127,8 +280,12 @@ class rpkgClient(cliClient):
             'after downloading any external sources. '
             'The content must be of unpacked type.',
             description='Puts content of the current '
-            'working directory into a gzip-compressed archive named '
+            'working directory into a compressed archive named '
             'according to Source0 filename as specfied in the .spec file. '
+            'The compression (gzip, bzip2, xz or zstd) follows the Source0 '
+            'extension unless the compressor config option says otherwise. '
+            'Git metadata and paths matching patterns in .rpkgignore '
+            '(gitignore syntax) are not packed. '
             'The content must be of unpacked type, otherwise no action is taken. '
             'Unpacked content is such that it contains a .spec file '
             'that references no present source or patch '
@@ -147,43 +304,258 @@ class rpkgClient(cliClient):
             '--outdir', default=os.getcwd(),
             help='Where to put the generated source. '
             'By default cwd.')
+        self.add_jobs_argument(make_source_parser)
         make_source_parser.set_defaults(command=self.make_source)
 
+    def add_jobs_argument(self, parser):
+        parser.add_argument(
+            '--jobs', '-j', type=int, default=None,
+            help='Number of source files to download in parallel. '
+            'By default the download_jobs config value is used.')
+
+    def apply_jobs_argument(self):
+        if self.args.jobs:
+            self.cmd.download_jobs = self.args.jobs
+
     def tag(self):
         self.cmd._rpmdefines = self.cmd.rpmdefines + ["--define 'dist %nil'"]
         super(rpkgClient, self).tag()
 
+    def sources(self):
+        self.apply_jobs_argument()
+        self.cmd.sources(self.args.outdir)
+
     def make_source(self):
+        self.apply_jobs_argument()
         self.cmd.sources()
         self.cmd._spec = self.args.spec
         self.cmd.make_source(self.args.outdir)
 
     def srpm(self):
+        self.apply_jobs_argument()
         self.cmd.sources()
         self.cmd._spec = self.args.spec
+        source_path = None
         try:
-            self.cmd.make_source()
+            source_path = self.cmd.make_source()
         except NotUnpackedException:
             pass
         self.cmd.srpm(self.args.outdir)
+        if source_path and not self.cmd.keep_source:
+            self.cmd.remove_source(source_path)
 
     def copr_build(self):
         self.args.outdir = None
         super(rpkgClient, self).copr_build()
 
     def is_packed(self):
-        self.cmd._spec = self.args.spec
-        ts = rpm.ts()
+        paths = list(self.args.paths)
+        if self.args.stdin:
+            paths.extend(line.strip() for line in sys.stdin if line.strip())
+        if not paths and not self.args.stdin:
+            self.cmd._spec = self.args.spec
+            if not self.args.json:
+                rpm_spec = self.cmd.spec_info()
+                if self.cmd.is_unpacked(self.cmd.path, rpm_spec.sources):
+                    self.log.info('No')
+                else:
+                    self.log.info('Yes')
+                return
+            cmds = [self.cmd]
+        elif self.args.spec:
+            self.log.error('--spec cannot be used with package directories')
+            return 1
+        else:
+            cmds = self.make_batch_cmds(paths)
+
+        workers = self.args.workers or int(dict(
+            self.config.items(self.name, raw=True)).get('batch_workers', 4))
+
+        def run(cmd):
+            status = {'path': cmd.path}
+            try:
+                status.update(cmd.packed_status())
+            except Exception as e:
+                self.log.debug('%s failed', cmd.path, exc_info=True)
+                status['error'] = str(e) or e.__class__.__name__
+            return status
+
+        pool = ThreadPool(max(1, min(workers, len(cmds))))
         try:
-            rpm.addMacro("_sourcedir", self.cmd.path)
-            rpm_spec = ts.parseSpec(self.cmd.spec)
-        except ValueError as e:
-            raise RpmSpecParseException(str(e))
+            results = pool.map(run, cmds)
+        finally:
+            pool.close()
+            pool.join()
 
-        if self.cmd.is_unpacked(self.cmd.path, rpm_spec.sources):
-            self.log.info('No')
-        else:
-            self.log.info('Yes')
+        for status in results:
+            if self.args.json:
+                line = json.dumps(status, sort_keys=True)
+            elif 'error' in status:
+                line = '{}: FAILED {}'.format(status['path'], status['error'])
+            else:
+                line = '{}: {}'.format(status['path'],
+                                       'Yes' if status['packed'] else 'No')
+            sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+        if any('error' in status for status in results):
+            return 1
+
+    def batch(self):
+        paths = list(self.args.paths)
+        if self.args.manifest:
+            paths.extend(read_manifest(self.args.manifest))
+        if not paths:
+            self.log.error('No package directories given')
+            return 1
+
+        workers = self.args.workers or int(dict(
+            self.config.items(self.name, raw=True)).get('batch_workers', 4))
+
+        cmds = self.make_batch_cmds(paths)
+
+        def run(cmd):
+            start = time.time()
+            try:
+                with span('batch.package', path=cmd.path):
+                    output = self.batch_package(cmd)
+                return BatchResult(cmd.path, output, None,
+                                   time.time() - start)
+            except Exception as e:
+                self.log.debug('%s failed', cmd.path, exc_info=True)
+                return BatchResult(cmd.path, None,
+                                   str(e) or e.__class__.__name__,
+                                   time.time() - start)
+
+        pool = ThreadPool(max(1, min(workers, len(cmds))))
+        try:
+            results = pool.map(run, cmds)
+        finally:
+            pool.close()
+            pool.join()
+
+        for line in format_batch_results(results):
+            self.log.info(line)
+        if any(result.error for result in results):
+            return 1
+
+    def make_batch_cmds(self, paths):
+        """
+        Commands for each of the package directories in paths, with one
+        lookaside session, source store and spec cache for all of them.
+        The specs are parsed ahead by worker processes, the remaining
+        parses are serialized in rpkglib.spec.
+        """
+        shared = self.make_cmd(os.getcwd())
+        for prop in BATCH_SHARED:
+            getattr(shared, prop)
+        cmds = [self.make_batch_cmd(path, shared) for path in paths]
+        self.batch_parse_specs(cmds, shared.spec_cache)
+        return cmds
+
+    def make_batch_cmd(self, path, shared):
+        """Commands for a package of rpkg batch sharing caches of shared"""
+        cmd = self.make_cmd(os.path.abspath(path))
+        for prop in BATCH_SHARED:
+            setattr(cmd, '_' + prop, getattr(shared, prop))
+        if getattr(self.args, 'jobs', None):
+            cmd.download_jobs = self.args.jobs
+        return cmd
+
+    def batch_parse_specs(self, cmds, spec_cache):
+        """
+        Parse the specs of all the packages in parallel processes ahead,
+        the packages then find them in spec_cache.
+        """
+        specs = []
+        for cmd in cmds:
+            try:
+                specs.append(cmd.spec_parse_args())
+            except Exception:
+                # e.g. no spec file, reported when the package is processed
+                continue
+        if len(specs) < 2:
+            return
+
+        evaluator = SpecEvaluator()
+        try:
+            spec_cache.prefetch(specs, evaluator)
+        finally:
+            evaluator.close()
+
+    def batch_package(self, cmd):
+        """
+        Download sources and create srpm (or only Source0 with
+        --make-source) of the package of cmd. Returns path of the result.
+        """
+        outdir = self.args.outdir
+        cmd.sources()
+        if self.args.make_source:
+            return cmd.make_source(outdir)
+        try:
+            cmd.make_source()
+        except NotUnpackedException:
+            pass
+        cmd.srpm(outdir)
+        return os.path.join(outdir or cmd.path,
+                            os.path.basename(cmd.srpmname))
+
+    def register_batch(self):
+        """Register the batch target"""
+        batch_parser = self.subparsers.add_parser(
+            'batch', help='Create srpms of many packages at once',
+            description='Download sources and create a source rpm '
+            '(or only Source0 with --make-source) for each of the given '
+            'package directories. The packages are processed in parallel '
+            'by one rpkg process sharing the lookaside connections and '
+            'caches. A table of the results is printed at the end and the '
+            'exit code is non-zero when any of the packages failed.')
+        batch_parser.add_argument(
+            'paths', nargs='*', metavar='PATH',
+            help='Package directory')
+        batch_parser.add_argument(
+            '--manifest', metavar='FILE', default=None,
+            help='File listing package directories, one per line. '
+            'Relative paths are relative to the file.')
+        batch_parser.add_argument(
+            '--make-source', action='store_true', default=False,
+            help='Only download sources and create Source0 of unpacked '
+            'packages instead of srpms.')
+        batch_parser.add_argument(
+            '--outdir', default=None,
+            help='Where to put the results. By default each package '
+            'directory.')
+        batch_parser.add_argument(
+            '--workers', '-w', type=int, default=None,
+            help='Number of packages processed in parallel. By default '
+            'the batch_workers config value (4) is used.')
+        self.add_jobs_argument(batch_parser)
+        batch_parser.set_defaults(command=self.batch)
+
+    def serve(self):
+        from rpkglib import server
+        from rpkglib.main import main
+
+        items = dict(self.config.items(self.name, raw=True))
+        socket_path = self.args.socket or items.get('server_socket') or \
+            server.default_socket_path()
+        server.serve(os.path.expanduser(socket_path), main)
+
+    def register_serve(self):
+        """Register the serve target"""
+        serve_parser = self.subparsers.add_parser(
+            'serve', help='Run rpkg commands sent over a Unix socket',
+            description='Keep rpm, pyrpkg and the other rpkg modules loaded '
+            'and run rpkg commands sent by rpkg clients over a Unix socket. '
+            'Each command runs in a fork of the server in the directory and '
+            'with the environment of the client, its output and exit code '
+            'are sent back. Clients use the server when the RPKG_SERVER '
+            'environment variable points to the socket. Standard input is '
+            'not forwarded.')
+        serve_parser.add_argument(
+            '--socket', default=None,
+            help='Path of the socket to listen on. By default the '
+            'server_socket config value or $XDG_RUNTIME_DIR/rpkg-UID.sock.')
+        serve_parser.set_defaults(command=self.serve)
 
     def register_srpm(self):
         """Register the srpm target"""
@@ -200,15 +572,48 @@ class rpkgClient(cliClient):
         srpm_parser.add_argument(
             '--outdir', default=os.getcwd(),
             help='Where to put the generated srpm.')
+        self.add_jobs_argument(srpm_parser)
         srpm_parser.set_defaults(command=self.srpm)
 
+    def register_sources(self):
+        """Register the sources target"""
+        sources_parser = self.subparsers.add_parser(
+            'sources', help='Download source files',
+            description='Download source files')
+        sources_parser.add_argument(
+            '--outdir', default=os.curdir,
+            help='Directory to download files into (defaults to pwd)')
+        self.add_jobs_argument(sources_parser)
+        sources_parser.set_defaults(command=self.sources)
+
     def register_is_packed(self):
         """Determine whether the package content is packed or not"""
         is_packed_parser = self.subparsers.add_parser(
             'is-packed', help='Tell user whether content is packed',
             description='Determine whether the package content '
             'in the working directory is packed or unpacked '
-            'and print that information to the screen.')
+            'and print that information to the screen. With package '
+            'directories given, all of them are checked at once by one '
+            'rpkg process and a line per directory is printed. The exit '
+            'code is non-zero when any of them could not be checked.')
+        is_packed_parser.add_argument(
+            'paths', nargs='*', metavar='PATH',
+            help='Package directory to check instead of the working '
+            'directory')
+        is_packed_parser.add_argument(
+            '--stdin', action='store_true', default=False,
+            help='Read package directories from standard input, one '
+            'per line.')
+        is_packed_parser.add_argument(
+            '--json', action='store_true', default=False,
+            help='Print a JSON object per package directory with the '
+            'path, packed (true/false), sources (spec sources present '
+            'in the directory), source0 (name of Source0) and error '
+            '(only when the directory could not be checked).')
+        is_packed_parser.add_argument(
+            '--workers', '-w', type=int, default=None,
+            help='Number of package directories checked in parallel. By '
+            'default the batch_workers config value (4) is used.')
         is_packed_parser.add_argument(
             '--spec', action='store', default=None,
             help='Path to an alternative spec file. Note that '
@@ -0,0 +1,125 @@
+import argparse
+import glob
+import logging
+import os
+import re
+import subprocess
+
+log = logging.getLogger("__main__")
+
+# bumped whenever rpkg.bash expects different variables in the cache
+FORMAT_VERSION = 1
+
+
+def var_suffix(name):
+    """Turn a command or option name into a part of a shell variable name"""
+    return re.sub('[^a-zA-Z0-9]', '_', name.lstrip('-'))
+
+
+def shell_quote(value):
+    return "'" + value.replace("'", "'\\''") + "'"
+
+
+def parser_options(parser):
+    """
+    Return (flags, options taking a value, {option: choices}) of an
+    argparse parser, hidden options excluded.
+    """
+    flags = []
+    with_value = []
+    choices = {}
+    for action in parser._actions:
+        if not action.option_strings or action.help == argparse.SUPPRESS:
+            continue
+        if action.nargs == 0:
+            flags.extend(action.option_strings)
+            continue
+        with_value.extend(action.option_strings)
+        if action.choices:
+            for option in action.option_strings:
+                choices[option] = [str(choice) for choice in action.choices]
+    return (flags, with_value, choices)
+
+
+def subcommands(parser):
+    """Return {name: parser} of the subcommands of an argparse parser"""
+    for action in parser._actions:
+        if isinstance(action, argparse._SubParsersAction):
+            return action.choices
+    return {}
+
+
+def branch_name(refname):
+    """
+    Branch name of a refs/heads/<branch> or refs/remotes/<remote>/<branch>
+    ref, the branch name may contain slashes
+    """
+    parts = refname.split('/', 3)
+    if parts[:2] == ['refs', 'heads']:
+        return '/'.join(parts[2:])
+    return parts[3] if len(parts) == 4 else ''
+
+
+def checkout_branches(path):
+    """Local and remote branch names of the git checkout in path"""
+    if not os.path.isdir(os.path.join(path, '.git')):
+        return []
+    try:
+        output = subprocess.check_output(
+            ['git', 'for-each-ref', '--format=%(refname)',
+             'refs/heads', 'refs/remotes'], cwd=path)
+    except (OSError, subprocess.CalledProcessError) as e:
+        log.debug("Could not list branches in {}: {}".format(path, e))
+        return []
+    branches = set()
+    for ref in output.decode('utf-8').split():
+        branches.add(branch_name(ref))
+    return sorted(branches - set(['HEAD', '']))
+
+
+def completion_lines(parser, path=None, stamp=''):
+    """
+    Shell variable assignments describing the parser tree and, if path
+    is given, the branches and spec files of that checkout.
+    """
+    lines = [
+        '_rpkg_completion_format={}'.format(FORMAT_VERSION),
+        '_rpkg_completion_stamp={}'.format(shell_quote(str(stamp))),
+    ]
+
+    def assign(name, words):
+        lines.append('{}={}'.format(name, shell_quote(' '.join(words))))
+
+    def assign_options(suffix, parser):
+        (flags, with_value, choices) = parser_options(parser)
+        assign('_rpkg_opts' + suffix, flags)
+        assign('_rpkg_optv' + suffix, with_value)
+        for (option, values) in sorted(choices.items()):
+            assign('_rpkg_choices{}__{}'.format(suffix, var_suffix(option)),
+                   values)
+
+    assign_options('', parser)
+    commands = subcommands(parser)
+    assign('_rpkg_commands', sorted(commands))
+    for (name, subparser) in sorted(commands.items()):
+        assign_options('_' + var_suffix(name), subparser)
+
+    if path:
+        assign('_rpkg_branches', checkout_branches(path))
+        assign('_rpkg_specs', sorted(
+            os.path.basename(spec)
+            for spec in glob.glob(os.path.join(path, '*.spec'))))
+    return lines
+
+
+def write_completion_cache(parser, cache_path, path=None, stamp=''):
+    """Atomically write the completion cache read by rpkg.bash"""
+    cache_dir = os.path.dirname(cache_path)
+    if cache_dir and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write('# generated by rpkg --dump-completion\n')
+        for line in completion_lines(parser, path, stamp):
+            f.write(line + '\n')
+    os.rename(tmp_path, cache_path)
@@ -0,0 +1,309 @@
+import bz2
+import gzip
+import logging
+import multiprocessing
+import struct
+import subprocess
+import threading
+import zlib
+
+from multiprocessing.pool import ThreadPool
+
+from rpkglib.exceptions import CompressionException, \
+    UnsupportedCompressionException
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+log = logging.getLogger("__main__")
+
+# archive extensions and the compressor used for them by default
+EXTENSIONS = [
+    ('.tar.gz', 'gzip'),
+    ('.tgz', 'gzip'),
+    ('.tar.bz2', 'bzip2'),
+    ('.tbz2', 'bzip2'),
+    ('.tar.xz', 'xz'),
+    ('.txz', 'xz'),
+    ('.tar.zst', 'zstd'),
+    ('.tzst', 'zstd'),
+]
+
+DEFAULT_LEVELS = {
+    'gzip': 9,
+    'pgzip': 9,
+    'bzip2': 9,
+    'xz': 6,
+    'zstd': 3,
+}
+
+BLOCK_SIZE = 1024*1024
+
+
+def default_threads():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def compressor_for(target_path, compressor=None):
+    """
+    Choose the compressor for the given archive path.
+
+    :param str target_path: path to the archive
+    :param str compressor: explicitly configured compressor name,
+            None or 'auto' to decide according to the extension
+
+    :returns str: compressor name
+    """
+    if compressor and compressor != 'auto':
+        if compressor not in DEFAULT_LEVELS:
+            raise UnsupportedCompressionException(
+                "Unknown compressor {}".format(compressor))
+        return compressor
+
+    for (extension, name) in EXTENSIONS:
+        if target_path.endswith(extension):
+            return name
+
+    # gzip has always been used regardless of the Source0 name
+    return 'gzip'
+
+
+def open_compressed(target_path, compressor, level=None, threads=None,
+                    deterministic=False, checksum=None):
+    """
+    Open target_path for writing compressed data.
+
+    :param str target_path: path to the archive
+    :param str compressor: one of gzip, pgzip, bzip2, xz, zstd
+    :param int level: compression level, a compressor default if None
+    :param int threads: number of compression threads for the
+            compressors that support it, all cpus if None
+    :param bool deterministic: do not store the current time in
+            the gzip header
+    :param checksum: hashlib object updated with the compressed data
+            as it is written to target_path
+
+    :returns a file-like object with write() and close()
+    """
+    if level is None:
+        level = DEFAULT_LEVELS[compressor]
+    threads = threads or default_threads()
+
+    if compressor in ('xz', 'zstd') and which(compressor):
+        cmd = {
+            'xz': ['xz', '-c', '-{}'.format(level), '-T{}'.format(threads)],
+            'zstd': ['zstd', '-q', '-c', '-{}'.format(level),
+                     '-T{}'.format(threads)],
+        }[compressor]
+        return ExternalWriter(
+            ChecksumFile(open(target_path, 'wb'), checksum), cmd)
+
+    if compressor == 'xz':
+        try:
+            import lzma
+        except ImportError:
+            raise UnsupportedCompressionException(
+                "xz compression needs the xz program or the lzma module")
+    if compressor == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise UnsupportedCompressionException(
+                "zstd compression needs the zstd program or "
+                "the zstandard module")
+    if compressor not in DEFAULT_LEVELS:
+        raise UnsupportedCompressionException(
+            "Unknown compressor {}".format(compressor))
+
+    target = ChecksumFile(open(target_path, 'wb'), checksum)
+    if compressor == 'gzip':
+        return GzipWriter(target_path, 'wb', compresslevel=level,
+                          fileobj=target, mtime=0 if deterministic else None)
+    if compressor == 'pgzip':
+        return ParallelGzipWriter(target, level, threads)
+    if compressor == 'bzip2':
+        return StreamWriter(bz2.BZ2Compressor(level), target)
+    if compressor == 'xz':
+        return StreamWriter(lzma.LZMACompressor(preset=level), target)
+    return ZstandardWriter(zstandard, target, level, threads)
+
+
+class ChecksumFile(object):
+    """Output file feeding everything written to it into a checksum"""
+    def __init__(self, fileobj, checksum=None):
+        self.fileobj = fileobj
+        self.checksum = checksum
+
+    def write(self, data):
+        if self.checksum is not None:
+            self.checksum.update(data)
+        self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.close()
+
+
+class GzipWriter(gzip.GzipFile):
+    """GzipFile closing the file object it writes to"""
+    def close(self):
+        fileobj = self.fileobj
+        try:
+            super(GzipWriter, self).close()
+        finally:
+            if fileobj is not None:
+                fileobj.close()
+
+
+class StreamWriter(object):
+    """Compress with a bz2/lzma compressor object into fileobj"""
+    def __init__(self, compressor, fileobj):
+        self.compressor = compressor
+        self.fileobj = fileobj
+
+    def write(self, data):
+        self.fileobj.write(self.compressor.compress(data))
+
+    def close(self):
+        try:
+            self.fileobj.write(self.compressor.flush())
+        finally:
+            self.fileobj.close()
+
+
+def gzip_member(data, level):
+    """Compress data into a complete gzip member"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    # magic, deflate, no flags, zero mtime, no extra flags, unknown os
+    header = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+    trailer = struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+                          len(data) & 0xffffffff)
+    return header + deflated + trailer
+
+
+class ParallelGzipWriter(object):
+    """
+    Gzip compressor using several threads.
+
+    Input is cut into blocks that are compressed concurrently (zlib
+    releases the GIL) and written as consecutive gzip members. Such
+    a multi-member stream is valid gzip that gzip, tar, rpmbuild and
+    python's gzip module decompress as a whole.
+    """
+    def __init__(self, fileobj, level, threads):
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = threads
+        self.pool = ThreadPool(threads)
+        self.pending = []
+        self.buf = []
+        self.buf_size = 0
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buf_size += len(data)
+        if self.buf_size >= BLOCK_SIZE:
+            self._submit()
+
+    def _submit(self):
+        block = b''.join(self.buf)
+        self.buf = []
+        self.buf_size = 0
+        self.pending.append(
+            self.pool.apply_async(gzip_member, (block, self.level)))
+        # bound the memory used by blocks waiting to be written
+        while len(self.pending) > 2*self.threads:
+            self.fileobj.write(self.pending.pop(0).get())
+
+    def close(self):
+        try:
+            if self.buf_size or not self.pending:
+                self._submit()
+            for result in self.pending:
+                self.fileobj.write(result.get())
+            self.pending = []
+        finally:
+            self.pool.close()
+            self.pool.join()
+            self.fileobj.close()
+
+
+class ExternalWriter(object):
+    """Compress by piping data through an external multi-threaded program"""
+    def __init__(self, target, cmd):
+        log.debug("Compressing with {}".format(' '.join(cmd)))
+        self.cmd = cmd
+        self.target = target
+        self.pump = None
+        # exception of writing the output to target, raised by write/close
+        self.error = None
+        if target.checksum is None:
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                         stdout=target.fileobj)
+        else:
+            # the output has to pass through python to be hashed
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE)
+            self.pump = threading.Thread(target=self._copy_output)
+            self.pump.daemon = True
+            self.pump.start()
+
+    def _copy_output(self):
+        try:
+            for chunk in iter(lambda: self.proc.stdout.read(BLOCK_SIZE), b''):
+                self.target.write(chunk)
+        except Exception as e:
+            # e.g. out of space, nothing reads the output anymore so the
+            # program is killed not to block writes to its input forever
+            self.error = e
+            self.proc.kill()
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        try:
+            self.proc.stdin.write(data)
+        except (IOError, OSError):
+            if self.error is not None:
+                raise self.error
+            raise
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except (IOError, OSError):
+            if self.error is None:
+                raise
+        if self.pump:
+            self.pump.join()
+        returncode = self.proc.wait()
+        self.target.close()
+        if self.error is not None:
+            raise self.error
+        if returncode:
+            raise CompressionException(
+                "{} failed with exit code {}".format(' '.join(self.cmd),
+                                                     returncode))
+
+
+class ZstandardWriter(object):
+    """Threaded zstd compression through the optional zstandard module"""
+    def __init__(self, zstandard, target, level, threads):
+        self.target = target
+        compressor = zstandard.ZstdCompressor(level=level, threads=threads)
+        self.writer = compressor.stream_writer(self.target, closefd=False)
+
+    def write(self, data):
+        self.writer.write(data)
+
+    def close(self):
+        self.writer.close()
+        self.target.close()
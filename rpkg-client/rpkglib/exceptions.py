@@ -10,3 +10,15 @@ class NoSourceZeroException(Exception):
 
 class SourceArchiveAlreadyExists(Exception):
     pass
+
+class SourceDownloadException(Exception):
+    pass
+
+class UnsupportedCompressionException(Exception):
+    pass
+
+class CompressionException(Exception):
+    pass
+
+class UnsupportedSrpmException(Exception):
+    pass
@@ -0,0 +1,228 @@
+import logging
+import os
+import re
+
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
+
+log = logging.getLogger("__main__")
+
+# files not counted as content when deciding whether a directory is unpacked
+IGNORED_FILE_REGEX = re.compile(
+    r'(^README|.spec$|^\.|^tito.props$|^sources$)', re.IGNORECASE)
+
+# never packed into Source0, srpms built in the package directory
+# would be nested into every following Source0 otherwise
+DEFAULT_EXCLUDES = ['.git', '.gitignore', '.rpkgignore', '*.src.rpm']
+
+IGNORE_FILENAME = '.rpkgignore'
+
+
+def is_ignored_file(filename):
+    """Whether filename is ignored when looking for unpacked content"""
+    return bool(IGNORED_FILE_REGEX.search(filename))
+
+
+def scan_package_dir(dirpath, source_names):
+    """
+    List dirpath once and tell whether it holds unpacked content and
+    which of the spec sources it holds.
+
+    The content is unpacked when there is at least one entry not ignored
+    by is_ignored_file and no regular file (or a link to one) named as
+    one of the source_names.
+
+    :param str dirpath: directory to look into
+    :param set source_names: file names of the spec sources
+    :returns (unpacked, sources) with the sorted names of the sources
+            present in dirpath
+    """
+    if not scandir:
+        return _scan_package_dir(
+            ((name, lambda name=name: os.path.isfile(
+                os.path.join(dirpath, name))) for name in os.listdir(dirpath)),
+            source_names)
+    iterator = scandir(dirpath)
+    try:
+        return _scan_package_dir(
+            ((entry.name, entry.is_file) for entry in iterator), source_names)
+    finally:
+        if hasattr(iterator, 'close'):
+            iterator.close()
+
+
+def _scan_package_dir(entries, source_names):
+    content = False
+    sources = []
+    for (name, is_file) in entries:
+        if name in source_names and is_file():
+            sources.append(name)
+        elif not content and not is_ignored_file(name):
+            content = True
+    return (content and not sources, sorted(sources))
+
+
+def glob_to_regex(pattern):
+    """
+    Translate a gitignore glob into a regular expression source.
+    '*' and '?' do not match '/', '**' matches across directories.
+    """
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+            continue
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[':
+            end = pattern.find(']', i + 1)
+            if end == -1:
+                regex += re.escape(c)
+            else:
+                group = pattern[i+1:end]
+                if group.startswith('!'):
+                    group = '^' + group[1:]
+                regex += '[{}]'.format(group.replace('\\', '\\\\'))
+                i = end
+        else:
+            regex += re.escape(c)
+        i += 1
+    return regex
+
+
+def literal_pattern(relpath):
+    """Rule pattern matching exactly relpath from the root"""
+    return '/' + re.sub(r'([*?[])', r'[\1]', relpath)
+
+
+class ExcludeRule(object):
+    """A single precompiled gitignore-style rule"""
+    def __init__(self, pattern):
+        self.negated = pattern.startswith('!')
+        if self.negated:
+            pattern = pattern[1:]
+        self.dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        # a pattern with a slash is relative to the root,
+        # otherwise it matches the name at any depth
+        anchored = '/' in pattern
+        pattern = pattern.lstrip('/')
+        prefix = '' if anchored else '(?:.*/)?'
+        self.regex = re.compile('^{}{}$'.format(prefix, glob_to_regex(pattern)))
+
+    def matches(self, relpath, is_dir):
+        if self.dir_only and not is_dir:
+            return False
+        return bool(self.regex.match(relpath))
+
+
+class ExcludeRules(object):
+    """
+    Ordered set of gitignore-style exclusion rules,
+    the last matching rule decides.
+    """
+    def __init__(self, patterns=()):
+        self.rules = []
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern):
+        pattern = pattern.strip()
+        if not pattern or pattern.startswith('#'):
+            return
+        self.rules.append(ExcludeRule(pattern))
+
+    def add_file(self, path):
+        """Add rules from an ignore file, if it exists"""
+        if not os.path.isfile(path):
+            return
+        with open(path) as f:
+            for line in f:
+                self.add(line)
+
+    def is_excluded(self, relpath, is_dir=False):
+        """
+        :param str relpath: '/' separated path relative to the packed root
+        :param bool is_dir: whether the path is a directory
+        """
+        excluded = False
+        for rule in self.rules:
+            if rule.negated == excluded and rule.matches(relpath, is_dir):
+                excluded = not rule.negated
+        return excluded
+
+
+def load_exclude_rules(dirpath, extra_patterns=()):
+    """
+    Rules for packing dirpath: the defaults, the dirpath/.rpkgignore
+    file and extra_patterns.
+    """
+    rules = ExcludeRules(DEFAULT_EXCLUDES)
+    rules.add_file(os.path.join(dirpath, IGNORE_FILENAME))
+    for pattern in extra_patterns:
+        rules.add(pattern)
+    return rules
+
+
+def _list_dir(dirpath):
+    """Return sorted (name, is_dir) of the directory entries"""
+    if scandir:
+        entries = [(entry.name, entry.is_dir(follow_symlinks=False))
+                   for entry in scandir(dirpath)]
+    else:
+        entries = [(name, not os.path.islink(os.path.join(dirpath, name)) and
+                    os.path.isdir(os.path.join(dirpath, name)))
+                   for name in os.listdir(dirpath)]
+    return sorted(entries)
+
+
+def iter_tree(root, rules, pool=None):
+    """
+    Walk root in a deterministic order (sorted by name, every directory
+    before its content) and yield
+    (path, relpath) of entries not excluded by rules. Excluded directories
+    are pruned, so nothing below them is listed or stat'ed.
+
+    With a pool (multiprocessing.pool.ThreadPool), every directory is
+    listed by its workers as soon as its parent was, ahead of the walk.
+    The order stays the same.
+    """
+    def list_children(dirpath, dir_relpath):
+        children = []
+        for (name, is_dir) in _list_dir(dirpath):
+            relpath = dir_relpath + '/' + name if dir_relpath else name
+            if rules.is_excluded(relpath, is_dir):
+                log.debug("Excluding {}".format(relpath))
+                continue
+            path = os.path.join(dirpath, name)
+            children.append((path, relpath, is_dir))
+        return children
+
+    def listing(dirpath, dir_relpath):
+        """Return a function returning the children of dirpath"""
+        if pool:
+            return pool.apply_async(list_children, (dirpath, dir_relpath)).get
+        return lambda: list_children(dirpath, dir_relpath)
+
+    stack = [listing(root, '')]
+    while stack:
+        children = stack.pop()()
+
+        # yield a directory's entries before descending, children
+        # are pushed in reverse to be visited in sorted order
+        for (path, relpath, is_dir) in children:
+            yield (path, relpath)
+        subdirs = [listing(path, relpath)
+                   for (path, relpath, is_dir) in children if is_dir]
+        stack.extend(reversed(subdirs))
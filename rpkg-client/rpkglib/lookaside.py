@@ -1,34 +1,452 @@
+import email.utils
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
 import requests
+import requests.adapters
 import pyrpkg.lookaside
+from pyrpkg.errors import DownloadError, UploadError
+
+from rpkglib.trace import span
+
+log = logging.getLogger("__main__")
+
+CHUNK_SIZE = 1024*1024
+
+
+class DownloadNotFound(DownloadError):
+    """The lookaside does not have the file under the requested url"""
+    pass
+
+
+class MultipartStream(object):
+    """
+    A file-like multipart/form-data body with known length.
+
+    Unlike passing files= to requests, the uploaded file is read in
+    chunks while being sent and is never loaded into memory as a whole.
+    """
+    def __init__(self, fields, file_field, filepath, progress=None):
+        """
+        :param list fields: list of (name, value) form fields
+        :param str file_field: name of the form field with the file
+        :param str filepath: path to the file to upload
+        :param progress: called with the size of every chunk of the file
+                read for sending
+        """
+        self.boundary = uuid.uuid4().hex
+        head = b''
+        for (name, value) in fields:
+            head += self._part_header(name) + value.encode('utf-8') + b'\r\n'
+        head += self._part_header(
+            file_field, os.path.basename(filepath),
+            b'Content-Type: application/octet-stream\r\n')
+        tail = '\r\n--{}--\r\n'.format(self.boundary).encode('ascii')
+
+        self.content_type = 'multipart/form-data; boundary={}'.format(
+            self.boundary)
+        self.len = len(head) + os.path.getsize(filepath) + len(tail)
+        self._head = head
+        self._tail = tail
+        self._file = open(filepath, 'rb')
+        self._progress = progress
+        self._parts = [self._read_head, self._read_file, self._read_tail]
+
+    def _part_header(self, name, filename=None, extra=b''):
+        disposition = 'Content-Disposition: form-data; name="{}"'.format(name)
+        if filename is not None:
+            if '\r' in filename or '\n' in filename:
+                raise UploadError('Cannot upload {!r}: line breaks are not'
+                                  ' allowed in file names'.format(filename))
+            disposition += '; filename="{}"'.format(
+                filename.replace('\\', '\\\\').replace('"', '\\"'))
+        return ('--{}\r\n{}\r\n'.format(self.boundary, disposition)
+                .encode('utf-8') + extra + b'\r\n')
+
+    def _read_head(self, size):
+        data, self._head = self._head[:size], self._head[size:]
+        return data
+
+    def _read_file(self, size):
+        data = self._file.read(size)
+        if self._progress:
+            self._progress(len(data))
+        return data
+
+    def _read_tail(self, size):
+        data, self._tail = self._tail[:size], self._tail[size:]
+        return data
+
+    def read(self, size=CHUNK_SIZE):
+        if size is None or size < 0:
+            size = self.len
+        while self._parts:
+            data = self._parts[0](size)
+            if data:
+                return data
+            self._parts.pop(0)
+        return b''
+
+    def close(self):
+        self._file.close()
+
+
+class Progress(object):
+    """
+    Progress bar of transfers of total bytes, updated from any thread.
+    Nothing is shown without a stream.
+    """
+    def __init__(self, total, stream=None):
+        self.total = total
+        self.done = 0
+        self.stream = stream
+        self._last_per_mille = -1
+        self._lock = threading.Lock()
+
+    def update(self, size):
+        with self._lock:
+            self.done += size
+            per_mille = 1000 * self.done // self.total if self.total else 1000
+            if per_mille == self._last_per_mille or not self.stream:
+                return
+            self._last_per_mille = per_mille
+            done_chars = 72 * per_mille // 1000
+            self.stream.write('\r{}{} {}%'.format(
+                '#' * done_chars, ' ' * (72 - done_chars), per_mille / 10.0))
+            self.stream.flush()
+
+    def finish(self):
+        if self.stream and self._last_per_mille >= 0:
+            self.stream.write('\n')
+            self.stream.flush()
+
+
+def load_async_lookaside():
+    """
+    The asyncio lookaside module rpkglib.aio.lookaside, None if it cannot
+    be used: rpkglib.aio is Python 3 only (and not installed with Python
+    2) and the module needs aiohttp.
+    """
+    try:
+        from rpkglib.aio import lookaside
+    except (ImportError, SyntaxError):
+        return None
+    if lookaside.aiohttp is None:
+        return None
+    return lookaside
+
+
+def hash_file(path, hashtype):
+    """Hash the file in path in one chunked read"""
+    checksum = hashlib.new(hashtype)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+class LayoutCache(object):
+    """
+    Remembers which download path layout a lookaside host uses.
+
+    Entries are kept per lookaside url and namespace, expire after ttl
+    seconds and are persisted in a small json file so that the layout
+    detected by one rpkg run is reused by the following ones.
+    """
+    def __init__(self, path=None, ttl=24*60*60):
+        """
+        :param str path: json file to persist the layouts in, or None
+                to keep them only in memory
+        :param int ttl: number of seconds a detected layout is trusted
+        """
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._layouts = None
+
+    def _load(self):
+        if self._layouts is not None:
+            return self._layouts
+        self._layouts = {}
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self._layouts = json.load(f)
+            except (IOError, ValueError) as e:
+                log.debug("Ignoring unreadable layout cache {}: {}"
+                          .format(self.path, e))
+        return self._layouts
+
+    def _save(self):
+        if not self.path:
+            return
+        try:
+            dirpath = os.path.dirname(self.path)
+            if not os.path.isdir(dirpath):
+                os.makedirs(dirpath)
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(self._layouts, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            log.debug("Could not write layout cache {}: {}"
+                      .format(self.path, e))
+
+    def get(self, key):
+        """Return the remembered layout for key or None if unknown/expired"""
+        with self._lock:
+            entry = self._load().get(key)
+        if not entry or time.time() - entry['timestamp'] > self.ttl:
+            return None
+        return entry['layout']
+
+    def set(self, key, layout):
+        with self._lock:
+            self._load()[key] = {'layout': layout, 'timestamp': time.time()}
+            self._save()
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._load().pop(key, None):
+                self._save()
 
 
 class CGILookasideCache(pyrpkg.lookaside.CGILookasideCache):
     """A class to interact with a CGI-based lookaside cache"""
     def __init__(self, hashtype, download_url, upload_url,
-                 client_cert=None, ca_cert=None):
+                 client_cert=None, ca_cert=None, layout_cache=None,
+                 pool_size=10):
         super(CGILookasideCache, self).__init__(hashtype, download_url, upload_url,
                                                 client_cert=client_cert,ca_cert=ca_cert)
 
         self.old_download_path = '%(name)s/%(filename)s/%(hash)s/%(filename)s'
         self.new_download_path = '%(name)s/%(filename)s/%(hashtype)s/%(hash)s/%(filename)s'
+        self.layouts = {
+            'old': self.old_download_path,
+            'new': self.new_download_path,
+        }
+        self.layout_cache = layout_cache or LayoutCache()
+        self.pool_size = pool_size
+        self.session = self._make_session()
+
+    def _make_session(self):
+        """
+        Create the requests session shared by all lookaside traffic
+        so that connections are kept alive and reused.
+        """
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if self.client_cert:
+            session.cert = self.client_cert
+        if self.ca_cert:
+            session.verify = self.ca_cert
+        return session
+
+    def hash_file(self, filename, hashtype=None):
+        # bigger chunks than pyrpkg, hashlib releases the GIL for them
+        return hash_file(filename, hashtype or self.hashtype)
+
+    def layout_key(self, name):
+        """Layouts are remembered per lookaside url and namespace"""
+        return '{} {}'.format(self.download_url, os.path.dirname(name))
+
+    def probe_layout(self, path_dict):
+        """
+        Find out which download path layout the lookaside uses
+        by sending HEAD requests for the given file.
+
+        :returns 'old', 'new' or None if no layout matched
+        """
+        for layout in ['old', 'new']:
+            path = self.layouts[layout] % path_dict
+            url = '%s/%s' % (self.download_url, path)
+            with span('lookaside.probe', url=url) as trace:
+                response = self.session.head(url)
+                trace['status'] = response.status_code
+            self.log.debug("URL %s returned status %s" % (url, response.status_code))
+            if response.status_code == 200:
+                self.log.debug("This URL seems to be correct, using it")
+                return layout
+        return None
 
     def download(self, name, filename, hash, outfile, hashtype=None, **kwargs):
-        original_download_path = self.download_path
+        if hashtype is None:
+            hashtype = self.hashtype
         urled_file = filename.replace(' ', '%20')
         path_dict = {'name': name, 'filename': urled_file, 'hash': hash,
                      'hashtype': hashtype}
         path_dict.update(kwargs)
 
-        for download_path in [self.old_download_path, self.new_download_path]:
-            path = download_path % path_dict
-            url = '%s/%s' % (self.download_url, path)
-            response = requests.head(url)
-            self.log.debug("URL %s returned status %s" % (url, response.status_code))
-            if response.status_code == 200:
-                self.log.debug("This URL seems to be correct, using it")
-                self.download_path = download_path
-                break
+        self.log.info("Downloading %s", filename)
+        if os.path.exists(outfile):
+            if self.file_is_valid(outfile, hash, hashtype=hashtype):
+                return
+
+        key = self.layout_key(name)
+        layout = self.layout_cache.get(key)
+        if layout:
+            try:
+                return self._download_url(
+                    self._url(layout, path_dict), filename, hash, outfile,
+                    hashtype)
+            except DownloadNotFound as e:
+                self.log.debug("Download with remembered layout '%s' failed (%s),"
+                               " probing again" % (layout, e))
+                self.layout_cache.invalidate(key)
+
+        layout = self.probe_layout(path_dict)
+        if layout:
+            self.layout_cache.set(key, layout)
+        return self._download_url(
+            self._url(layout, path_dict), filename, hash, outfile, hashtype)
+
+    def _url(self, layout, path_dict):
+        download_path = self.layouts[layout] if layout else self.download_path
+        return '%s/%s' % (self.download_url, download_path % path_dict)
+
+    def _download_url(self, url, filename, hash, outfile, hashtype):
+        """
+        Stream the file at url into outfile.
+
+        The data is written into <outfile>.part in chunks and hashed on
+        the fly. An existing .part file left by an interrupted transfer is
+        resumed with a Range request. Only a file with the expected hash
+        is renamed to outfile, so outfile is never left incomplete and it
+        does not need to be read again for verification.
+        """
+        part_file = outfile + '.part'
+        offset = 0
+        headers = {'Accept-Encoding': 'identity'}
+        if os.path.exists(part_file):
+            offset = os.path.getsize(part_file)
+            if offset:
+                headers['Range'] = 'bytes=%d-' % offset
+
+        with span('lookaside.download', file=filename, url=url,
+                  offset=offset, bytes=0) as trace:
+            try:
+                response = self.session.get(url, stream=True, headers=headers)
+            except requests.exceptions.RequestException as e:
+                raise DownloadError(str(e))
+
+            with response:
+                if response.status_code == 404:
+                    raise DownloadNotFound('Server returned status code 404')
+
+                resumed = offset and response.status_code == 206 and \
+                    response.headers.get('Content-Range', '').startswith(
+                        'bytes %d-' % offset)
+                if offset and not resumed and response.status_code != 200:
+                    # the partial file does not fit the remote one, start over
+                    self.log.debug("Cannot resume %s (status %s), restarting"
+                                   % (filename, response.status_code))
+                    os.unlink(part_file)
+                    return self._download_url(url, filename, hash, outfile,
+                                              hashtype)
+
+                if response.status_code not in (200, 206):
+                    raise DownloadError('Server returned status code %d'
+                                        % response.status_code)
+
+                checksum = hashlib.new(hashtype)
+                if resumed:
+                    self.log.info("Resuming download of %s from byte %d"
+                                  % (filename, offset))
+                    with open(part_file, 'rb') as f:
+                        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                            checksum.update(chunk)
+
+                try:
+                    with open(part_file, 'ab' if resumed else 'wb') as f:
+                        for chunk in response.iter_content(CHUNK_SIZE):
+                            f.write(chunk)
+                            checksum.update(chunk)
+                            trace['bytes'] += len(chunk)
+                except requests.exceptions.RequestException as e:
+                    # keep the partial file to resume from it next time
+                    raise DownloadError('Download of %s interrupted: %s'
+                                        % (filename, e))
+
+            if checksum.hexdigest() != hash:
+                os.unlink(part_file)
+                if resumed:
+                    # the partial file is likely of another version of
+                    # the file, download the whole file once more
+                    self.log.debug("Resumed %s failed checksum, restarting"
+                                   % filename)
+                    return self._download_url(url, filename, hash, outfile,
+                                              hashtype)
+                raise DownloadError('%s failed checksum' % filename)
+
+            last_modified = response.headers.get('Last-Modified')
+            if last_modified:
+                tstamp = email.utils.mktime_tz(
+                    email.utils.parsedate_tz(last_modified))
+                os.utime(part_file, (tstamp, tstamp))
+
+            # replaces the directory entry only, so an existing outfile
+            # hardlinked to the shared source store stays untouched
+            os.rename(part_file, outfile)
+
+    def _post(self, data, error_cls):
+        try:
+            response = self.session.post(self.upload_url, **data)
+        except requests.exceptions.RequestException as e:
+            raise error_cls(str(e))
+        output = response.text.strip()
+        if response.status_code != 200:
+            raise error_cls(output)
+        return output
+
+    def remote_file_exists(self, name, filename, hash):
+        """Ask the lookaside CGI whether it already has the given file"""
+        output = self._post({'data': [('name', name),
+                                      ('%ssum' % self.hashtype, hash),
+                                      ('filename', filename)]},
+                            UploadError)
+
+        # Lookaside CGI script returns these strings depending on
+        # whether or not the file exists
+        if output == 'Available':
+            return True
+        if output == 'Missing':
+            return False
+
+        self.log.debug(output)
+        raise UploadError('Error checking for %s at %s'
+                          % (filename, self.upload_url))
+
+    def upload(self, name, filepath, hash):
+        """Upload a file to the lookaside unless it is already there"""
+        filename = os.path.basename(filepath)
+        if self.remote_file_exists(name, filename, hash):
+            self.log.info("File already uploaded: %s", filepath)
+            return
+        self.send_file(name, filepath, hash)
+
+    def send_file(self, name, filepath, hash, progress=None):
+        """
+        Upload a file without asking whether the lookaside has it.
 
-        result = super(CGILookasideCache, self).download(name, filename, hash, outfile, hashtype=hashtype, **kwargs)
-        self.download_path = original_download_path
-        return result
+        :param progress: called with the size of every chunk sent
+        """
+        self.log.info("Uploading: %s", filepath)
+        body = MultipartStream([('name', name),
+                                ('%ssum' % self.hashtype, hash)],
+                               'file', filepath, progress=progress)
+        try:
+            output = self._post({'data': body,
+                                 'headers': {'Content-Type': body.content_type}},
+                                UploadError)
+        finally:
+            body.close()
+        if output:
+            self.log.debug(output)
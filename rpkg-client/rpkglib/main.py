@@ -0,0 +1,104 @@
+import os
+import sys
+import logging
+import argparse
+
+from os.path import expanduser
+from six.moves import configparser
+
+import pyrpkg
+import pyrpkg.utils
+
+from rpkglib.cli import rpkgClient, find_command
+from rpkglib.trace import tracer
+
+
+def load_config(config_path=None):
+    """
+    Read the config file to use, if not specified, ~/.config/rpkg is used
+    and if that does not exists, then /etc/rpkg.conf is tried.
+    """
+    config_to_use = '/etc/rpkg.conf'
+    for custom_config in [config_path, expanduser('~/.config/rpkg')]:
+        if custom_config and os.path.exists(custom_config):
+            config_to_use = custom_config
+            break
+
+    # Setup a configuration object and read config file data
+    config = configparser.SafeConfigParser()
+    config.read(config_to_use)
+    return config
+
+
+def main(argv=None):
+    """
+    Run rpkg with the given command line arguments (sys.argv[1:] by
+    default) and return the exit code.
+    """
+    if argv is not None:
+        sys.argv = sys.argv[:1] + list(argv)
+
+    # Setup an argparser and parse the known commands to get the config file
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-C', '--config', help='Specify a config file to use. '
+                        'If not specified, ~/.config/rpkg is used and if that '
+                        'does not exists, then /etc/rpkg.conf is tried.')
+    parser.add_argument('--path')
+    # Used by rpkg.bash to cache the parser tree, see rpkglib.completion
+    parser.add_argument('--dump-completion', metavar='FILE')
+
+    (args, other) = parser.parse_known_args()
+    config = load_config(args.config)
+
+    if args.dump_completion:
+        from rpkglib.completion import write_completion_cache
+        client = rpkgClient(config)
+        write_completion_cache(
+            client.parser, args.dump_completion,
+            path=args.path or os.getcwd(),
+            stamp=int(os.stat(sys.argv[0]).st_mtime))
+        return 0
+
+    client = rpkgClient(config, command=find_command(sys.argv[1:]))
+    client.do_imports('rpkglib')
+    client.parse_cmdline()
+
+    if not client.args.path:
+        try:
+            client.args.path = pyrpkg.utils.getcwd()
+        except:
+            print('Could not get current path, have you deleted it?')
+            return 1
+
+    # setup the logger -- This logger will take things of INFO or DEBUG and
+    # log it to stdout.  Anything above that (WARN, ERROR, CRITICAL) will go
+    # to stderr.  Normal operation will show anything INFO and above.
+    # Quiet hides INFO, while Verbose exposes DEBUG.  In all cases WARN or
+    # higher are exposed (via stderr).
+    log = pyrpkg.log
+    client.setupLogging(log)
+
+    if client.args.v:
+        log.setLevel(logging.DEBUG)
+    elif client.args.q:
+        log.setLevel(logging.WARNING)
+    else:
+        log.setLevel(logging.INFO)
+
+    if client.args.trace:
+        tracer.enabled = True
+
+    # Run the necessary command
+    try:
+        return client.args.command()
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        log.error('Could not execute %s: %s' %
+                  (client.args.command.__name__, str(e)))
+        if client.args.v:
+            raise
+        return 1
+    finally:
+        if client.args.trace:
+            tracer.write(client.args.trace)
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import logging
+import os
+import stat
+
+from rpkglib import ignore
+from rpkglib.sourcecache import stat_key
+
+log = logging.getLogger("__main__")
+
+CHUNK_SIZE = 1024*1024
+
+
+class HashingReader(object):
+    """File wrapper computing sha256 of everything read through it"""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.checksum = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.checksum.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.checksum.hexdigest()
+
+
+def hash_file(path):
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def file_entry(st, digest):
+    """Manifest entry of a regular file"""
+    return ['file'] + stat_key(st)[:2] + [digest]
+
+
+def path_entry(path, st):
+    """Manifest entry of anything else than a regular file"""
+    if stat.S_ISDIR(st.st_mode):
+        return ['dir']
+    if stat.S_ISLNK(st.st_mode):
+        return ['link', os.readlink(path)]
+    return ['other', st.st_mode]
+
+
+class SourceManifest(object):
+    """
+    Record of the input files a generated Source0 archive was packed from.
+
+    The manifest maps every packed path to its type and, for regular
+    files, size, mtime and sha256. It also remembers the identity of the
+    archive it describes and the packing options, so that an archive
+    replaced by somebody else or packed differently is never reused.
+    """
+    def __init__(self, path):
+        """
+        :param str path: json file holding the manifest
+        """
+        self.path = path
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = {}
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path) as f:
+                        self._data = json.load(f)
+                except (IOError, ValueError) as e:
+                    log.debug("Ignoring unreadable manifest {}: {}"
+                              .format(self.path, e))
+        return self._data
+
+    def describes(self, archive_path):
+        """Whether the manifest was written for the archive as it is now"""
+        try:
+            st = os.stat(archive_path)
+        except OSError:
+            return False
+        return self.data.get('archive') == stat_key(st)
+
+    def is_current(self, archive_path, dirpath, options):
+        """
+        Tell whether archive_path was packed from the current content
+        of dirpath with the same options. Only files whose size or mtime
+        differ from the manifest are read.
+        """
+        if not self.describes(archive_path):
+            return False
+        if self.data.get('options') != options:
+            log.debug("Packing options of {} changed".format(archive_path))
+            return False
+
+        files = self.data.get('files', {})
+        seen = 0
+        rules = ignore.load_exclude_rules(dirpath, options.get('excludes', []))
+        skip = os.path.abspath(archive_path)
+        for (path, relpath) in ignore.iter_tree(dirpath, rules):
+            if os.path.abspath(path) == skip:
+                continue
+            entry = files.get(relpath)
+            if entry is None:
+                log.debug("{} was added".format(relpath))
+                return False
+            seen += 1
+
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode):
+                (size, mtime_ns) = stat_key(st)[:2]
+                changed = entry[0] != 'file' or entry[1] != size or \
+                    (entry[2] != mtime_ns and hash_file(path) != entry[3])
+            else:
+                changed = path_entry(path, st) != entry
+            if changed:
+                log.debug("{} changed".format(relpath))
+                return False
+
+        if seen != len(files):
+            log.debug("Some files were removed from {}".format(dirpath))
+            return False
+        return True
+
+    def write(self, archive_path, files, options):
+        """
+        :param str archive_path: the generated archive
+        :param dict files: relpath -> manifest entry of the packed paths
+        :param dict options: packing options
+        """
+        self._data = {
+            'archive': stat_key(os.stat(archive_path)),
+            'options': options,
+            'files': files,
+        }
+        dirpath = os.path.dirname(self.path)
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self._data, f)
+        os.rename(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._data = None
+
+
+class SrpmFingerprint(object):
+    """
+    Record of what an srpm was built from. Like SourceManifest, it also
+    remembers the identity of the srpm, so that an srpm replaced by
+    somebody else is never reused.
+    """
+    def __init__(self, path, srpm_path):
+        """
+        :param str path: json file holding the fingerprint
+        :param str srpm_path: the srpm it describes
+        """
+        self.path = path
+        self.srpm_path = srpm_path
+
+    def matches(self, inputs):
+        """Whether the srpm exists and was built from inputs"""
+        try:
+            st = os.stat(self.srpm_path)
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        return data.get('srpm') == stat_key(st) and \
+            data.get('inputs') == json.loads(json.dumps(inputs))
+
+    def write(self, inputs):
+        """
+        :param dict inputs: json serializable description of everything
+                the srpm depends on
+        """
+        data = {
+            'srpm': stat_key(os.stat(self.srpm_path)),
+            'inputs': inputs,
+        }
+        dirpath = os.path.dirname(self.path)
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
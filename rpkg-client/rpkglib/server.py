@@ -0,0 +1,234 @@
+"""
+rpkg serve: run rpkg commands in forks of one long-lived process.
+
+A client connects to the Unix socket and sends one JSON line
+{"argv": [...], "cwd": "...", "env": {...}}. The server forks, the fork
+changes into cwd, takes over env and runs rpkg with argv. Its stdout and
+stderr are streamed back in frames of one type byte, a 4 byte big
+endian payload length and the payload:
+
+    '1' stdout data, '2' stderr data, 'x' exit code (ascii)
+
+The rpkg script implements the client side (see RPKG_SERVER), it must
+not import rpkglib to stay cheap.
+"""
+
+import errno
+import json
+import logging
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+
+log = logging.getLogger("__main__")
+
+STDOUT = b'1'
+STDERR = b'2'
+EXIT = b'x'
+
+HEADER = struct.Struct('>cI')
+
+
+def default_socket_path():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or '/tmp'
+    return os.path.join(runtime_dir, 'rpkg-{}.sock'.format(os.getuid()))
+
+
+def send_frame(sock, kind, payload):
+    sock.sendall(HEADER.pack(kind, len(payload)) + payload)
+
+
+def recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def read_frames(sock):
+    """Yield (kind, payload) frames until the connection is closed"""
+    while True:
+        header = recv_exactly(sock, HEADER.size)
+        if header is None:
+            return
+        (kind, size) = HEADER.unpack(header)
+        payload = recv_exactly(sock, size)
+        if payload is None:
+            return
+        yield (kind, payload)
+
+
+def read_request(sock):
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return json.loads(data.decode('utf-8'))
+
+
+def warm_up():
+    """Do the expensive part of rpkg startup once, before any fork"""
+    import rpm
+    import requests
+    import pyrpkg.cli
+    import rpkglib.cli
+    import rpkglib.lookaside
+    import rpkglib.spec
+    rpm.reloadConfig()
+
+
+class Server(object):
+    """
+    Accept requests on a Unix socket and run each of them in a fork.
+
+    Running in a fork keeps the requests isolated from each other (rpm
+    macros, current directory, environment, file descriptors) while the
+    modules and rpm configuration loaded by the server are inherited.
+    """
+    def __init__(self, socket_path, run):
+        """
+        :param str socket_path: where to listen
+        :param run: function taking argv and returning the exit code
+        """
+        self.socket_path = socket_path
+        self.run = run
+        self.sock = None
+        self.children = set()
+
+    def listen(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            self.sock.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        self.sock.listen(16)
+        self.sock.settimeout(1)
+
+    def serve_forever(self):
+        log.info('Listening on {}'.format(self.socket_path))
+        try:
+            while True:
+                self.reap()
+                try:
+                    (conn, _) = self.sock.accept()
+                except socket.timeout:
+                    continue
+                pid = os.fork()
+                if pid:
+                    conn.close()
+                    self.children.add(pid)
+                    continue
+                try:
+                    self.sock.close()
+                    conn.settimeout(None)
+                    self.handle(conn)
+                finally:
+                    os._exit(0)
+        finally:
+            self.sock.close()
+            os.unlink(self.socket_path)
+
+    def reap(self):
+        for pid in list(self.children):
+            try:
+                (done, _) = os.waitpid(pid, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                done = pid
+            if done:
+                self.children.discard(pid)
+
+    def handle(self, conn):
+        """Run a request, called in the forked child"""
+        request = read_request(conn)
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+        # drop what the server itself logs to
+        import pyrpkg
+        del pyrpkg.log.handlers[:]
+
+        null_fd = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(null_fd, 0)
+        os.close(null_fd)
+
+        relays = []
+        send_lock = threading.Lock()
+        for (fd, kind) in [(1, STDOUT), (2, STDERR)]:
+            (read_fd, write_fd) = os.pipe()
+            os.dup2(write_fd, fd)
+            os.close(write_fd)
+            relay = threading.Thread(target=self.relay,
+                                     args=(read_fd, conn, kind, send_lock))
+            relay.daemon = True
+            relay.start()
+            relays.append(relay)
+        # in case the server runs with the python streams replaced
+        (sys.stdout, sys.stderr) = (sys.__stdout__, sys.__stderr__)
+
+        code = 1
+        try:
+            code = self.run(request['argv'])
+        except SystemExit as e:
+            code = e.code
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+        if code is None:
+            code = 0
+        elif not isinstance(code, int):
+            sys.stderr.write('{}\n'.format(code))
+            sys.stderr.flush()
+            code = 1
+
+        # close the pipes so that the relays see their end
+        null_fd = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(null_fd, 1)
+        os.dup2(null_fd, 2)
+        os.close(null_fd)
+        for relay in relays:
+            relay.join()
+        send_frame(conn, EXIT, str(code).encode('ascii'))
+        conn.close()
+
+    @staticmethod
+    def relay(read_fd, conn, kind, send_lock):
+        try:
+            while True:
+                data = os.read(read_fd, 65536)
+                if not data:
+                    break
+                with send_lock:
+                    send_frame(conn, kind, data)
+        except (IOError, OSError, socket.error):
+            # the client went away, keep reading so that the command
+            # does not get stuck on a full pipe
+            while os.read(read_fd, 65536):
+                pass
+        finally:
+            os.close(read_fd)
+
+
+def serve(socket_path, run):
+    warm_up()
+    server = Server(socket_path, run)
+    server.listen()
+    server.serve_forever()
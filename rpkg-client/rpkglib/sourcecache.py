@@ -0,0 +1,366 @@
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+
+log = logging.getLogger("__main__")
+
+# ioctl request to clone file extents (reflink) on btrfs, xfs and others
+FICLONE = 0x40049409
+
+CHUNK_SIZE = 1024*1024
+
+# os.utime takes nanosecond times, float times lose the precision
+UTIME_NS = sys.version_info[0] >= 3
+
+
+def hash_file(path, hashtype):
+    """Hash the content of the file in path"""
+    checksum = hashlib.new(hashtype)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def link_file(src, dst, hardlink=False):
+    """
+    Make dst have the same content as src without copying data when
+    possible: reflink first, then a plain copy. With hardlink, a hardlink
+    is tried before, dst then shares the inode (and changes) with src.
+
+    :param str src: existing file
+    :param str dst: path to create, an existing file is replaced
+    :param bool hardlink: try to hardlink dst to src first
+    """
+    if os.path.exists(dst):
+        if hardlink and os.path.samefile(src, dst):
+            return
+        os.unlink(dst)
+
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+
+    with open(src, 'rb') as src_file:
+        with open(dst, 'wb') as dst_file:
+            try:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            except (IOError, OSError):
+                shutil.copyfileobj(src_file, dst_file)
+    shutil.copystat(src, dst)
+
+
+class SourceStore(object):
+    """
+    Content-addressed store of source files shared by all checkouts
+    on the machine.
+
+    Files are stored under <root>/<hashtype>/<hash[:2]>/<hash> and are
+    reflinked into checkouts (copied where reflinks are not supported),
+    or hardlinked with hardlink. A hardlinked checkout file modified in
+    place changes the stored file as well, so stored files are checked
+    against their hash before being linked again and corrupted ones are
+    dropped.
+    The least recently used files are evicted once the store grows
+    over max_size bytes.
+    """
+    def __init__(self, root, max_size=None, hardlink=False):
+        """
+        :param str root: directory of the store
+        :param int max_size: size limit of the store in bytes or None
+        :param bool hardlink: hardlink files into checkouts
+        """
+        self.root = root
+        self.max_size = max_size
+        self.hardlink = hardlink
+
+    def path(self, hashtype, hash):
+        return os.path.join(self.root, hashtype, hash[:2], hash)
+
+    def _touch(self, path):
+        # access time marks usage for the LRU eviction. The mtime is part
+        # of the stat_key of the hardlinked checkout files and has to stay
+        # exact, without nanosecond utime the access time updated by the
+        # kernel on reads is relied on instead.
+        if not UTIME_NS:
+            return
+        try:
+            now_ns = getattr(time, 'time_ns', lambda: int(time.time()*1e9))()
+            os.utime(path, ns=(now_ns, os.stat(path).st_mtime_ns))
+        except OSError:
+            pass
+
+    def fetch(self, hashtype, hash, outfile, verified_index=None):
+        """
+        Put the file with the given hash to outfile if it is in the store.
+
+        :param VerifiedIndex verified_index: index sparing the hashing of
+                stored files that did not change since they were verified
+        :returns True if outfile was provided from the store
+        """
+        if verified_index is None:
+            verified_index = VerifiedIndex()
+        path = self.path(hashtype, hash)
+        if not os.path.exists(path):
+            return False
+        try:
+            if not verified_index.is_verified(path, hashtype, hash):
+                if hash_file(path, hashtype) != hash:
+                    log.warning("Removing corrupted {} from source store"
+                                .format(path))
+                    os.unlink(path)
+                    return False
+                verified_index.record(path, hashtype, hash)
+            link_file(path, outfile, self.hardlink)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            # evicted in the meantime
+            return False
+        self._touch(path)
+        log.debug("Provided {} from source store {}".format(outfile, path))
+        return True
+
+    def add(self, hashtype, hash, filepath, verified_index=None):
+        """
+        Store the file at filepath, which is known to have the given hash.
+
+        :param VerifiedIndex verified_index: index to record the stored
+                file in as verified
+        """
+        path = self.path(hashtype, hash)
+        if os.path.exists(path):
+            self._touch(path)
+            return
+
+        dirpath = os.path.dirname(path)
+        if not os.path.isdir(dirpath):
+            try:
+                os.makedirs(dirpath)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        tmp_path = '{}.{}.{}.tmp'.format(
+            path, os.getpid(), threading.current_thread().ident)
+        link_file(filepath, tmp_path, self.hardlink)
+        os.rename(tmp_path, path)
+        self._touch(path)
+        if verified_index is not None:
+            verified_index.record(path, hashtype, hash)
+        log.debug("Added {} to source store as {}".format(filepath, path))
+
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used files over the size limit"""
+        if not self.max_size:
+            return
+
+        entries = []
+        total_size = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_atime, st.st_size, path))
+                total_size += st.st_size
+
+        for (atime, size, path) in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total_size -= size
+            log.debug("Evicted {} from source store".format(path))
+
+
+def stat_key(st):
+    """Identify a version of a file by its size, mtime and inode"""
+    mtime_ns = getattr(st, 'st_mtime_ns', None) or int(st.st_mtime * 1e9)
+    return [st.st_size, mtime_ns, st.st_ino]
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Hold an exclusive flock of the file in path, across processes"""
+    with open(path, 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        # closing the file releases the lock
+        yield
+
+
+class PathIndex(object):
+    """
+    Entries keyed by absolute paths, kept in memory and merged into
+    a json file by save(). The file is read, merged and written under
+    a lock of <path>.lock, so that concurrent rpkg processes do not
+    lose each other's entries.
+
+    Entries of paths that no longer exist are dropped when saving: the
+    ones recorded by this process always, all of them once in about
+    PRUNE_EVERY saves not to stat every path of a big index each time.
+    """
+    description = 'index'
+    PRUNE_EVERY = 50
+
+    def __init__(self, path=None):
+        """
+        :param str path: json file to persist the index in, or None
+                to keep it only in memory
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = None
+        self._updates = {}
+
+    def _read(self):
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    return json.load(f)
+            except (IOError, ValueError) as e:
+                log.debug("Ignoring unreadable {} {}: {}"
+                          .format(self.description, self.path, e))
+        return {}
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = self._read()
+        return self._entries
+
+    def _get(self, path):
+        with self._lock:
+            return self._load().get(path)
+
+    def _put(self, path, entry):
+        with self._lock:
+            self._load()[path] = entry
+            self._updates[path] = entry
+
+    def save(self, prune=None):
+        """
+        Merge the recorded entries into the index file, dropping entries
+        of files that no longer exist.
+
+        :param bool prune: check all the entries for removed files, by
+                default done once in about PRUNE_EVERY saves
+        """
+        if prune is None:
+            prune = random.randint(1, self.PRUNE_EVERY) == 1
+        with self._lock:
+            if not self.path or not self._updates:
+                return
+            try:
+                dirpath = os.path.dirname(self.path)
+                if not os.path.isdir(dirpath):
+                    os.makedirs(dirpath)
+                with file_lock(self.path + '.lock'):
+                    entries = self._merge(prune)
+                    tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+                    with open(tmp_path, 'w') as f:
+                        json.dump(entries, f)
+                    os.rename(tmp_path, self.path)
+            except (IOError, OSError) as e:
+                log.debug("Could not write {} {}: {}"
+                          .format(self.description, self.path, e))
+                return
+            self._entries = entries
+            self._updates = {}
+
+    def _merge(self, prune):
+        entries = self._read()
+        entries.update(self._updates)
+        checked = entries if prune else self._updates
+        for filepath in list(checked):
+            if not os.path.exists(filepath):
+                del entries[filepath]
+        return entries
+
+
+class VerifiedIndex(PathIndex):
+    """
+    Sidecar index of files whose hash was already verified.
+
+    A file is identified by its absolute path, size, mtime and inode so
+    that unchanged files do not need to be hashed again in later runs.
+    """
+    description = 'verification index'
+
+    def is_verified(self, filepath, hashtype, hash):
+        """
+        Tell whether filepath is known to have the given hash
+        without reading its content.
+        """
+        filepath = os.path.abspath(filepath)
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return False
+        entry = self._get(filepath)
+        return bool(entry) and entry['stat'] == stat_key(st) and \
+            entry['hashtype'] == hashtype and entry['hash'] == hash
+
+    def record(self, filepath, hashtype, hash):
+        """Remember that filepath in its current state has the given hash"""
+        filepath = os.path.abspath(filepath)
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return
+        self._put(filepath, {'stat': stat_key(st), 'hashtype': hashtype,
+                             'hash': hash})
+
+
+class UnpackedCache(PathIndex):
+    """
+    Results of Commands.scan_package_dir keyed by the directory, its
+    mtime and the spec source names.
+
+    Adding, removing or renaming a directory entry changes the directory
+    mtime. A directory modified within RACY_SECONDS is not cached, its
+    mtime may not change with the next modification.
+    """
+    description = 'unpacked cache'
+    RACY_SECONDS = 2
+
+    @staticmethod
+    def _key(st, source_names):
+        return [stat_key(st)[1:], sorted(source_names)]
+
+    def get(self, dirpath, st, source_names):
+        """
+        :param os.stat_result st: stat of dirpath
+        :returns the cached (unpacked, sources) or None
+        """
+        entry = self._get(os.path.abspath(dirpath))
+        if entry and entry['key'] == self._key(st, source_names) and \
+                'sources' in entry:
+            return (entry['unpacked'], entry['sources'])
+        return None
+
+    def record(self, dirpath, st, source_names, unpacked, sources):
+        if time.time() - st.st_mtime < self.RACY_SECONDS:
+            return
+        self._put(os.path.abspath(dirpath), {
+            'key': self._key(st, source_names), 'unpacked': unpacked,
+            'sources': sources})
@@ -0,0 +1,261 @@
+import collections
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import shlex
+import threading
+
+from rpkglib.exceptions import RpmSpecParseException
+from rpkglib.sourcecache import stat_key
+from rpkglib.trace import span
+from rpkglib.utils import find_source_zero
+
+log = logging.getLogger("__main__")
+
+# rpm macros are process-global, only one spec can be parsed at a time
+rpm_lock = threading.RLock()
+
+SpecInfo = collections.namedtuple(
+    'SpecInfo', ['name', 'epoch', 'version', 'release', 'sources', 'source_zero'])
+
+
+def macros_from_rpmdefines(rpmdefines):
+    """
+    Turn ["--define 'name value'", ...] as used for rpm command lines
+    into a list of (name, value) tuples.
+    """
+    macros = []
+    for arg in shlex.split(' '.join(rpmdefines)):
+        if arg == '--define':
+            continue
+        (name, _, value) = arg.partition(' ')
+        macros.append((name, value))
+    return macros
+
+
+def parse_spec(spec_path, macros=(), header=False):
+    """
+    Parse a spec file with rpm and return its SpecInfo.
+
+    The given macros are defined for the parse only, rpm configuration
+    is reloaded afterwards so that nothing leaks into later parses.
+
+    :param str spec_path: path to the spec file
+    :param list macros: (name, value) tuples to define
+    :param bool header: return (SpecInfo, source rpm header) instead,
+            the header is an rpm.hdr and cannot leave the process
+    """
+    import rpm
+
+    with rpm_lock, span('spec.parse', spec=spec_path):
+        ts = rpm.ts()
+        try:
+            for (name, value) in macros:
+                rpm.addMacro(name, value)
+            rpm_spec = ts.parseSpec(spec_path)
+
+            sources = [tuple(source) for source in rpm_spec.sources]
+            info = SpecInfo(
+                name=rpm.expandMacro("%{name}"),
+                epoch=rpm.expandMacro("%{?epoch}") or "0",
+                version=rpm.expandMacro("%{version}"),
+                release=rpm.expandMacro("%{release}"),
+                sources=sources,
+                source_zero=find_source_zero(sources),
+            )
+            if header:
+                return (info, rpm_spec.sourceHeader)
+            return info
+        except ValueError as e:
+            raise RpmSpecParseException(str(e))
+        finally:
+            rpm.reloadConfig()
+
+
+def _init_evaluator():
+    import rpm
+    rpm.reloadConfig()
+
+
+def _evaluate(args):
+    (spec_path, macros) = args
+    try:
+        return parse_spec(spec_path, macros)
+    except RpmSpecParseException as e:
+        return e
+    except Exception as e:
+        # the exception must survive pickling on its way back
+        return RpmSpecParseException('{}: {}'.format(spec_path, e))
+
+
+class SpecEvaluator(object):
+    """
+    Pool of worker processes parsing spec files in parallel.
+
+    rpm keeps macros in process-global state, every worker starts from
+    freshly loaded rpm configuration and reloads it after each parse,
+    so macros of one spec cannot leak into another, nor into the parent.
+    """
+    def __init__(self, processes=None):
+        """
+        :param int processes: number of worker processes, number of cpus
+                by default
+        """
+        self.processes = processes or multiprocessing.cpu_count()
+        self._pool = None
+
+    def evaluate(self, specs):
+        """
+        Parse the specs given as (spec_path, macros) pairs.
+
+        :returns list of SpecInfo or RpmSpecParseException (for a spec
+                that failed to parse) in the order of specs
+        """
+        specs = list(specs)
+        if not specs:
+            return []
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(
+                min(self.processes, len(specs)), _init_evaluator)
+        return self._pool.map(_evaluate, specs, chunksize=1)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+class SpecCache(object):
+    """
+    Results of spec parsing keyed by spec path, its size and mtime and
+    the defined macros, so that a spec is parsed only once per process
+    (or, with a cache directory, once until it changes).
+
+    Note that the result of a parse can also depend on %() shell
+    expansions and the system macro files, which are not part of the
+    key. That is why persisting the results on disk is optional.
+    """
+    def __init__(self, cache_dir=None):
+        """
+        :param str cache_dir: directory to persist the results in,
+                None to keep them only in memory
+        """
+        self.cache_dir = cache_dir
+        self._entries = {}
+        # source rpm headers of the specs parsed in this process
+        self._headers = {}
+        self._lock = threading.Lock()
+
+    def _disk_path(self, key):
+        digest = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest + '.json')
+
+    def _load(self, key):
+        path = self._disk_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, ValueError) as e:
+            log.debug("Ignoring unreadable spec cache {}: {}".format(path, e))
+            return None
+        data['sources'] = [tuple(source) for source in data['sources']]
+        return SpecInfo(**data)
+
+    def _save(self, key, info):
+        path = self._disk_path(key)
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(info._asdict(), f)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            log.debug("Could not write spec cache {}: {}".format(path, e))
+
+    def _key(self, spec_path, macros):
+        spec_path = os.path.abspath(spec_path)
+        return [spec_path, stat_key(os.stat(spec_path))[:2],
+                [list(macro) for macro in macros]]
+
+    def prefetch(self, specs, evaluator):
+        """
+        Parse the not yet cached specs from (spec_path, macros) pairs at
+        once with the given SpecEvaluator. Specs failing to parse are not
+        cached, get() raises their error again.
+        """
+        missing = []
+        for (spec_path, macros) in specs:
+            try:
+                key = self._key(spec_path, macros)
+            except OSError:
+                continue
+            with self._lock:
+                if json.dumps(key) in self._entries:
+                    continue
+            info = self._load(key) if self.cache_dir else None
+            if info is not None:
+                with self._lock:
+                    self._entries[json.dumps(key)] = info
+                continue
+            missing.append((key, macros))
+
+        results = evaluator.evaluate(
+            [(key[0], macros) for (key, macros) in missing])
+        for ((key, macros), info) in zip(missing, results):
+            if isinstance(info, Exception):
+                log.debug("Parsing {} failed: {}".format(key[0], info))
+                continue
+            if self.cache_dir:
+                self._save(key, info)
+            with self._lock:
+                self._entries[json.dumps(key)] = info
+
+    def get(self, spec_path, macros=()):
+        """Return SpecInfo of spec_path, parsing it only when needed"""
+        key = self._key(spec_path, macros)
+        memory_key = json.dumps(key)
+
+        with span('spec.get', spec=key[0]) as trace:
+            with self._lock:
+                info = self._entries.get(memory_key)
+            trace['cache'] = 'memory'
+            if info is None and self.cache_dir:
+                info = self._load(key)
+                trace['cache'] = 'disk'
+            if info is None:
+                trace['cache'] = 'miss'
+                log.debug("Parsing {}".format(key[0]))
+                (info, header) = parse_spec(key[0], macros, header=True)
+                with self._lock:
+                    self._headers[memory_key] = header
+                if self.cache_dir:
+                    self._save(key, info)
+
+        with self._lock:
+            self._entries[memory_key] = info
+        return info
+
+    def header(self, spec_path, macros=()):
+        """
+        Return the source rpm header of spec_path as rpm made it when
+        parsing the spec. It is kept from the parse done by get() in
+        this process, the spec is parsed again only when get() did not
+        parse it (it was cached on disk or parsed by a SpecEvaluator).
+        """
+        key = self._key(spec_path, macros)
+        memory_key = json.dumps(key)
+        with self._lock:
+            header = self._headers.get(memory_key)
+        if header is None:
+            log.debug("Parsing {} for its header".format(key[0]))
+            (info, header) = parse_spec(key[0], macros, header=True)
+            with self._lock:
+                self._entries[memory_key] = info
+                self._headers[memory_key] = header
+        return header
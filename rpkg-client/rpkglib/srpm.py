@@ -0,0 +1,362 @@
+"""
+In-process source rpm writer.
+
+An alternative to rpmbuild -bs which parses the spec once more in a new
+process: the .src.rpm is written from the source rpm header rpm made
+when the spec was parsed (see SpecCache.header), laid out like rpmbuild
+does it:
+
+    lead, signature header (header digests), main header (spec tags and
+    the file list), gzip compressed cpio payload (the spec, Source and
+    Patch files)
+
+The space of the headers is reserved and the payload is written first,
+so every file is read only once, hashed while it is copied. The headers
+with the file and payload digests are written at the start of the file
+at the end.
+"""
+
+import gzip
+import hashlib
+import logging
+import os
+import socket
+import struct
+import time
+
+try:
+    import grp
+    import pwd
+except ImportError:
+    grp = pwd = None
+
+from rpkglib.compression import ChecksumFile
+from rpkglib.exceptions import UnsupportedSrpmException
+from rpkglib.spec import rpm_lock
+
+log = logging.getLogger("__main__")
+
+CHUNK_SIZE = 1024*1024
+
+LEAD_MAGIC = b'\xed\xab\xee\xdb'
+HEADER_MAGIC = b'\x8e\xad\xe8\x01\x00\x00\x00\x00'
+
+# tag data types
+(CHAR, INT8, INT16, INT32, INT64, STRING, BIN, STRING_ARRAY,
+ I18NSTRING) = range(1, 10)
+# struct format and size of the integer types
+INT_FORMATS = {
+    CHAR: 'B',
+    INT8: 'B',
+    INT16: 'H',
+    INT32: 'I',
+    INT64: 'Q',
+}
+
+# signature header tags
+SIGTAG_SHA1 = 269
+SIGTAG_SHA256 = 273
+SIGTAG_PAYLOADSIZE = 1007
+
+# main header tags
+HEADERSIGNATURES = 62
+HEADERIMMUTABLE = 63
+HEADERI18NTABLE = 100
+BUILDTIME = 1006
+BUILDHOST = 1007
+SIZE = 1009
+OS = 1021
+ARCH = 1022
+FILESIZES = 1028
+FILEMODES = 1030
+FILERDEVS = 1033
+FILEMTIMES = 1034
+FILEDIGESTS = 1035
+FILELINKTOS = 1036
+FILEFLAGS = 1037
+FILEUSERNAME = 1039
+FILEGROUPNAME = 1040
+FILEVERIFYFLAGS = 1045
+RPMVERSION = 1064
+FILEDEVICES = 1095
+FILEINODES = 1096
+FILELANGS = 1097
+SOURCEPACKAGE = 1106
+DIRINDEXES = 1116
+BASENAMES = 1117
+DIRNAMES = 1118
+PAYLOADFORMAT = 1124
+PAYLOADCOMPRESSOR = 1125
+PAYLOADFLAGS = 1126
+FILEDIGESTALGO = 5011
+ENCODING = 5062
+PAYLOADDIGEST = 5092
+PAYLOADDIGESTALGO = 5093
+
+# tags the writer sets itself, never copied from the spec header
+WRITER_TAGS = set([
+    BUILDTIME, BUILDHOST, SIZE, FILESIZES, FILEMODES, FILERDEVS,
+    FILEMTIMES, FILEDIGESTS, FILELINKTOS, FILEFLAGS, FILEUSERNAME,
+    FILEGROUPNAME, FILEVERIFYFLAGS, RPMVERSION, FILEDEVICES, FILEINODES,
+    FILELANGS, SOURCEPACKAGE, DIRINDEXES, BASENAMES, DIRNAMES,
+    PAYLOADFORMAT, PAYLOADCOMPRESSOR, PAYLOADFLAGS, FILEDIGESTALGO,
+    ENCODING, PAYLOADDIGEST, PAYLOADDIGESTALGO,
+])
+
+RPMFILE_SPECFILE = 1 << 5
+# flag of NoSource/NoPatch entries of rpm spec sources
+RPMBUILD_ISNO = 1 << 3
+
+# rpm ids of the file digest algorithms
+DIGEST_ALGOS = {
+    'md5': 1,
+    'sha1': 2,
+    'sha256': 8,
+    'sha384': 9,
+    'sha512': 10,
+}
+
+# sizes are written as 32 bit numbers
+MAX_SIZE = 2**32 - 1
+
+
+def _bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+def _padding(length, alignment):
+    return (alignment - length % alignment) % alignment
+
+
+def encode_header(entries, region_tag):
+    """
+    Serialize a header with an immutable region.
+
+    :param list entries: (tag, type, values) with values a list of
+            numbers or strings (one for STRING), bytes for BIN
+    :param int region_tag: HEADERSIGNATURES or HEADERIMMUTABLE
+    """
+    index = []
+    data = b''
+    for (tag, tag_type, values) in sorted(entries):
+        if tag_type in INT_FORMATS:
+            fmt = INT_FORMATS[tag_type]
+            size = struct.calcsize(fmt)
+            data += b'\0' * _padding(len(data), size)
+            mask = 2**(8*size) - 1
+            payload = struct.pack('>{}{}'.format(len(values), fmt),
+                                  *[value & mask for value in values])
+            count = len(values)
+        elif tag_type == BIN:
+            payload = values
+            count = len(values)
+        else:
+            payload = b''.join(_bytes(value) + b'\0' for value in values)
+            count = len(values)
+        index.append(struct.pack('>iIii', tag, tag_type, len(data), count))
+        data += payload
+
+    # the region trailer points back at the index entries it covers,
+    # its own entry included
+    trailer = struct.pack('>iIii', region_tag, BIN,
+                          -16 * (len(index) + 1), 16)
+    index.insert(0, struct.pack('>iIii', region_tag, BIN, len(data), 16))
+    data += trailer
+    return HEADER_MAGIC + struct.pack('>ii', len(index), len(data)) + \
+        b''.join(index) + data
+
+
+def encode_lead(name):
+    """rpm lead of a source package named name (name-version-release)"""
+    # major 3, minor 0, source, arch 0, name, os 1, header signature
+    return struct.pack('>4sBBhh66shh16s', LEAD_MAGIC, 3, 0, 1, 0,
+                       _bytes(name)[:65], 1, 5, b'')
+
+
+def cpio_entry(name, mode, mtime, size, ino):
+    """newc cpio header of a file, padded for its data"""
+    name = _bytes(name) + b'\0'
+    header = ('070701' + '%08x' * 13 % (
+        ino, mode, 0, 0, 1, mtime, size, 0, 0, 0, 0, len(name), 0)
+    ).encode('ascii') + name
+    return header + b'\0' * _padding(len(header), 4)
+
+
+CPIO_TRAILER = cpio_entry('TRAILER!!!', 0, 0, 0, 0)
+
+
+def entries_from_header(hdr):
+    """
+    (tag, type, values) of the tags of an rpm header object to be
+    copied into the srpm header.
+    """
+    import rpm
+
+    entries = []
+    for tag in hdr.keys():
+        if tag < 1000 or tag in WRITER_TAGS:
+            continue
+        tag_type = rpm.tagtype(tag) & 0xffff
+        value = hdr[tag]
+        if tag_type == BIN:
+            entries.append((tag, BIN, bytes(value)))
+            continue
+        if not isinstance(value, list):
+            value = [value]
+        entries.append((tag, tag_type, value))
+
+    tags = set(entry[0] for entry in entries)
+    with rpm_lock:
+        if OS not in tags:
+            entries.append((OS, STRING, [rpm.expandMacro('%{_target_os}')]))
+        if ARCH not in tags:
+            entries.append((ARCH, STRING, [rpm.expandMacro('%{_arch}')]))
+    entries.append((RPMVERSION, STRING, [rpm.__version__]))
+    return entries
+
+
+class SrpmFile(object):
+    """A file going into the srpm"""
+    def __init__(self, name, path, flags=0):
+        self.name = name
+        self.path = path
+        self.flags = flags
+        self.st = os.stat(path)
+
+    @property
+    def owner(self):
+        user = group = 'root'
+        if pwd:
+            try:
+                user = pwd.getpwuid(self.st.st_uid)[0]
+            except KeyError:
+                pass
+        if grp:
+            try:
+                group = grp.getgrgid(self.st.st_gid)[0]
+            except KeyError:
+                pass
+        return (user, group)
+
+
+def file_entries(files, hashtype, digests):
+    """Header entries of the file list, digests in the order of files"""
+    owners = [f.owner for f in files]
+    return [
+        (SIZE, INT32, [sum(f.st.st_size for f in files)]),
+        (FILESIZES, INT32, [f.st.st_size for f in files]),
+        (FILEMODES, INT16, [f.st.st_mode for f in files]),
+        (FILERDEVS, INT16, [0] * len(files)),
+        (FILEMTIMES, INT32, [int(f.st.st_mtime) for f in files]),
+        (FILEDIGESTS, STRING_ARRAY, digests),
+        (FILELINKTOS, STRING_ARRAY, [''] * len(files)),
+        (FILEFLAGS, INT32, [f.flags for f in files]),
+        (FILEUSERNAME, STRING_ARRAY, [user for (user, _) in owners]),
+        (FILEGROUPNAME, STRING_ARRAY, [group for (_, group) in owners]),
+        (FILEVERIFYFLAGS, INT32, [-1] * len(files)),
+        (FILEDEVICES, INT32, [1] * len(files)),
+        (FILEINODES, INT32, list(range(1, len(files) + 1))),
+        (FILELANGS, STRING_ARRAY, [''] * len(files)),
+        (DIRINDEXES, INT32, [0] * len(files)),
+        (BASENAMES, STRING_ARRAY, [f.name for f in files]),
+        (DIRNAMES, STRING_ARRAY, ['']),
+        (FILEDIGESTALGO, INT32, [DIGEST_ALGOS[hashtype]]),
+    ]
+
+
+def write_srpm(srpm_path, entries, files, hashtype='sha256'):
+    """
+    Write a source rpm.
+
+    :param str srpm_path: the srpm to write (name-version-release.src.rpm),
+            replaced when it exists
+    :param list entries: (tag, type, values) of the main header, see
+            entries_from_header
+    :param list files: SrpmFile objects to put into the srpm
+    :param str hashtype: file digest algorithm
+    :raises UnsupportedSrpmException: when rpmbuild has to build the
+            srpm, for files over 4 GiB or an unknown hashtype
+    """
+    if hashtype not in DIGEST_ALGOS:
+        raise UnsupportedSrpmException(
+            "Unsupported file digest algorithm {}".format(hashtype))
+    files = sorted(files, key=lambda f: f.name)
+    payload_size = len(CPIO_TRAILER) + sum(
+        len(cpio_entry(f.name, 0, 0, 0, 0)) + f.st.st_size +
+        _padding(f.st.st_size, 4) for f in files)
+    if payload_size > MAX_SIZE:
+        raise UnsupportedSrpmException(
+            "Sources too big for the native srpm writer")
+
+    lead_name = os.path.basename(srpm_path)
+    if lead_name.endswith('.src.rpm'):
+        lead_name = lead_name[:-len('.src.rpm')]
+    buildtime = int(os.environ.get('SOURCE_DATE_EPOCH') or time.time())
+    entries = list(entries) + [
+        (HEADERI18NTABLE, STRING_ARRAY, ['C']),
+        (BUILDTIME, INT32, [buildtime]),
+        (BUILDHOST, STRING, [socket.gethostname()]),
+        (SOURCEPACKAGE, INT32, [1]),
+        (ENCODING, STRING, ['utf-8']),
+        (PAYLOADFORMAT, STRING, ['cpio']),
+        (PAYLOADCOMPRESSOR, STRING, ['gzip']),
+        (PAYLOADFLAGS, STRING, ['9']),
+        (PAYLOADDIGESTALGO, INT32, [DIGEST_ALGOS['sha256']]),
+    ]
+
+    def headers(digests, payload_digest):
+        header = encode_header(
+            entries + file_entries(files, hashtype, digests) +
+            [(PAYLOADDIGEST, STRING_ARRAY, [payload_digest])],
+            HEADERIMMUTABLE)
+        signature = encode_header([
+            (SIGTAG_SHA1, STRING, [hashlib.sha1(header).hexdigest()]),
+            (SIGTAG_SHA256, STRING, [hashlib.sha256(header).hexdigest()]),
+            (SIGTAG_PAYLOADSIZE, INT32, [payload_size]),
+        ], HEADERSIGNATURES)
+        signature += b'\0' * _padding(len(signature), 8)
+        return encode_lead(lead_name) + signature + header
+
+    # digests are hex strings of a fixed length, a header with zeroes
+    # instead is as long as the final one
+    placeholder = '0' * len(hashlib.new(hashtype).hexdigest())
+    headers_size = len(headers([placeholder] * len(files), '0' * 64))
+
+    tmp_path = '{}.{}.tmp'.format(srpm_path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as srpm:
+            srpm.seek(headers_size)
+            payload_checksum = hashlib.sha256()
+            payload = gzip.GzipFile(
+                filename='', mode='wb', compresslevel=9, mtime=0,
+                fileobj=ChecksumFile(srpm, payload_checksum))
+            digests = []
+            for (ino, f) in enumerate(files, 1):
+                payload.write(cpio_entry(f.name, f.st.st_mode,
+                                         int(f.st.st_mtime), f.st.st_size,
+                                         ino))
+                checksum = hashlib.new(hashtype)
+                copied = 0
+                with open(f.path, 'rb') as source:
+                    for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                        checksum.update(chunk)
+                        payload.write(chunk)
+                        copied += len(chunk)
+                if copied != f.st.st_size:
+                    raise IOError("{} changed while being written into {}"
+                                  .format(f.path, srpm_path))
+                payload.write(b'\0' * _padding(copied, 4))
+                digests.append(checksum.hexdigest())
+            payload.write(CPIO_TRAILER)
+            payload.close()
+
+            srpm.seek(0)
+            srpm.write(headers(digests, payload_checksum.hexdigest()))
+        os.rename(tmp_path, srpm_path)
+    except:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    log.info('Wrote: {}'.format(srpm_path))
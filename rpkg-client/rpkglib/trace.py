@@ -0,0 +1,95 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class Tracer(object):
+    """
+    Collects timed spans of the rpkg command phases.
+
+    Spans are only recorded while enabled. The dict yielded by span()
+    can be filled with details (sizes, cache hits, ...) which end up in
+    the args of the span. A span with 'bytes' gets its throughput in
+    bytes per second added.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        if not self.enabled:
+            yield args
+            return
+
+        start = time.time()
+        try:
+            yield args
+        except BaseException as e:
+            args['error'] = str(e) or e.__class__.__name__
+            raise
+        finally:
+            duration = time.time() - start
+            if args.get('bytes') and duration > 0:
+                args['throughput'] = int(args['bytes'] / duration)
+            thread = threading.current_thread()
+            event = {
+                'name': name,
+                'start': start,
+                'duration': duration,
+                'pid': os.getpid(),
+                'tid': thread.ident,
+                'thread': thread.name,
+                'args': args,
+            }
+            with self._lock:
+                self.events.append(event)
+
+    def write(self, path):
+        """
+        Write the spans into path as Chrome trace format (chrome://tracing,
+        Perfetto) if it ends with .json, as JSON lines otherwise.
+        """
+        with self._lock:
+            events = sorted(self.events, key=lambda event: event['start'])
+        with open(path, 'w') as f:
+            if path.endswith('.json'):
+                json.dump({'traceEvents': self._chrome_events(events)}, f)
+                return
+            for event in events:
+                f.write(json.dumps(event, sort_keys=True) + '\n')
+
+    @staticmethod
+    def _chrome_events(events):
+        chrome_events = []
+        threads = set()
+        for event in events:
+            if (event['pid'], event['tid']) not in threads:
+                threads.add((event['pid'], event['tid']))
+                chrome_events.append({
+                    'name': 'thread_name', 'ph': 'M',
+                    'pid': event['pid'], 'tid': event['tid'],
+                    'args': {'name': event['thread']},
+                })
+            chrome_events.append({
+                'name': event['name'],
+                'cat': event['name'].split('.')[0],
+                'ph': 'X',
+                'ts': int(event['start'] * 1e6),
+                'dur': int(event['duration'] * 1e6),
+                'pid': event['pid'],
+                'tid': event['tid'],
+                'args': event['args'],
+            })
+        return chrome_events
+
+
+tracer = Tracer()
+
+
+def span(name, **args):
+    """Time a phase with the global tracer, see Tracer.span"""
+    return tracer.span(name, **args)
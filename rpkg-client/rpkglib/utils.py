@@ -1,39 +1,305 @@
+import collections
+import contextlib
+import hashlib
+import io
 import logging
+import mmap
 import os
-import re
 import shutil
+import stat
 import tarfile
 
-from exceptions import SourceArchiveAlreadyExists
+from multiprocessing.pool import ThreadPool
+
+try:
+    import grp
+    import pwd
+except ImportError:
+    grp = pwd = None
+
+from rpkglib.exceptions import SourceArchiveAlreadyExists
+from rpkglib import compression
+from rpkglib import ignore
+from rpkglib.manifest import HashingReader, file_entry, path_entry
+from rpkglib.trace import span
 
 log = logging.getLogger("__main__")
 
 
-def pack_sources(dir_to_pack, target_path, pack_dir_as):
+# regular files up to this size are read by the prefetching workers,
+# bigger ones are mapped into memory by the writer
+PREFETCH_MAX_SIZE = 256*1024
+# number of entries prefetched ahead of the writer
+PREFETCH_WINDOW = 256
+DEFAULT_IO_THREADS = 8
+
+Prefetched = collections.namedtuple(
+    'Prefetched', ['st', 'linkname', 'data', 'digest'])
+
+
+def prefetch_entry(path, digest=False):
+    """
+    Stat path and read it if it is a small regular file. The sha256 of
+    the content is computed as well when digest is set.
+    """
+    st = os.lstat(path)
+    if stat.S_ISLNK(st.st_mode):
+        return Prefetched(st, os.readlink(path), None, None)
+    if not stat.S_ISREG(st.st_mode):
+        return Prefetched(st, '', None, None)
+
+    if st.st_size > PREFETCH_MAX_SIZE:
+        if hasattr(os, 'posix_fadvise'):
+            # let the disk read it while the writer is busy with others
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+        return Prefetched(st, '', None, None)
+
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        data = f.read(st.st_size)
+    return Prefetched(st, '', data,
+                      hashlib.sha256(data).hexdigest() if digest else None)
+
+
+def iter_prefetched(entries, pool, digest=False):
+    """
+    Yield (path, relpath, Prefetched) of the (path, relpath) entries in
+    their order. With a pool, up to PREFETCH_WINDOW entries are being
+    prefetched by its workers ahead of the consumer.
+    """
+    if not pool:
+        for (path, relpath) in entries:
+            yield (path, relpath, prefetch_entry(path, digest))
+        return
+
+    pending = collections.deque()
+    for (path, relpath) in entries:
+        pending.append((path, relpath,
+                        pool.apply_async(prefetch_entry, (path, digest))))
+        if len(pending) >= PREFETCH_WINDOW:
+            (path, relpath, result) = pending.popleft()
+            yield (path, relpath, result.get())
+    while pending:
+        (path, relpath, result) = pending.popleft()
+        yield (path, relpath, result.get())
+
+
+_owner_names = {}
+
+
+def _owner_name(getter, owner_id):
+    """User or group name of the id, looked up once per id"""
+    key = (getter, owner_id)
+    if key not in _owner_names:
+        try:
+            _owner_names[key] = getter(owner_id)[0]
+        except KeyError:
+            _owner_names[key] = ''
+    return _owner_names[key]
+
+
+def make_tarinfo(tarball, st, arcname, linkname):
+    """
+    TarInfo of a path from its lstat result, as tarfile.gettarinfo makes
+    it (including hardlinks), without stat'ing the path again.
+    None for sockets and other unsupported types.
+    """
+    mode = st.st_mode
+    if stat.S_ISREG(mode):
+        inode = (st.st_ino, st.st_dev)
+        if st.st_nlink > 1 and inode in tarball.inodes and \
+                arcname != tarball.inodes[inode]:
+            member_type = tarfile.LNKTYPE
+            linkname = tarball.inodes[inode]
+        else:
+            member_type = tarfile.REGTYPE
+            if inode[0]:
+                tarball.inodes[inode] = arcname
+    elif stat.S_ISDIR(mode):
+        member_type = tarfile.DIRTYPE
+    elif stat.S_ISFIFO(mode):
+        member_type = tarfile.FIFOTYPE
+    elif stat.S_ISLNK(mode):
+        member_type = tarfile.SYMTYPE
+    elif stat.S_ISCHR(mode):
+        member_type = tarfile.CHRTYPE
+    elif stat.S_ISBLK(mode):
+        member_type = tarfile.BLKTYPE
+    else:
+        return None
+
+    tarinfo = tarfile.TarInfo(arcname)
+    tarinfo.mode = mode
+    tarinfo.uid = st.st_uid
+    tarinfo.gid = st.st_gid
+    tarinfo.size = st.st_size if member_type == tarfile.REGTYPE else 0
+    tarinfo.mtime = st.st_mtime
+    tarinfo.type = member_type
+    tarinfo.linkname = linkname
+    if pwd:
+        tarinfo.uname = _owner_name(pwd.getpwuid, st.st_uid)
+    if grp:
+        tarinfo.gname = _owner_name(grp.getgrgid, st.st_gid)
+    if member_type in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+        tarinfo.devmajor = os.major(st.st_rdev)
+        tarinfo.devminor = os.minor(st.st_rdev)
+    return tarinfo
+
+
+def pack_sources(dir_to_pack, target_path, pack_dir_as,
+                 compressor=None, level=None, threads=None, excludes=(),
+                 deterministic=False, manifest_files=None, io_threads=None,
+                 checksum=None):
     """
-    Create a gzipped tar archive from the given directory.
+    Create a compressed tar archive from the given directory.
+
+    Git metadata, srpms and paths matching rules in .rpkgignore
+    (gitignore syntax) are left out. Excluded directories are not descended into.
+
+    In deterministic mode, the same content always gives the same
+    archive: members are sorted, owners are reset to root, mtimes are
+    set to $SOURCE_DATE_EPOCH (or 0) and the gzip header has no
+    timestamp.
+
+    The tree is listed, stat'ed and small files are read (and hashed for
+    the manifest) by io_threads worker threads ahead of the one thread
+    writing the tar members in order. Big files are mapped into memory
+    and read by the writer directly.
 
     :param str dir_to_pack: directory to be packed
     :param str target_path: path to the resulting archive
     :param str pack_dir_as: packed directory name inside the archive
+    :param str compressor: gzip, pgzip, bzip2, xz or zstd, by default
+            chosen according to the target_path extension
+    :param int level: compression level, compressor default if None
+    :param int threads: number of threads for compressors supporting
+            that, all cpus if None
+    :param list excludes: additional gitignore-style exclusion patterns
+    :param bool deterministic: produce a reproducible archive
+    :param dict manifest_files: if given, filled with relpath -> manifest
+            entry of every packed path, the digests are computed while
+            the files are packed
+    :param int io_threads: number of threads reading the tree, 1 to read
+            it in the writing thread
+    :param checksum: hashlib object updated with the archive content as
+            it is written
     """
     if os.path.exists(target_path):
         raise SourceArchiveAlreadyExists("{} already exists"
                                          .format(target_path))
 
-    log.debug("Packing {} as {} into {}...".format(
-        dir_to_pack, pack_dir_as, target_path))
+    compressor = compression.compressor_for(target_path, compressor)
+    log.debug("Packing {} as {} into {} using {}...".format(
+        dir_to_pack, pack_dir_as, target_path, compressor))
+
+    rules = ignore.load_exclude_rules(dir_to_pack, excludes)
+    # the archive may be created inside the packed directory
+    skip_path = os.path.abspath(target_path)
+    mtime = int(os.environ.get('SOURCE_DATE_EPOCH', 0))
+    digest = manifest_files is not None
+    packed = [0]
+
+    def add(tarball, path, arcname, relpath, entry):
+        tarinfo = make_tarinfo(tarball, entry.st, arcname, entry.linkname)
+        if tarinfo is None:
+            log.debug("Skipping {}, unsupported file type".format(path))
+            return
+        if deterministic:
+            tarinfo.uid = tarinfo.gid = 0
+            tarinfo.uname = tarinfo.gname = 'root'
+            tarinfo.mtime = mtime
+
+        if not tarinfo.isreg():
+            tarball.addfile(tarinfo)
+            if relpath and digest:
+                manifest_files[relpath] = path_entry(path, entry.st)
+            return
+
+        packed[0] += tarinfo.size
+        if entry.data is not None:
+            tarball.addfile(tarinfo, io.BytesIO(entry.data))
+            if digest:
+                manifest_files[relpath] = file_entry(entry.st, entry.digest)
+            return
 
-    def exclude(tar_info):
-        exclude_git_pattern = r'(/.git$|/.git/|/.gitignore$)'
-        if re.search(exclude_git_pattern, tar_info.name):
-            log.debug("Excluding {}".format(tar_info.name))
-            return None
-        return tar_info
+        with open(path, 'rb') as f:
+            content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                reader = HashingReader(content) if digest else content
+                tarball.addfile(tarinfo, reader)
+            finally:
+                content.close()
+            if digest:
+                manifest_files[relpath] = file_entry(
+                    os.fstat(f.fileno()), reader.hexdigest())
 
-    tarball = tarfile.open(target_path, 'w:gz')
-    tarball.add(dir_to_pack, pack_dir_as, filter=exclude)
-    tarball.close()
+    if io_threads is None:
+        io_threads = DEFAULT_IO_THREADS
+    pool = ThreadPool(io_threads) if io_threads > 1 else None
+
+    with span('pack', archive=os.path.basename(target_path),
+              compressor=compressor, io_threads=io_threads) as trace:
+        fileobj = compression.open_compressed(
+            target_path, compressor, level=level, threads=threads,
+            deterministic=deterministic, checksum=checksum)
+        try:
+            try:
+                tarball = tarfile.open(fileobj=fileobj, mode='w|',
+                                       format=tarfile.GNU_FORMAT)
+                add(tarball, dir_to_pack, pack_dir_as, None,
+                    prefetch_entry(dir_to_pack))
+                entries = ((path, relpath) for (path, relpath)
+                           in ignore.iter_tree(dir_to_pack, rules, pool)
+                           if os.path.abspath(path) != skip_path)
+                for (path, relpath, entry) in iter_prefetched(
+                        entries, pool, digest):
+                    add(tarball, path, pack_dir_as + '/' + relpath, relpath,
+                        entry)
+                tarball.close()
+            finally:
+                fileobj.close()
+                if pool:
+                    pool.terminate()
+                    pool.join()
+        except:
+            if os.path.exists(target_path):
+                os.unlink(target_path)
+            raise
+
+        trace['bytes'] = packed[0]
+        trace['bytes_out'] = os.path.getsize(target_path)
+        if packed[0]:
+            trace['ratio'] = round(float(trace['bytes_out']) / packed[0], 4)
+
+
+@contextlib.contextmanager
+def replacing(path):
+    """
+    Yield a temporary path to write the new content of path into. It
+    replaces path by a rename once the block finishes without an error,
+    so readers see either the old or the new content.
+    """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        yield tmp_path
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def get_cache_dir():
+    """
+    Return the directory where rpkg keeps its caches,
+    which is $XDG_CACHE_HOME/rpkg or ~/.cache/rpkg.
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'rpkg')
 
 
 def find_source_zero(rpm_sources):
@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 
+import sys
+
 import rpm
 from setuptools import setup, find_packages
 
 spec_file = rpm.ts().parseSpec('rpkg-client.spec')
 
+# asyncio code does not even compile on Python 2
+py3_only_packages = ['rpkglib.aio'] if sys.version_info[0] < 3 else []
+
 setup(
     name=spec_file.sourceHeader.name.decode("utf-8"),
     version=spec_file.sourceHeader.version.decode("utf-8"),
@@ -19,7 +24,7 @@ setup(
         "Programming Language :: Python :: 3",
         "Topic :: Software Development :: Build Tools",
     ],
-    packages=find_packages(),
+    packages=find_packages(exclude=py3_only_packages),
     scripts=['rpkg'],
     include_package_data=True,
 )
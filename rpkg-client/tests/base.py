@@ -9,8 +9,17 @@ from spec_templates import SPEC_TEMPLATE
 class TestCase(unittest.TestCase):
     def setUp(self):
         self.tmpdir = tempfile.mkdtemp()
+        # keep rpkg caches of the tests away from the home directory
+        self.cachedir = tempfile.mkdtemp()
+        self.orig_cache_home = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = self.cachedir
 
     def tearDown(self):
+        if self.orig_cache_home is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = self.orig_cache_home
+        shutil.rmtree(self.cachedir)
         shutil.rmtree(self.tmpdir)
 
     def dump_spec(self, template, pkgname='testpkg', **kwargs):
@@ -0,0 +1,233 @@
+import hashlib
+import os
+import threading
+import time
+import unittest
+
+from six.moves import BaseHTTPServer, socketserver
+
+import base
+import rpkglib
+from pyrpkg.errors import DownloadError
+from rpkglib.exceptions import SourceDownloadException
+from rpkglib.lookaside import LayoutCache
+
+try:
+    import asyncio
+    import aiohttp
+    from rpkglib.aio import lookaside as aiolookaside
+except (ImportError, SyntaxError):
+    aiolookaside = None
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves server.files (url path: content), supports Range"""
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def respond(self, send_body):
+        with self.server.lock:
+            self.server.requests.append((self.command, self.path))
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active,
+                                         self.server.active)
+        try:
+            time.sleep(self.server.delay)
+            self.send_content(send_body)
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    def send_content(self, send_body):
+        content = self.server.files.get(self.path)
+        if content is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        offset = 0
+        range_header = self.headers.get('Range', '')
+        if range_header.startswith('bytes='):
+            offset = int(range_header[len('bytes='):-1])
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                offset, len(content) - 1, len(content)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(content) - offset))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(content[offset:])
+
+
+class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class LookasideTestCase(base.TestCase):
+    """Runs a local lookaside and an async client of it"""
+    def setUp(self):
+        super(LookasideTestCase, self).setUp()
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.files = {}
+        self.server.requests = []
+        self.server.lock = threading.Lock()
+        self.server.active = self.server.max_active = 0
+        self.server.delay = 0
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.url = 'http://127.0.0.1:{}/repo/pkgs'.format(
+            self.server.server_address[1])
+        self.layout_cache = LayoutCache(
+            os.path.join(self.tmpdir, 'layouts.json'))
+        self.loop = asyncio.new_event_loop()
+        self.lookaside = aiolookaside.AsyncCGILookasideCache(
+            'sha512', self.url, self.url + '/upload.cgi',
+            layout_cache=self.layout_cache, per_host=2)
+        self.content = b'content' * 1000
+        self.hash = hashlib.sha512(self.content).hexdigest()
+        self.outfile = os.path.join(self.tmpdir, 'foo.tar.gz')
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.lookaside.close())
+        self.loop.close()
+        self.server.shutdown()
+        self.server.server_close()
+        super(LookasideTestCase, self).tearDown()
+
+    def serve(self, layout, content=None, filename='foo.tar.gz'):
+        path = {
+            'old': '/repo/pkgs/ns/foo/{filename}/{hash}/{filename}',
+            'new': '/repo/pkgs/ns/foo/{filename}/sha512/{hash}/{filename}',
+        }[layout].format(hash=self.hash, filename=filename)
+        self.server.files[path] = content or self.content
+
+
+@unittest.skipIf(aiolookaside is None, 'needs Python 3 and aiohttp')
+class TestAsyncCGILookasideCache(LookasideTestCase):
+    def download(self):
+        self.loop.run_until_complete(self.lookaside.download(
+            'ns/foo', 'foo.tar.gz', self.hash, self.outfile,
+            hashtype='sha512'))
+
+    def test_download_probes_layout(self):
+        self.serve('new')
+        self.download()
+        with open(self.outfile, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertEqual([method for (method, _) in self.server.requests],
+                         ['HEAD', 'HEAD', 'GET'])
+        self.assertEqual(self.layout_cache.get(
+            self.lookaside.layout_key('ns/foo')), 'new')
+
+    def test_download_uses_remembered_layout(self):
+        self.serve('old')
+        self.layout_cache.set(self.lookaside.layout_key('ns/foo'), 'old')
+        self.download()
+        self.assertEqual([method for (method, _) in self.server.requests],
+                         ['GET'])
+
+    def test_stale_remembered_layout_is_probed_again(self):
+        self.serve('old')
+        self.layout_cache.set(self.lookaside.layout_key('ns/foo'), 'new')
+        self.download()
+        self.assertTrue(os.path.exists(self.outfile))
+        self.assertEqual(self.layout_cache.get(
+            self.lookaside.layout_key('ns/foo')), 'old')
+
+    def test_download_resumes_part_file(self):
+        self.serve('new')
+        with open(self.outfile + '.part', 'wb') as f:
+            f.write(self.content[:100])
+        self.download()
+        with open(self.outfile, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertFalse(os.path.exists(self.outfile + '.part'))
+
+    def test_resumed_part_file_of_other_version_is_restarted(self):
+        self.serve('new')
+        with open(self.outfile + '.part', 'wb') as f:
+            f.write(b'old')
+        self.download()
+        with open(self.outfile, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertEqual([method for (method, _) in self.server.requests],
+                         ['HEAD', 'HEAD', 'GET', 'GET'])
+
+    def test_checksum_mismatch(self):
+        self.serve('new', content=b'other content')
+        with self.assertRaises(DownloadError):
+            self.download()
+        self.assertFalse(os.path.exists(self.outfile))
+        self.assertFalse(os.path.exists(self.outfile + '.part'))
+
+    def test_connections_are_capped_per_host(self):
+        filenames = ['file{}'.format(num) for num in range(6)]
+        for filename in filenames:
+            self.serve('new', filename=filename)
+        self.layout_cache.set(self.lookaside.layout_key('ns/foo'), 'new')
+        self.server.delay = 0.1
+
+        self.loop.run_until_complete(asyncio.gather(*[
+            self.loop.create_task(self.lookaside.download(
+                'ns/foo', filename, self.hash,
+                os.path.join(self.tmpdir, filename)))
+            for filename in filenames]))
+        for filename in filenames:
+            self.assertTrue(os.path.exists(os.path.join(self.tmpdir, filename)))
+        self.assertEqual(self.server.max_active, 2)
+
+
+@unittest.skipIf(aiolookaside is None, 'needs Python 3 and aiohttp')
+class TestAsyncSources(LookasideTestCase):
+    def make_cmd(self):
+        cmd = rpkglib.Commands(self.tmpdir, self.url, 'sha512',
+                               self.url + '/upload.cgi',
+                               'ssh://someuser@localhost/%(module)s',
+                               'http://localhost/git/%(module)s',
+                               branchre='.*',
+                               kojiconfig='',
+                               build_client=None)
+        cmd.async_lookaside = True
+        cmd._ns_module_name = 'ns/foo'
+        cmd.cache_dir = self.cachedir
+        return cmd
+
+    def write_sources(self, filenames):
+        with open(os.path.join(self.tmpdir, 'sources'), 'w') as f:
+            for filename in filenames:
+                f.write('SHA512 ({}) = {}\n'.format(filename, self.hash))
+
+    def test_sources(self):
+        filenames = ['file{}'.format(num) for num in range(3)]
+        for filename in filenames:
+            self.serve('old', filename=filename)
+        self.write_sources(filenames)
+
+        self.make_cmd().sources()
+        for filename in filenames:
+            with open(os.path.join(self.tmpdir, filename), 'rb') as f:
+                self.assertEqual(f.read(), self.content)
+
+        # verified files are not requested again
+        del self.server.requests[:]
+        self.make_cmd().sources()
+        self.assertEqual(self.server.requests, [])
+
+    def test_sources_reports_all_failures(self):
+        self.serve('new', filename='file0')
+        self.write_sources(['file0', 'missing1', 'missing2'])
+
+        with self.assertRaises(SourceDownloadException) as context:
+            self.make_cmd().sources()
+        self.assertIn('missing1', str(context.exception))
+        self.assertIn('missing2', str(context.exception))
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'file0')))
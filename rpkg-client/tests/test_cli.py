@@ -4,10 +4,11 @@ import six
 import base
 import os
 import glob
+import json
 import tempfile
 
 from six.moves import configparser
-from rpkglib.cli import rpkgClient
+from rpkglib.cli import rpkgClient, find_command, read_manifest
 from rpkglib.exceptions import NotUnpackedException
 
 from spec_templates import SPEC_TEMPLATE
@@ -35,12 +36,12 @@ class TestCli(base.TestCase):
         config_file.write(RPKG_CONFIG)
         config_file.close()
 
-        config = configparser.SafeConfigParser()
-        config.read(self.config_path)
+        self.config = configparser.SafeConfigParser()
+        self.config.read(self.config_path)
 
-        self.client = rpkgClient(config, name='rpkg')
+        self.client = rpkgClient(self.config, name='rpkg')
         self.client.do_imports('rpkglib')
-        self.client.args = MagicMock(user='user', q='q', path=self.tmpdir)
+        self.client.args = MagicMock(user='user', q='q', path=self.tmpdir, jobs=None)
 
     def tearDown(self):
         os.unlink(self.config_path)
@@ -64,6 +65,78 @@ class TestCli(base.TestCase):
             realms=[],
         )
 
+    def test_find_command(self):
+        self.assertEqual(find_command(['-v', '--path', 'srpm', 'sources']),
+                         'sources')
+        self.assertEqual(find_command(['--path=/tmp', '-q', 'srpm']), 'srpm')
+        self.assertEqual(find_command(['--trace', 'f', 'srpm']), 'srpm')
+        self.assertEqual(find_command(['-C', 'rpkg.conf']), None)
+        self.assertEqual(find_command(['-h', 'srpm']), None)
+
+    def test_registers_requested_command_only(self):
+        client = rpkgClient(self.config, name='rpkg', command='co')
+        self.assertEqual(set(client.subparsers.choices),
+                         set(['help', 'clone', 'co']))
+        client = rpkgClient(self.config, name='rpkg', command='no-such')
+        self.assertIn('is-packed', client.subparsers.choices)
+
+    def test_registers_each_command(self):
+        for command in rpkgClient.COMMANDS:
+            client = rpkgClient(self.config, name='rpkg', command=command)
+            self.assertIn(command, client.subparsers.choices)
+
+    def test_read_manifest(self):
+        manifest_path = os.path.join(self.tmpdir, 'manifest')
+        with open(manifest_path, 'w') as f:
+            f.write('# nightly\npkg1\n\n/abs/pkg2\n')
+        self.assertEqual(read_manifest(manifest_path),
+                         [os.path.join(self.tmpdir, 'pkg1'), '/abs/pkg2'])
+
+    def test_batch_reports_failures(self):
+        def batch_package(cmd):
+            if cmd.path.endswith('bad'):
+                raise Exception('no spec')
+            return cmd.path + '.src.rpm'
+
+        self.client.args = MagicMock(paths=['good', 'bad'], manifest=None,
+                                     workers=2, jobs=None)
+        self.client.log = MagicMock()
+        with mock.patch.object(self.client, 'make_cmd',
+                               side_effect=lambda path: MagicMock(path=path)), \
+                mock.patch.object(self.client, 'batch_package',
+                                  side_effect=batch_package):
+            self.assertEqual(self.client.batch(), 1)
+        lines = [call[0][0] for call in self.client.log.info.call_args_list]
+        self.assertEqual(lines[0].split(), ['PACKAGE', 'RESULT', 'TIME', 'OUTPUT'])
+        self.assertIn('good.src.rpm', lines[1])
+        self.assertIn('FAILED', lines[2])
+        self.assertIn('no spec', lines[2])
+
+    def test_is_packed_json(self):
+        def make_cmd(path):
+            cmd = MagicMock(path=path)
+            if path == 'bad':
+                cmd.packed_status.side_effect = Exception('no spec')
+            else:
+                cmd.packed_status.return_value = {
+                    'packed': False, 'sources': [], 'source0': 'pkg.tar.gz'}
+            return cmd
+
+        self.client.args = MagicMock(paths=['good'], stdin=True, json=True,
+                                     workers=2)
+        self.client.args.spec = None
+        with mock.patch.object(self.client, 'make_batch_cmds',
+                               side_effect=lambda paths: [
+                                   make_cmd(path) for path in paths]), \
+                mock.patch('sys.stdin', six.StringIO('bad\n\n')), \
+                mock.patch('sys.stdout', new_callable=six.StringIO) as out:
+            self.assertEqual(self.client.is_packed(), 1)
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(lines, [
+            {'path': 'good', 'packed': False, 'sources': [],
+             'source0': 'pkg.tar.gz'},
+            {'path': 'bad', 'error': 'no spec'}])
+
     def test_make_source_from_packed_raises(self):
         self.make_packed_content()
         self.client.args.spec = ''
@@ -82,9 +155,16 @@ class TestCli(base.TestCase):
         self.client.args.outdir = self.tmpdir
         self.client.args.spec = ''
         self.client.make_source()
-        self.assertTrue(glob.glob('{}/{}'.format(self.tmpdir, '*.tar.gz')))
-        with self.assertRaises(NotUnpackedException):
-            self.client.make_source()
+        archive_paths = glob.glob('{}/{}'.format(self.tmpdir, '*.tar.gz'))
+        self.assertTrue(archive_paths)
+        self.assertFalse(self.client.cmd.is_unpacked(
+            self.tmpdir, self.get_parsed_spec(
+                os.path.join(self.tmpdir, 'testpkg.spec')).sources))
+
+        # the generated source is reused as long as nothing changes
+        inode = os.stat(archive_paths[0]).st_ino
+        self.client.make_source()
+        self.assertEqual(os.stat(archive_paths[0]).st_ino, inode)
 
     def test_make_srpm_from_packed(self):
         self.make_packed_content()
@@ -1,5 +1,6 @@
 import unittest
 import os
+import hashlib
 import tarfile
 import six
 import git
@@ -7,8 +8,10 @@ import git
 import base
 import rpkglib
 from rpkglib.exceptions import NotUnpackedException, RpmSpecParseException,\
-        NoSourceZeroException
+        NoSourceZeroException, SourceDownloadException, SourceArchiveAlreadyExists,\
+        UnsupportedSrpmException
 from rpkglib.utils import find_source_zero
+from pyrpkg.errors import AlreadyUploadedError, UploadError
 from spec_templates import SPEC_TEMPLATE, SPEC_WITH_PATCH_TEMPLATE,\
         INVALID_SPEC_TEMPLATE, NO_SOURCE_ZERO_SPEC_TEMPLATE
 
@@ -94,16 +97,254 @@ class TestCommands(base.TestCase):
             '{}/{}'.format(self.tmpdir, 'tendrl-gluster-integration-1.5.2.tar.gz'),
             hashtype='md5')
 
+    def write_sources(self, filenames):
+        sources_path = os.path.join(self.tmpdir, 'sources')
+        sources = open(sources_path, 'w')
+        for filename in filenames:
+            sources.write('SHA512 ({}) = {}\n'.format(filename, 'a'*128))
+        sources.close()
+
+        # create repo for ns_module_name determining
+        repo = git.Repo.init(self.tmpdir)
+        repo.create_remote('origin', 'http://copr-dist-git.fedorainfracloud.org/git/testpkg')
+
+    def test_sources_parallel(self):
+        filenames = ['source{}.tar.gz'.format(i) for i in range(5)]
+        self.write_sources(filenames)
+
+        self.cmd.download_jobs = 3
+        self.cmd.lookasidecache.download = MagicMock()
+        self.cmd.sources()
+        self.assertEqual(self.cmd.lookasidecache.download.call_count, 5)
+        for filename in filenames:
+            self.cmd.lookasidecache.download.assert_any_call(
+                'testpkg', filename, 'a'*128,
+                '{}/{}'.format(self.tmpdir, filename),
+                hashtype='sha512')
+
+    def test_sources_async_lookaside_unavailable(self):
+        self.write_sources(['source0.tar.gz'])
+        self.cmd.async_lookaside = True
+        self.cmd.lookasidecache.download = MagicMock()
+        with mock.patch('rpkglib.lookaside.load_async_lookaside',
+                        return_value=None):
+            self.cmd.sources()
+        self.assertEqual(self.cmd.lookasidecache.download.call_count, 1)
+
+    def test_sources_parallel_reports_failures(self):
+        filenames = ['source{}.tar.gz'.format(i) for i in range(4)]
+        self.write_sources(filenames)
+
+        def download(name, filename, hash, outfile, hashtype=None):
+            if filename == 'source1.tar.gz':
+                raise Exception('checksum mismatch')
+
+        self.cmd.download_jobs = 2
+        self.cmd.lookasidecache.download = MagicMock(side_effect=download)
+        with self.assertRaises(SourceDownloadException) as ctx:
+            self.cmd.sources()
+        self.assertIn('source1.tar.gz', str(ctx.exception))
+        self.assertNotIn('source2.tar.gz', str(ctx.exception))
+        self.assertEqual(self.cmd.lookasidecache.download.call_count, 4)
+
+    def test_sources_uses_source_store(self):
+        self.write_sources(['source0.tar.gz'])
+        self.cmd.source_store_enabled = True
+
+        stored_path = self.touch_file('stored.tar.gz')
+        self.cmd.source_store.add('sha512', 'a'*128, stored_path,
+                                  self.cmd.verified_index)
+
+        self.cmd.lookasidecache.download = MagicMock()
+        self.cmd.sources()
+        self.cmd.lookasidecache.download.assert_not_called()
+        self.assertTrue(os.path.exists(
+            os.path.join(self.tmpdir, 'source0.tar.gz')))
+
+    def test_sources_skips_verified_files(self):
+        self.write_sources(['source0.tar.gz'])
+        outfile = self.touch_file('source0.tar.gz')
+        self.cmd.verified_index.record(outfile, 'sha512', 'a'*128)
+
+        self.cmd.lookasidecache.download = MagicMock()
+        self.cmd.lookasidecache.hash_file = MagicMock()
+        self.cmd.sources()
+        self.cmd.lookasidecache.download.assert_not_called()
+        self.cmd.lookasidecache.hash_file.assert_not_called()
+
+    def test_sources_rechecks_changed_files(self):
+        self.write_sources(['source0.tar.gz'])
+        outfile = self.touch_file('source0.tar.gz')
+        self.cmd.verified_index.record(outfile, 'sha512', 'a'*128)
+        with open(outfile, 'w') as f:
+            f.write('changed')
+
+        self.cmd.lookasidecache.download = MagicMock()
+        self.cmd.sources()
+        self.assertEqual(self.cmd.lookasidecache.download.call_count, 1)
+
+    def prepare_upload(self, filenames):
+        repo = git.Repo.init(self.tmpdir)
+        repo.create_remote('origin', 'http://copr-dist-git.fedorainfracloud.org/git/testpkg')
+        paths = []
+        for filename in filenames:
+            path = os.path.join(self.tmpdir, filename)
+            with open(path, 'w') as f:
+                f.write(filename)
+            paths.append(path)
+        self.cmd.lookasidehash = 'sha512'
+        self.cmd.lookasidecache.send_file = MagicMock()
+        return paths
+
+    def read_file(self, filename):
+        with open(os.path.join(self.tmpdir, filename)) as f:
+            return f.read()
+
+    def test_upload_sends_missing_files_only(self):
+        paths = self.prepare_upload(['a.tar.gz', 'b.tar.gz', 'c.tar.gz'])
+        self.cmd.lookasidecache.remote_file_exists = MagicMock(
+            side_effect=lambda name, filename, hash: filename == 'b.tar.gz')
+
+        self.cmd.upload(paths)
+        self.assertEqual(self.cmd.lookasidecache.remote_file_exists.call_count, 3)
+        sent = sorted(call[0][1] for call in
+                      self.cmd.lookasidecache.send_file.call_args_list)
+        self.assertEqual(sent, [paths[0], paths[2]])
+
+        sources = self.read_file('sources')
+        for path in paths:
+            filename = os.path.basename(path)
+            self.assertIn('SHA512 ({}) = {}'.format(
+                filename, hashlib.sha512(filename.encode('ascii')).hexdigest()),
+                sources)
+            self.assertIn('/' + filename, self.read_file('.gitignore'))
+        self.assertTrue(self.cmd.verified_index.is_verified(
+            paths[0], 'sha512',
+            hashlib.sha512(b'a.tar.gz').hexdigest()))
+
+    def test_upload_all_available(self):
+        paths = self.prepare_upload(['a.tar.gz'])
+        self.cmd.lookasidecache.remote_file_exists = MagicMock(
+            return_value=True)
+        with self.assertRaises(AlreadyUploadedError):
+            self.cmd.upload(paths)
+        self.cmd.lookasidecache.send_file.assert_not_called()
+        self.assertIn('a.tar.gz', self.read_file('sources'))
+
+    def test_upload_failure_keeps_sources(self):
+        paths = self.prepare_upload(['a.tar.gz', 'b.tar.gz'])
+        old_sources = 'SHA512 (old.tar.gz) = {}\n'.format('a'*128)
+        with open(os.path.join(self.tmpdir, 'sources'), 'w') as f:
+            f.write(old_sources)
+        self.cmd.lookasidecache.remote_file_exists = MagicMock(
+            return_value=False)
+        self.cmd.lookasidecache.send_file.side_effect = \
+            lambda name, path, hash, progress: \
+            progress(1) if path.endswith('a.tar.gz') else 1/0
+
+        with self.assertRaises(UploadError) as context:
+            self.cmd.upload(paths)
+        self.assertIn('b.tar.gz', str(context.exception))
+        self.assertNotIn('a.tar.gz', str(context.exception))
+        self.assertEqual(self.read_file('sources'), old_sources)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, '.gitignore')))
+
     def test_srpm(self):
         spec_path = self.dump_spec(SPEC_TEMPLATE, source0='source0.tar.gz')
         self.touch_file('source0.tar.gz')
         self.cmd._run_command = MagicMock()
         self.cmd.srpm()
-        cmd_templated = ['rpmbuild', "--define '_sourcedir {path}'", "--define '_specdir {path}'",
-                         "--define '_builddir {path}'", "--define '_srcrpmdir {path}'",
-                         "--define '_rpmdir {path}'", '--nodeps', '-bs', '{path}/testpkg.spec']
+        cmd_templated = ['rpmbuild', '--define', '_sourcedir {path}', '--define', '_specdir {path}',
+                         '--define', '_builddir {path}', '--define', '_srcrpmdir {path}',
+                         '--define', '_rpmdir {path}', '--nodeps', '-bs', '{path}/testpkg.spec']
         cmd = [part.format(path=self.tmpdir) for part in cmd_templated]
-        self.cmd._run_command.assert_called_with(cmd, shell=True)
+        self.cmd._run_command.assert_called_with(cmd)
+
+    def test_srpm_reuse(self):
+        self.dump_spec(SPEC_TEMPLATE, source0='source0.tar.gz')
+        source_path = self.touch_file('source0.tar.gz')
+        self.cmd.reuse_srpm = True
+        self.cmd.cache_dir = self.cachedir
+
+        def rpmbuild(cmd):
+            srpm_path = os.path.join(self.tmpdir, 'testpkg-{}-{}.src.rpm'.format(
+                self.cmd.ver, self.cmd.rel))
+            with open(srpm_path, 'w') as f:
+                f.write('srpm')
+        self.cmd._run_command = MagicMock(side_effect=rpmbuild)
+
+        self.cmd.srpm()
+        self.cmd.srpm()
+        self.assertEqual(self.cmd._run_command.call_count, 1)
+
+        # a changed source builds the srpm again
+        with open(source_path, 'w') as f:
+            f.write('changed')
+        self.cmd.srpm()
+        self.assertEqual(self.cmd._run_command.call_count, 2)
+
+        # so does different rpmbuild arguments
+        self.cmd.srpm(outdir=self.tmpdir)
+        self.assertEqual(self.cmd._run_command.call_count, 3)
+
+        # and switching to the native writer
+        self.cmd.native_srpm = True
+        self.cmd.write_srpm = MagicMock(
+            side_effect=lambda srpm_path: rpmbuild(None))
+        self.cmd.srpm(outdir=self.tmpdir)
+        self.assertEqual(self.cmd.write_srpm.call_count, 1)
+        self.cmd.srpm(outdir=self.tmpdir)
+        self.assertEqual(self.cmd.write_srpm.call_count, 1)
+
+    def test_srpm_native(self):
+        self.dump_spec(SPEC_TEMPLATE, source0='source0.tar.gz')
+        self.touch_file('source0.tar.gz')
+        self.cmd.native_srpm = True
+        self.cmd._run_command = MagicMock()
+        self.cmd.write_srpm = MagicMock()
+        self.cmd.srpm()
+        self.cmd.write_srpm.assert_called_with(os.path.join(
+            self.tmpdir, 'testpkg-1-1.src.rpm'))
+        self.assertFalse(self.cmd._run_command.called)
+
+        # rpmbuild builds what the native writer does not support
+        self.cmd.write_srpm.side_effect = UnsupportedSrpmException('NoSource')
+        self.cmd.srpm()
+        self.assertTrue(self.cmd._run_command.called)
+
+    def test_is_unpacked_is_cached(self):
+        self.touch_file('main.c')
+        os.utime(self.tmpdir, (1000, 1000))
+        self.cmd.cache_dir = self.cachedir
+        sources = [('source0.tar.gz', 0, 1)]
+        with mock.patch('rpkglib.ignore.scan_package_dir',
+                        wraps=rpkglib.ignore.scan_package_dir) as scan:
+            self.assertTrue(self.cmd.is_unpacked(self.tmpdir, sources))
+            self.assertTrue(self.cmd.is_unpacked(self.tmpdir, sources))
+            self.assertEqual(scan.call_count, 1)
+
+            self.touch_file('source0.tar.gz')
+            os.utime(self.tmpdir, (2000, 2000))
+            self.assertFalse(self.cmd.is_unpacked(self.tmpdir, sources))
+            self.assertEqual(scan.call_count, 2)
+
+    def test_packed_status(self):
+        self.touch_file('source0.tar.gz')
+        self.touch_file('fix.patch')
+        sources = [('http://example.com/source0.tar.gz', 0, 1),
+                   ('fix.patch', 0, 2), ('other.patch', 1, 2)]
+        os.utime(self.tmpdir, (1000, 1000))
+        self.cmd.cache_dir = self.cachedir
+        with mock.patch.object(self.cmd, 'spec_info', return_value=MagicMock(
+                sources=sources, source_zero='source0.tar.gz')), \
+                mock.patch('rpkglib.ignore.scan_package_dir',
+                           wraps=rpkglib.ignore.scan_package_dir) as scan:
+            for _ in range(2):
+                self.assertEqual(self.cmd.packed_status(), {
+                    'packed': True,
+                    'sources': ['fix.patch', 'source0.tar.gz'],
+                    'source0': 'source0.tar.gz'})
+            self.assertEqual(scan.call_count, 1)
 
     def test_is_unpacked_source_is_present(self):
         spec_path = self.dump_spec(SPEC_TEMPLATE, source0='source0.tar.gz')
@@ -152,6 +393,21 @@ class TestCommands(base.TestCase):
         is_unpacked = self.cmd.is_unpacked(self.tmpdir, parsed_spec.sources)
         self.assertFalse(is_unpacked)
 
+    def test_load_nameverrel(self):
+        self.dump_spec(SPEC_TEMPLATE, source0='source0.tar.gz')
+        self.cmd.load_nameverrel()
+        self.assertEqual((self.cmd._epoch, self.cmd._ver, self.cmd._rel),
+                         ('0', '1', '1'))
+
+    def test_spec_is_parsed_once(self):
+        self.dump_spec(SPEC_TEMPLATE, source0='source0.tar.gz')
+        self.touch_file('patch.txt')
+        with mock.patch('rpkglib.spec.parse_spec',
+                        wraps=rpkglib.spec.parse_spec) as parse_spec:
+            self.cmd.load_nameverrel()
+            self.cmd.make_source(self.tmpdir)
+        self.assertEqual(parse_spec.call_count, 1)
+
     def test_make_source_raises_on_packed(self):
         self.dump_spec(SPEC_TEMPLATE, source0='source0.tar.gz')
         with self.assertRaises(NotUnpackedException):
@@ -177,6 +433,90 @@ class TestCommands(base.TestCase):
         tarball = tarfile.open(archive_path, 'r:gz')
         self.assertEquals(expected_names, sorted(tarball.getnames()))
 
+    def test_make_source_is_reproducible(self):
+        self.dump_spec(SPEC_TEMPLATE, source0='source0.tar.gz')
+        self.touch_file('patch.txt', subdir='dir')
+        self.cmd.deterministic_sources = True
+        outdir = os.path.join(self.tmpdir, 'out')
+        os.mkdir(outdir)
+
+        archive_path = self.cmd.make_source(outdir)
+        with open(archive_path, 'rb') as f:
+            first = f.read()
+        os.unlink(archive_path)
+        os.utime(os.path.join(self.tmpdir, 'dir', 'patch.txt'), (1, 1))
+
+        archive_path = self.cmd.make_source(outdir)
+        with open(archive_path, 'rb') as f:
+            self.assertEqual(first, f.read())
+        tarball = tarfile.open(archive_path, 'r:gz')
+        self.assertEqual(set(m.mtime for m in tarball.getmembers()), set([0]))
+
+    def test_make_source_regenerates_changed_content(self):
+        self.dump_spec(SPEC_TEMPLATE, source0='source0.tar.gz')
+        patch_path = self.touch_file('patch.txt')
+        outdir = os.path.join(self.tmpdir, 'out')
+        os.mkdir(outdir)
+
+        archive_path = self.cmd.make_source(outdir)
+        inode = os.stat(archive_path).st_ino
+        self.assertEqual(self.cmd.make_source(outdir), archive_path)
+        self.assertEqual(os.stat(archive_path).st_ino, inode)
+
+        with open(patch_path, 'w') as f:
+            f.write('changed')
+        self.cmd.make_source(outdir)
+        tarball = tarfile.open(archive_path, 'r:gz')
+        self.assertEqual(
+            tarball.extractfile('testpkg-1/patch.txt').read(), b'changed')
+
+    def test_make_source_records_archive_digest(self):
+        self.dump_spec(SPEC_TEMPLATE, source0='source0.tar.gz')
+        self.touch_file('patch.txt')
+        outdir = os.path.join(self.tmpdir, 'out')
+        os.mkdir(outdir)
+        self.cmd.cache_dir = self.cachedir
+
+        archive_path = self.cmd.make_source(outdir)
+        with open(archive_path, 'rb') as f:
+            digest = hashlib.new(self.cmd.hashtype, f.read()).hexdigest()
+        self.assertTrue(self.cmd.verified_index.is_verified(
+            archive_path, self.cmd.hashtype, digest))
+
+        self.cmd.remove_source(archive_path)
+        self.assertFalse(os.path.exists(archive_path))
+        self.assertFalse(os.path.exists(
+            self.cmd.source_manifest(archive_path).path))
+
+    def test_srpm_twice_reuses_source(self):
+        self.dump_spec(SPEC_TEMPLATE, source0='source0.tar.gz')
+        self.touch_file('patch.txt')
+        self.cmd.cache_dir = self.cachedir
+
+        def rpmbuild(cmd):
+            srpm_path = os.path.join(self.tmpdir, 'testpkg-1-1.src.rpm')
+            with open(srpm_path, 'w') as f:
+                f.write('srpm')
+        self.cmd._run_command = MagicMock(side_effect=rpmbuild)
+
+        archive_path = self.cmd.make_source()
+        inode = os.stat(archive_path).st_ino
+        self.cmd.srpm()
+        self.assertEqual(self.cmd.make_source(), archive_path)
+        self.assertEqual(os.stat(archive_path).st_ino, inode)
+        tarball = tarfile.open(archive_path, 'r:gz')
+        self.assertEqual(sorted(tarball.getnames()), [
+            'testpkg-1', 'testpkg-1/patch.txt', 'testpkg-1/testpkg.spec'])
+
+    def test_make_source_keeps_foreign_archive(self):
+        self.dump_spec(SPEC_TEMPLATE, source0='source0.tar.gz')
+        self.touch_file('patch.txt')
+        outdir = os.path.join(self.tmpdir, 'out')
+        os.mkdir(outdir)
+        open(os.path.join(outdir, 'source0.tar.gz'), 'w').close()
+        with self.assertRaises(SourceArchiveAlreadyExists):
+            self.cmd.make_source(outdir)
+
     def test_make_source_raises_on_invalid_spec(self):
         self.dump_spec(INVALID_SPEC_TEMPLATE)
         with self.assertRaises(RpmSpecParseException):
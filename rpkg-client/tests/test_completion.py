@@ -0,0 +1,61 @@
+import argparse
+import os
+import subprocess
+
+import base
+from rpkglib.completion import checkout_branches, completion_lines, \
+    write_completion_cache
+
+
+class TestCompletion(base.TestCase):
+    def setUp(self):
+        super(TestCompletion, self).setUp()
+        self.parser = argparse.ArgumentParser()
+        self.parser.add_argument('--path')
+        self.parser.add_argument('-q', action='store_true')
+        self.parser.add_argument('--hidden', help=argparse.SUPPRESS)
+        subparsers = self.parser.add_subparsers()
+        srpm_parser = subparsers.add_parser('srpm')
+        srpm_parser.add_argument('--outdir')
+        srpm_parser.add_argument('--hash', choices=['md5', 'sha256'])
+        subparsers.add_parser('is-packed')
+
+    def test_parser_tree(self):
+        lines = completion_lines(self.parser, stamp=42)
+        self.assertIn("_rpkg_completion_stamp='42'", lines)
+        self.assertIn("_rpkg_opts='-h --help -q'", lines)
+        self.assertIn("_rpkg_optv='--path'", lines)
+        self.assertIn("_rpkg_commands='is-packed srpm'", lines)
+        self.assertIn("_rpkg_optv_srpm='--outdir --hash'", lines)
+        self.assertIn("_rpkg_choices_srpm__hash='md5 sha256'", lines)
+        self.assertIn("_rpkg_opts_is_packed='-h --help'", lines)
+
+    def test_checkout_data(self):
+        self.touch_file('testpkg.spec')
+        lines = completion_lines(self.parser, path=self.tmpdir)
+        self.assertIn("_rpkg_specs='testpkg.spec'", lines)
+        self.assertIn("_rpkg_branches=''", lines)
+
+    def test_checkout_branches_keep_slashes(self):
+        def git(*args):
+            subprocess.check_call(
+                ['git', '-c', 'user.name=test', '-c', 'user.email=test@test']
+                + list(args), cwd=self.tmpdir)
+        git('init', '-q')
+        git('commit', '-q', '--allow-empty', '-m', 'init')
+        git('branch', 'feature/foo')
+        git('update-ref', 'refs/remotes/origin/feature/bar', 'HEAD')
+        git('symbolic-ref', 'refs/remotes/origin/HEAD',
+            'refs/remotes/origin/feature/bar')
+        branches = checkout_branches(self.tmpdir)
+        self.assertIn('feature/foo', branches)
+        self.assertIn('feature/bar', branches)
+        self.assertNotIn('foo', branches)
+        self.assertNotIn('HEAD', branches)
+
+    def test_cache_is_sourceable(self):
+        cache_path = os.path.join(self.tmpdir, 'cache', 'completion')
+        write_completion_cache(self.parser, cache_path)
+        output = subprocess.check_output(
+            ['bash', '-c', '. "$0" && echo "$_rpkg_optv_srpm"', cache_path])
+        self.assertEqual(output.decode('utf-8').strip(), '--outdir --hash')
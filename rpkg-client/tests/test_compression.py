@@ -0,0 +1,155 @@
+import errno
+import gzip
+import hashlib
+import os
+import tarfile
+import six
+import unittest
+
+import base
+from rpkglib import compression, utils
+from rpkglib.exceptions import CompressionException, \
+    UnsupportedCompressionException
+from rpkglib.utils import pack_sources
+
+
+class TestCompression(base.TestCase):
+    def test_compressor_for(self):
+        self.assertEqual(compression.compressor_for('a.tar.gz'), 'gzip')
+        self.assertEqual(compression.compressor_for('a.tgz'), 'gzip')
+        self.assertEqual(compression.compressor_for('a.tar.xz'), 'xz')
+        self.assertEqual(compression.compressor_for('a.tar.zst'), 'zstd')
+        self.assertEqual(compression.compressor_for('a.tar.bz2'), 'bzip2')
+        self.assertEqual(compression.compressor_for('a.zip'), 'gzip')
+        self.assertEqual(compression.compressor_for('a.tar.gz', 'pgzip'), 'pgzip')
+        self.assertEqual(compression.compressor_for('a.tar.xz', 'auto'), 'xz')
+        with self.assertRaises(UnsupportedCompressionException):
+            compression.compressor_for('a.tar.gz', 'rar')
+
+    def test_parallel_gzip_is_valid_gzip(self):
+        data = os.urandom(1024) * (3 * compression.BLOCK_SIZE // 1024 + 7)
+        target_path = os.path.join(self.tmpdir, 'data.gz')
+        writer = compression.open_compressed(target_path, 'pgzip', threads=3)
+        for i in range(0, len(data), 10000):
+            writer.write(data[i:i+10000])
+        writer.close()
+
+        with gzip.open(target_path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_parallel_gzip_empty_input(self):
+        target_path = os.path.join(self.tmpdir, 'empty.gz')
+        compression.open_compressed(target_path, 'pgzip').close()
+        with gzip.open(target_path, 'rb') as f:
+            self.assertEqual(f.read(), b'')
+
+    def test_checksum_of_written_data(self):
+        for compressor in ('gzip', 'pgzip', 'bzip2'):
+            target_path = os.path.join(self.tmpdir, 'data.' + compressor)
+            checksum = hashlib.sha256()
+            writer = compression.open_compressed(target_path, compressor,
+                                                 checksum=checksum)
+            writer.write(b'data' * 100000)
+            writer.close()
+            with open(target_path, 'rb') as f:
+                self.assertEqual(checksum.hexdigest(),
+                                 hashlib.sha256(f.read()).hexdigest())
+
+    def test_external_writer_target_error(self):
+        class FullFile(object):
+            def write(self, data):
+                raise IOError(errno.ENOSPC, 'No space left on device')
+
+            def close(self):
+                pass
+
+        writer = compression.ExternalWriter(
+            compression.ChecksumFile(FullFile(), hashlib.sha256()), ['cat'])
+        with self.assertRaises(IOError) as context:
+            for _ in range(64):
+                writer.write(b'x' * 1024*1024)
+            writer.close()
+        self.assertEqual(context.exception.errno, errno.ENOSPC)
+        self.assertIsNotNone(writer.proc.wait())
+
+    def test_external_writer_failure(self):
+        target_path = os.path.join(self.tmpdir, 'data.xz')
+        writer = compression.ExternalWriter(
+            compression.ChecksumFile(open(target_path, 'wb')),
+            ['sh', '-c', 'cat >/dev/null; exit 3'])
+        writer.write(b'data')
+        with self.assertRaises(CompressionException) as context:
+            writer.close()
+        self.assertIn('exit code 3', str(context.exception))
+
+    def pack(self, source0, compressor=None):
+        self.touch_file('foo.py', subdir='content')
+        target_path = os.path.join(self.tmpdir, source0)
+        pack_sources(os.path.join(self.tmpdir, 'content'), target_path,
+                     'testpkg-1', compressor=compressor)
+        return target_path
+
+    def test_pack_sources_pgzip(self):
+        target_path = self.pack('source0.tar.gz', compressor='pgzip')
+        tarball = tarfile.open(target_path, 'r:gz')
+        self.assertEqual(sorted(tarball.getnames()),
+                         ['testpkg-1', 'testpkg-1/foo.py'])
+
+    def test_pack_sources_bzip2(self):
+        target_path = self.pack('source0.tar.bz2')
+        tarball = tarfile.open(target_path, 'r:bz2')
+        self.assertEqual(sorted(tarball.getnames()),
+                         ['testpkg-1', 'testpkg-1/foo.py'])
+
+    @unittest.skipUnless(six.PY3, 'tarfile reads xz only on python 3')
+    def test_pack_sources_xz(self):
+        target_path = self.pack('source0.tar.xz')
+        tarball = tarfile.open(target_path, 'r:xz')
+        self.assertEqual(sorted(tarball.getnames()),
+                         ['testpkg-1', 'testpkg-1/foo.py'])
+
+    def make_tree(self):
+        content = os.path.join(self.tmpdir, 'content')
+        for dirnum in range(5):
+            dirpath = os.path.join(content, 'dir{}'.format(dirnum), 'sub')
+            os.makedirs(dirpath)
+            for filenum in range(20):
+                with open(os.path.join(dirpath, 'file{}.c'.format(filenum)),
+                          'w') as f:
+                    f.write('int f{}_{};\n'.format(dirnum, filenum))
+        with open(os.path.join(content, 'big.bin'), 'wb') as f:
+            f.write(os.urandom(utils.PREFETCH_MAX_SIZE + 1000))
+        os.symlink('big.bin', os.path.join(content, 'link'))
+        os.link(os.path.join(content, 'big.bin'),
+                os.path.join(content, 'hardlink'))
+        return content
+
+    def test_pack_sources_threads_give_same_archive(self):
+        content = self.make_tree()
+        archives = []
+        for io_threads in (1, 4):
+            outdir = os.path.join(self.tmpdir, 'out{}'.format(io_threads))
+            os.mkdir(outdir)
+            target_path = os.path.join(outdir, 'source0.tar.gz')
+            manifest_files = {}
+            pack_sources(content, target_path, 'testpkg-1',
+                         deterministic=True, manifest_files=manifest_files,
+                         io_threads=io_threads)
+            with open(target_path, 'rb') as f:
+                archives.append((f.read(), manifest_files))
+        self.assertEqual(archives[0], archives[1])
+
+    def test_pack_sources_links_and_big_files(self):
+        content = self.make_tree()
+        target_path = os.path.join(self.tmpdir, 'source0.tar.gz')
+        pack_sources(content, target_path, 'testpkg-1', io_threads=4)
+
+        tarball = tarfile.open(target_path, 'r:gz')
+        big = tarball.getmember('testpkg-1/big.bin')
+        with open(os.path.join(content, 'big.bin'), 'rb') as f:
+            self.assertEqual(tarball.extractfile(big).read(), f.read())
+        self.assertTrue(tarball.getmember('testpkg-1/link').issym())
+        self.assertEqual(tarball.getmember('testpkg-1/link').linkname,
+                         'big.bin')
+        self.assertTrue(tarball.getmember('testpkg-1/hardlink').islnk())
+        self.assertEqual(len(tarball.getnames()), 1 + 5*2 + 5*20 + 3)
@@ -0,0 +1,105 @@
+import os
+import six
+import tarfile
+
+from multiprocessing.pool import ThreadPool
+
+import base
+from rpkglib import ignore
+from rpkglib.ignore import ExcludeRules, iter_tree, is_ignored_file
+from rpkglib.utils import pack_sources
+
+if six.PY3:
+    from unittest import mock
+else:
+    import mock
+
+
+class TestExcludeRules(base.TestCase):
+    def test_name_matches_at_any_depth(self):
+        rules = ExcludeRules(['*.o', '.git'])
+        self.assertTrue(rules.is_excluded('main.o'))
+        self.assertTrue(rules.is_excluded('src/main.o'))
+        self.assertTrue(rules.is_excluded('sub/.git', is_dir=True))
+        self.assertFalse(rules.is_excluded('main.c'))
+        self.assertFalse(rules.is_excluded('agit'))
+
+    def test_anchored_and_directory_rules(self):
+        rules = ExcludeRules(['/build', 'cache/', 'doc/*.html', 'a/**/z'])
+        self.assertTrue(rules.is_excluded('build', is_dir=True))
+        self.assertFalse(rules.is_excluded('src/build', is_dir=True))
+        self.assertTrue(rules.is_excluded('src/cache', is_dir=True))
+        self.assertFalse(rules.is_excluded('src/cache', is_dir=False))
+        self.assertTrue(rules.is_excluded('doc/index.html'))
+        self.assertFalse(rules.is_excluded('doc/api/index.html'))
+        self.assertTrue(rules.is_excluded('a/z'))
+        self.assertTrue(rules.is_excluded('a/b/c/z'))
+
+    def test_negation_and_comments(self):
+        rules = ExcludeRules(['# comment', '', '*.log', '!keep.log'])
+        self.assertTrue(rules.is_excluded('build.log'))
+        self.assertFalse(rules.is_excluded('keep.log'))
+        self.assertFalse(rules.is_excluded('# comment'))
+
+    def test_scan_package_dir(self):
+        self.touch_file('testpkg.spec')
+        self.touch_file('README')
+        self.assertEqual(ignore.scan_package_dir(self.tmpdir, set()),
+                         (False, []))
+        os.mkdir(os.path.join(self.tmpdir, 'source0.tar.gz'))
+        self.assertEqual(ignore.scan_package_dir(
+            self.tmpdir, set(['source0.tar.gz'])), (True, []))
+        self.touch_file('b.patch')
+        self.touch_file('a.patch')
+        self.assertEqual(ignore.scan_package_dir(
+            self.tmpdir, set(['source0.tar.gz', 'a.patch', 'b.patch',
+                              'c.patch'])),
+            (False, ['a.patch', 'b.patch']))
+
+    def test_is_ignored_file(self):
+        for filename in ['README', 'readme.md', 'x.spec', '.hidden',
+                         'tito.props', 'sources']:
+            self.assertTrue(is_ignored_file(filename))
+        self.assertFalse(is_ignored_file('main.c'))
+
+
+class TestIterTree(base.TestCase):
+    def test_prunes_excluded_directories(self):
+        self.touch_file('b.c', subdir='src')
+        self.touch_file('a.c', subdir='src/sub')
+        self.touch_file('config', subdir='.git')
+        self.touch_file('.gitignore')
+
+        with mock.patch('rpkglib.ignore._list_dir',
+                        wraps=ignore._list_dir) as list_dir:
+            relpaths = [relpath for (path, relpath) in iter_tree(
+                self.tmpdir, ExcludeRules(['.git', '.gitignore']))]
+
+        self.assertEqual(relpaths, ['src', 'src/b.c', 'src/sub', 'src/sub/a.c'])
+        listed = [call[0][0] for call in list_dir.call_args_list]
+        self.assertNotIn(os.path.join(self.tmpdir, '.git'), listed)
+
+    def test_pack_sources_honours_rpkgignore(self):
+        content = os.path.join(self.tmpdir, 'content')
+        os.makedirs(os.path.join(content, 'build'))
+        os.makedirs(os.path.join(content, '.git'))
+        for filename in ['main.c', 'main.o', 'build/out', '.git/HEAD']:
+            open(os.path.join(content, filename), 'w').close()
+        with open(os.path.join(content, '.rpkgignore'), 'w') as f:
+            f.write('*.o\nbuild/\n')
+
+        target_path = os.path.join(self.tmpdir, 'source0.tar.gz')
+        pack_sources(content, target_path, 'testpkg-1')
+        tarball = tarfile.open(target_path, 'r:gz')
+        self.assertEqual(tarball.getnames(), ['testpkg-1', 'testpkg-1/main.c'])
+
+    def test_pool_keeps_order(self):
+        for subdir in ['a/x', 'a/y', 'b', 'c/z/w']:
+            self.touch_file('f', subdir=subdir)
+        rules = ExcludeRules([])
+        pool = ThreadPool(3)
+        try:
+            self.assertEqual(list(iter_tree(self.tmpdir, rules, pool)),
+                             list(iter_tree(self.tmpdir, rules)))
+        finally:
+            pool.terminate()
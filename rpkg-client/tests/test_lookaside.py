@@ -0,0 +1,218 @@
+import hashlib
+import os
+import six
+
+import base
+from pyrpkg.errors import DownloadError, UploadError
+from rpkglib.lookaside import CGILookasideCache, LayoutCache, \
+    MultipartStream
+
+if six.PY3:
+    from unittest import mock
+    from unittest.mock import MagicMock
+else:
+    import mock
+    from mock import MagicMock
+
+
+class TestLayoutCache(base.TestCase):
+    def test_persists_layouts(self):
+        cache_path = os.path.join(self.tmpdir, 'layouts.json')
+        LayoutCache(cache_path).set('key', 'new')
+        self.assertEqual(LayoutCache(cache_path).get('key'), 'new')
+
+    def test_expired_layout_is_ignored(self):
+        cache = LayoutCache(os.path.join(self.tmpdir, 'layouts.json'), ttl=0)
+        cache.set('key', 'old')
+        self.assertEqual(cache.get('key'), None)
+
+    def test_invalidate(self):
+        cache_path = os.path.join(self.tmpdir, 'layouts.json')
+        LayoutCache(cache_path).set('key', 'new')
+        LayoutCache(cache_path).invalidate('key')
+        self.assertEqual(LayoutCache(cache_path).get('key'), None)
+
+
+class TestCGILookasideCache(base.TestCase):
+    def setUp(self):
+        super(TestCGILookasideCache, self).setUp()
+        self.layout_cache = LayoutCache(
+            os.path.join(self.tmpdir, 'layouts.json'))
+        self.lookaside = CGILookasideCache(
+            'sha512', 'http://localhost/repo/pkgs',
+            'https://localhost/repo/pkgs/upload.cgi',
+            layout_cache=self.layout_cache)
+        self.lookaside.session = MagicMock()
+        self.content = b'content'
+        self.hash = hashlib.sha512(self.content).hexdigest()
+        self.outfile = os.path.join(self.tmpdir, 'foo.tar.gz')
+
+    def serve(self, layout):
+        """Make the mocked session serve files with the given layout"""
+        def status(url):
+            return 200 if ('/sha512/' in url) == (layout == 'new') else 404
+
+        def head(url):
+            return MagicMock(status_code=status(url))
+
+        def get(url, **kwargs):
+            response = MagicMock(status_code=status(url), headers={})
+            response.__enter__.return_value = response
+            response.iter_content.return_value = [self.content]
+            return response
+
+        self.lookaside.session.head.side_effect = head
+        self.lookaside.session.get.side_effect = get
+
+    def download(self, name, filename):
+        self.lookaside.download(name, filename, self.hash,
+                                os.path.join(self.tmpdir, filename),
+                                hashtype='sha512')
+
+    def test_session_carries_certificates(self):
+        lookaside = CGILookasideCache(
+            'sha512', 'http://localhost/repo/pkgs',
+            'https://localhost/repo/pkgs/upload.cgi',
+            client_cert='/client.cert', ca_cert='/ca.cert', pool_size=3)
+        self.assertEqual(lookaside.session.cert, '/client.cert')
+        self.assertEqual(lookaside.session.verify, '/ca.cert')
+
+    def test_download_probes_only_once(self):
+        self.serve('new')
+        self.download('ns/pkg', 'foo.tar.gz')
+        self.assertEqual(self.lookaside.session.head.call_count, 2)
+        self.assertEqual(self.layout_cache.get(
+            self.lookaside.layout_key('ns/pkg')), 'new')
+
+        self.download('ns/other', 'bar.tar.gz')
+        self.assertEqual(self.lookaside.session.head.call_count, 2)
+        self.assertEqual(self.lookaside.session.get.call_count, 2)
+        with open(os.path.join(self.tmpdir, 'bar.tar.gz'), 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_download_reprobes_on_not_found(self):
+        self.serve('old')
+        self.layout_cache.set(self.lookaside.layout_key('ns/pkg'), 'new')
+
+        self.download('ns/pkg', 'foo.tar.gz')
+        self.assertEqual(self.lookaside.session.head.call_count, 1)
+        self.assertEqual(self.layout_cache.get(
+            self.lookaside.layout_key('ns/pkg')), 'old')
+
+    def test_download_checksum_mismatch(self):
+        self.serve('new')
+        self.content = b'corrupted'
+        with self.assertRaises(DownloadError):
+            self.download('ns/pkg', 'foo.tar.gz')
+
+    def test_download_resumes_partial_file(self):
+        self.serve('new')
+        self.layout_cache.set(self.lookaside.layout_key('ns/pkg'), 'new')
+        with open(self.outfile + '.part', 'wb') as f:
+            f.write(self.content[:3])
+
+        def get(url, headers=None, **kwargs):
+            self.assertEqual(headers['Range'], 'bytes=3-')
+            response = MagicMock(status_code=206, headers={
+                'Content-Range': 'bytes 3-6/7'})
+            response.__enter__.return_value = response
+            response.iter_content.return_value = [self.content[3:]]
+            return response
+
+        self.lookaside.session.get.side_effect = get
+        self.download('ns/pkg', 'foo.tar.gz')
+        self.assertFalse(os.path.exists(self.outfile + '.part'))
+        with open(self.outfile, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_download_restarts_resumed_file_on_mismatch(self):
+        self.layout_cache.set(self.lookaside.layout_key('ns/pkg'), 'new')
+        with open(self.outfile + '.part', 'wb') as f:
+            f.write(b'old')
+
+        def get(url, headers=None, **kwargs):
+            if 'Range' in headers:
+                response = MagicMock(status_code=206, headers={
+                    'Content-Range': 'bytes 3-6/7'})
+                response.iter_content.return_value = [self.content[3:]]
+            else:
+                response = MagicMock(status_code=200, headers={})
+                response.iter_content.return_value = [self.content]
+            response.__enter__.return_value = response
+            return response
+
+        self.lookaside.session.get.side_effect = get
+        self.download('ns/pkg', 'foo.tar.gz')
+        self.assertEqual(self.lookaside.session.get.call_count, 2)
+        with open(self.outfile, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_download_restarts_when_range_is_ignored(self):
+        self.serve('new')
+        self.layout_cache.set(self.lookaside.layout_key('ns/pkg'), 'new')
+        with open(self.outfile + '.part', 'wb') as f:
+            f.write(b'garbage')
+
+        self.download('ns/pkg', 'foo.tar.gz')
+        with open(self.outfile, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_download_removes_part_file_on_mismatch(self):
+        self.serve('new')
+        self.content = b'corrupted'
+        with self.assertRaises(DownloadError):
+            self.download('ns/pkg', 'foo.tar.gz')
+        self.assertFalse(os.path.exists(self.outfile))
+        self.assertFalse(os.path.exists(self.outfile + '.part'))
+
+    def test_upload_skips_available_file(self):
+        self.lookaside.session.post.return_value = MagicMock(
+            status_code=200, text='Available')
+        self.lookaside.upload('ns/pkg', self.outfile, self.hash)
+        self.assertEqual(self.lookaside.session.post.call_count, 1)
+
+    def test_upload_streams_multipart_body(self):
+        with open(self.outfile, 'wb') as f:
+            f.write(self.content)
+        bodies = []
+
+        def post(url, data=None, headers=None):
+            if headers:
+                bodies.append(data.read(-1) + data.read(-1) + data.read(-1))
+                self.assertEqual(len(bodies[0]), data.len)
+                return MagicMock(status_code=200, text='')
+            return MagicMock(status_code=200, text='Missing')
+
+        self.lookaside.session.post.side_effect = post
+        self.lookaside.upload('ns/pkg', self.outfile, self.hash)
+        self.assertIn(b'name="file"; filename="foo.tar.gz"', bodies[0])
+        self.assertIn(self.content, bodies[0])
+        self.assertIn(self.hash.encode('ascii'), bodies[0])
+
+    def test_multipart_escapes_filename(self):
+        filepath = os.path.join(self.tmpdir, 'a"b\\c.tar.gz')
+        open(filepath, 'wb').close()
+        stream = MultipartStream([], 'file', filepath)
+        self.assertIn(b'; filename="a\\"b\\\\c.tar.gz"\r\n',
+                      stream.read(-1))
+
+    def test_multipart_rejects_line_breaks_in_filename(self):
+        filepath = os.path.join(self.tmpdir, 'a\r\nb.tar.gz')
+        open(filepath, 'wb').close()
+        self.assertRaises(UploadError, MultipartStream, [], 'file', filepath)
+
+    def test_send_file_reports_progress(self):
+        with open(self.outfile, 'wb') as f:
+            f.write(self.content)
+        sent = []
+
+        def post(url, data=None, headers=None):
+            while data.read(2):
+                pass
+            return MagicMock(status_code=200, text='')
+
+        self.lookaside.session.post.side_effect = post
+        self.lookaside.send_file('ns/pkg', self.outfile, self.hash,
+                                 progress=sent.append)
+        self.assertEqual(self.lookaside.session.post.call_count, 1)
+        self.assertEqual(sum(sent), len(self.content))
@@ -0,0 +1,58 @@
+import json
+import os
+import signal
+import socket
+import sys
+
+import base
+from rpkglib.server import Server, read_frames
+
+
+def run(argv):
+    sys.stdout.write('out: {} in {}\n'.format(
+        ' '.join(argv), os.path.basename(os.getcwd())))
+    sys.stderr.write('err: {}\n'.format(os.environ['RPKG_TEST']))
+    return 3
+
+
+class TestServer(base.TestCase):
+    def setUp(self):
+        super(TestServer, self).setUp()
+        self.socket_path = os.path.join(self.tmpdir, 'rpkg.sock')
+        server = Server(self.socket_path, run)
+        server.listen()
+        self.server_pid = os.fork()
+        if not self.server_pid:
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        server.sock.close()
+
+    def tearDown(self):
+        os.kill(self.server_pid, signal.SIGTERM)
+        os.waitpid(self.server_pid, 0)
+        super(TestServer, self).tearDown()
+
+    def request(self, argv):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        env = dict(os.environ, RPKG_TEST='env')
+        request = {'argv': argv, 'cwd': self.tmpdir, 'env': env}
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        frames = list(read_frames(sock))
+        sock.close()
+        return frames
+
+    def test_request(self):
+        frames = self.request(['srpm', '--outdir', '.'])
+        stdout = b''.join(data for (kind, data) in frames if kind == b'1')
+        stderr = b''.join(data for (kind, data) in frames if kind == b'2')
+        self.assertEqual(stdout, 'out: srpm --outdir . in {}\n'.format(
+            os.path.basename(self.tmpdir)).encode('utf-8'))
+        self.assertEqual(stderr, b'err: env\n')
+        self.assertEqual(frames[-1], (b'x', b'3'))
+
+    def test_requests_are_isolated(self):
+        self.request(['a'])
+        self.assertEqual(self.request(['b'])[-1], (b'x', b'3'))
@@ -0,0 +1,206 @@
+import hashlib
+import multiprocessing
+import os
+import time
+import unittest
+
+import base
+from rpkglib.sourcecache import SourceStore, UnpackedCache, VerifiedIndex,\
+        UTIME_NS, link_file
+
+
+class TestSourceStore(base.TestCase):
+    def setUp(self):
+        super(TestSourceStore, self).setUp()
+        self.store = SourceStore(os.path.join(self.tmpdir, 'store'))
+
+    def write_file(self, filename, content):
+        path = os.path.join(self.tmpdir, filename)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def hash(self, content):
+        return hashlib.sha512(content.encode('utf-8')).hexdigest()
+
+    def test_fetch_missing(self):
+        outfile = os.path.join(self.tmpdir, 'out')
+        self.assertFalse(self.store.fetch('sha512', 'abcd', outfile))
+        self.assertFalse(os.path.exists(outfile))
+
+    def test_add_and_fetch(self):
+        path = self.write_file('foo.tar.gz', 'foo')
+        self.store.add('sha512', self.hash('foo'), path)
+        self.assertTrue(os.access(path, os.W_OK))
+
+        outfile = os.path.join(self.tmpdir, 'checkout.tar.gz')
+        self.assertTrue(self.store.fetch('sha512', self.hash('foo'), outfile))
+        self.assertFalse(os.path.samefile(
+            outfile, self.store.path('sha512', self.hash('foo'))))
+        with open(outfile) as f:
+            self.assertEqual(f.read(), 'foo')
+
+        # an edit of the checkout does not reach the store
+        with open(outfile, 'w') as f:
+            f.write('bar')
+        with open(self.store.path('sha512', self.hash('foo'))) as f:
+            self.assertEqual(f.read(), 'foo')
+
+    def test_hardlink(self):
+        self.store.hardlink = True
+        path = self.write_file('foo.tar.gz', 'foo')
+        self.store.add('sha512', self.hash('foo'), path)
+        outfile = os.path.join(self.tmpdir, 'checkout.tar.gz')
+        self.assertTrue(self.store.fetch('sha512', self.hash('foo'), outfile))
+        self.assertTrue(os.path.samefile(outfile, path))
+
+    @unittest.skipUnless(UTIME_NS, 'needs nanosecond utime')
+    def test_fetch_keeps_mtime(self):
+        path = self.write_file('foo.tar.gz', 'foo')
+        os.utime(path, ns=(1700000000123456789, 1700000000123456789))
+        self.store.hardlink = True
+        self.store.add('sha512', self.hash('foo'), path)
+        self.store.fetch('sha512', self.hash('foo'),
+                         os.path.join(self.tmpdir, 'checkout.tar.gz'))
+        self.assertEqual(os.stat(path).st_mtime_ns, 1700000000123456789)
+
+    def test_corrupted_file_is_not_fetched(self):
+        self.store.hardlink = True
+        path = self.write_file('foo.tar.gz', 'foo')
+        self.store.add('sha512', self.hash('foo'), path)
+        # modified in place through the checkout sharing the inode
+        with open(path, 'w') as f:
+            f.write('bar')
+
+        outfile = os.path.join(self.tmpdir, 'checkout.tar.gz')
+        self.assertFalse(self.store.fetch('sha512', self.hash('foo'), outfile))
+        self.assertFalse(os.path.exists(outfile))
+        self.assertFalse(os.path.exists(
+            self.store.path('sha512', self.hash('foo'))))
+
+    def test_verified_file_is_not_hashed(self):
+        index = VerifiedIndex()
+        path = self.write_file('foo.tar.gz', 'foo')
+        self.store.add('sha512', 'abcd', path, index)
+        self.assertTrue(self.store.fetch(
+            'sha512', 'abcd', os.path.join(self.tmpdir, 'checkout'), index))
+
+    def test_eviction_removes_least_recently_used(self):
+        self.store.max_size = 6
+        self.store.add('sha512', 'aaaa', self.write_file('a', 'aaa'))
+        os.utime(self.store.path('sha512', 'aaaa'),
+                 (time.time() - 100, time.time() - 100))
+        self.store.add('sha512', 'bbbb', self.write_file('b', 'bbb'))
+        self.store.add('sha512', 'cccc', self.write_file('c', 'ccc'))
+
+        self.assertFalse(os.path.exists(self.store.path('sha512', 'aaaa')))
+        self.assertTrue(os.path.exists(self.store.path('sha512', 'bbbb')))
+        self.assertTrue(os.path.exists(self.store.path('sha512', 'cccc')))
+
+    def test_link_file_replaces_existing(self):
+        src = self.write_file('src', 'new')
+        dst = self.write_file('dst', 'old')
+        link_file(src, dst)
+        with open(dst) as f:
+            self.assertEqual(f.read(), 'new')
+
+
+class TestVerifiedIndex(base.TestCase):
+    def setUp(self):
+        super(TestVerifiedIndex, self).setUp()
+        self.index_path = os.path.join(self.tmpdir, 'verified.json')
+        self.filepath = os.path.join(self.tmpdir, 'foo.tar.gz')
+        with open(self.filepath, 'w') as f:
+            f.write('foo')
+
+    def test_record_is_persisted(self):
+        index = VerifiedIndex(self.index_path)
+        index.record(self.filepath, 'sha512', 'abcd')
+        index.save()
+
+        index = VerifiedIndex(self.index_path)
+        self.assertTrue(index.is_verified(self.filepath, 'sha512', 'abcd'))
+        self.assertFalse(index.is_verified(self.filepath, 'sha512', 'efgh'))
+        self.assertFalse(index.is_verified(self.filepath, 'md5', 'abcd'))
+
+    def test_modified_file_is_not_verified(self):
+        index = VerifiedIndex(self.index_path)
+        index.record(self.filepath, 'sha512', 'abcd')
+        with open(self.filepath, 'w') as f:
+            f.write('foobar')
+        self.assertFalse(index.is_verified(self.filepath, 'sha512', 'abcd'))
+
+    def test_save_drops_removed_files(self):
+        index = VerifiedIndex(self.index_path)
+        index.record(self.filepath, 'sha512', 'abcd')
+        index.save()
+        os.unlink(self.filepath)
+        other_path = os.path.join(self.tmpdir, 'bar.tar.gz')
+        open(other_path, 'w').close()
+        index.record(other_path, 'sha512', 'efgh')
+        index.save(prune=True)
+
+        index = VerifiedIndex(self.index_path)
+        self.assertEqual(list(index._load().keys()), [other_path])
+
+
+    def test_save_checks_only_recorded_files(self):
+        index = VerifiedIndex(self.index_path)
+        index.record(self.filepath, 'sha512', 'abcd')
+        index.save()
+        os.unlink(self.filepath)
+        other_path = os.path.join(self.tmpdir, 'bar.tar.gz')
+        open(other_path, 'w').close()
+        index.record(other_path, 'sha512', 'efgh')
+        os.unlink(other_path)
+        index.save(prune=False)
+
+        index = VerifiedIndex(self.index_path)
+        self.assertEqual(list(index._load().keys()), [self.filepath])
+
+    def test_concurrent_saves_are_merged(self):
+        def record(num):
+            index = VerifiedIndex(self.index_path)
+            for i in range(20):
+                filepath = os.path.join(self.tmpdir, '{}-{}'.format(num, i))
+                open(filepath, 'w').close()
+                index.record(filepath, 'sha512', 'abcd')
+                index.save(prune=False)
+
+        processes = [multiprocessing.Process(target=record, args=(num,))
+                     for num in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertEqual(len(VerifiedIndex(self.index_path)._load()), 80)
+
+
+class TestUnpackedCache(base.TestCase):
+    def setUp(self):
+        super(TestUnpackedCache, self).setUp()
+        self.cache_path = os.path.join(self.cachedir, 'unpacked.json')
+        os.utime(self.tmpdir, (1000, 1000))
+
+    def test_result_is_persisted(self):
+        cache = UnpackedCache(self.cache_path)
+        cache.record(self.tmpdir, os.stat(self.tmpdir), set(['a.tar.gz']),
+                     False, ['a.tar.gz'])
+        cache.save()
+
+        cache = UnpackedCache(self.cache_path)
+        st = os.stat(self.tmpdir)
+        self.assertEqual(cache.get(self.tmpdir, st, set(['a.tar.gz'])),
+                         (False, ['a.tar.gz']))
+        self.assertIsNone(cache.get(self.tmpdir, st, set(['b.tar.gz'])))
+
+        open(os.path.join(self.tmpdir, 'new.c'), 'w').close()
+        self.assertIsNone(cache.get(self.tmpdir, os.stat(self.tmpdir),
+                                    set(['a.tar.gz'])))
+
+    def test_recently_modified_directory_is_not_cached(self):
+        cache = UnpackedCache(self.cache_path)
+        open(os.path.join(self.tmpdir, 'new.c'), 'w').close()
+        st = os.stat(self.tmpdir)
+        cache.record(self.tmpdir, st, set(), True, [])
+        self.assertIsNone(cache.get(self.tmpdir, st, set()))
@@ -0,0 +1,116 @@
+import os
+import six
+
+import base
+from rpkglib.exceptions import RpmSpecParseException
+from rpkglib.spec import SpecCache, SpecEvaluator, SpecInfo,\
+        macros_from_rpmdefines
+from spec_templates import SPEC_TEMPLATE, INVALID_SPEC_TEMPLATE
+
+if six.PY3:
+    from unittest import mock
+    from unittest.mock import MagicMock
+else:
+    import mock
+    from mock import MagicMock
+
+
+INFO = SpecInfo(name='testpkg', epoch='0', version='1', release='1',
+                sources=[('source0.tar.gz', 0, 1)],
+                source_zero='source0.tar.gz')
+# what parse_spec returns with header=True
+PARSED = (INFO, None)
+
+
+class TestSpecCache(base.TestCase):
+    def setUp(self):
+        super(TestSpecCache, self).setUp()
+        self.spec_path = os.path.join(self.tmpdir, 'testpkg.spec')
+        self.write_spec('Name: testpkg')
+
+    def write_spec(self, content):
+        with open(self.spec_path, 'w') as f:
+            f.write(content)
+
+    def test_macros_from_rpmdefines(self):
+        rpmdefines = ["--define '_sourcedir /tmp/a b'", "--define 'dist %nil'"]
+        self.assertEqual(macros_from_rpmdefines(rpmdefines),
+                         [('_sourcedir', '/tmp/a b'), ('dist', '%nil')])
+
+    @mock.patch('rpkglib.spec.parse_spec', return_value=PARSED)
+    def test_parses_once(self, parse_spec):
+        cache = SpecCache()
+        self.assertEqual(cache.get(self.spec_path), INFO)
+        self.assertEqual(cache.get(self.spec_path), INFO)
+        self.assertEqual(parse_spec.call_count, 1)
+
+    @mock.patch('rpkglib.spec.parse_spec', return_value=PARSED)
+    def test_reparses_on_change(self, parse_spec):
+        cache = SpecCache()
+        cache.get(self.spec_path)
+        self.write_spec('Name: otherpkg')
+        os.utime(self.spec_path, (1, 1))
+        cache.get(self.spec_path)
+        cache.get(self.spec_path, [('dist', '.fc30')])
+        self.assertEqual(parse_spec.call_count, 3)
+
+    @mock.patch('rpkglib.spec.parse_spec', return_value=PARSED)
+    def test_persists_results(self, parse_spec):
+        cache_dir = os.path.join(self.tmpdir, 'specs')
+        SpecCache(cache_dir).get(self.spec_path)
+        self.assertEqual(SpecCache(cache_dir).get(self.spec_path), INFO)
+        self.assertEqual(parse_spec.call_count, 1)
+
+    @mock.patch('rpkglib.spec.parse_spec', return_value=PARSED)
+    def test_prefetch(self, parse_spec):
+        other_spec_path = os.path.join(self.tmpdir, 'other.spec')
+        open(other_spec_path, 'w').close()
+        evaluator = MagicMock()
+        evaluator.evaluate.return_value = [INFO, RpmSpecParseException('bad')]
+
+        cache = SpecCache()
+        cache.prefetch([(self.spec_path, []), (other_spec_path, [])],
+                       evaluator)
+        self.assertEqual(cache.get(self.spec_path, []), INFO)
+        self.assertFalse(parse_spec.called)
+        cache.get(other_spec_path, [])
+        self.assertEqual(parse_spec.call_count, 1)
+
+        cache.prefetch([(self.spec_path, [])], evaluator)
+        evaluator.evaluate.assert_called_with([])
+
+    @mock.patch('rpkglib.spec.parse_spec', return_value=(INFO, 'header'))
+    def test_header_is_kept_from_parse(self, parse_spec):
+        cache = SpecCache()
+        cache.get(self.spec_path)
+        self.assertEqual(cache.header(self.spec_path), 'header')
+        self.assertEqual(parse_spec.call_count, 1)
+
+        # parsed elsewhere, the header has to be made here
+        cache = SpecCache(os.path.join(self.tmpdir, 'specs'))
+        cache.get(self.spec_path)
+        cache = SpecCache(os.path.join(self.tmpdir, 'specs'))
+        cache.get(self.spec_path)
+        self.assertEqual(cache.header(self.spec_path), 'header')
+        self.assertEqual(parse_spec.call_count, 3)
+
+
+class TestSpecEvaluator(base.TestCase):
+    def test_evaluate(self):
+        specs = []
+        for pkgname in ['testpkg1', 'testpkg2']:
+            self.dump_spec(SPEC_TEMPLATE, pkgname=pkgname,
+                           source0='source0.tar.gz')
+            specs.append((os.path.join(self.tmpdir, pkgname + '.spec'),
+                          [('_sourcedir', self.tmpdir)]))
+        specs.append((self.dump_spec(INVALID_SPEC_TEMPLATE), []))
+
+        evaluator = SpecEvaluator(processes=2)
+        try:
+            results = evaluator.evaluate(specs)
+        finally:
+            evaluator.close()
+        self.assertEqual([info.name for info in results[:2]],
+                         ['testpkg1', 'testpkg2'])
+        self.assertEqual(results[0].source_zero, 'source0.tar.gz')
+        self.assertIsInstance(results[2], RpmSpecParseException)
@@ -0,0 +1,151 @@
+import gzip
+import hashlib
+import io
+import os
+import struct
+import subprocess
+import unittest
+
+import base
+import rpkglib
+from rpkglib import srpm
+from rpkglib.exceptions import UnsupportedSrpmException
+from spec_templates import SPEC_WITH_PATCH_TEMPLATE
+
+try:
+    import rpm
+except ImportError:
+    rpm = None
+
+
+def have_rpmbuild():
+    return any(os.access(os.path.join(path, 'rpmbuild'), os.X_OK)
+               for path in os.environ.get('PATH', '').split(os.pathsep))
+
+
+def read_header(data, offset):
+    """Decode the header at offset into tag: values, and its end offset"""
+    assert data[offset:offset + 8] == srpm.HEADER_MAGIC
+    (nindex, hsize) = struct.unpack('>ii', data[offset + 8:offset + 16])
+    store = offset + 16 + 16*nindex
+    tags = {}
+    for num in range(nindex):
+        start = offset + 16 + 16*num
+        (tag, tag_type, entry_offset, count) = struct.unpack(
+            '>iIii', data[start:start + 16])
+        value_start = store + entry_offset
+        if tag_type in srpm.INT_FORMATS:
+            fmt = '>{}{}'.format(count, srpm.INT_FORMATS[tag_type])
+            tags[tag] = list(struct.unpack(
+                fmt, data[value_start:value_start + struct.calcsize(fmt)]))
+        elif tag_type == srpm.BIN:
+            tags[tag] = data[value_start:value_start + count]
+        else:
+            tags[tag] = [value.decode('utf-8') for value in
+                         data[value_start:].split(b'\0')[:count]]
+    return (tags, store + hsize)
+
+
+def read_cpio(data):
+    """name: content of a newc cpio archive"""
+    files = {}
+    offset = 0
+    while True:
+        fields = [int(data[offset + 6 + 8*num:offset + 14 + 8*num], 16)
+                  for num in range(13)]
+        (size, namesize) = (fields[6], fields[11])
+        name = data[offset + 110:offset + 110 + namesize - 1].decode('utf-8')
+        offset += 110 + namesize
+        offset += srpm._padding(offset, 4)
+        if name == 'TRAILER!!!':
+            return files
+        files[name] = data[offset:offset + size]
+        offset += size + srpm._padding(size, 4)
+
+
+class TestSrpmWriter(base.TestCase):
+    def setUp(self):
+        super(TestSrpmWriter, self).setUp()
+        self.files = []
+        for (name, content) in [('testpkg.spec', b'Name: testpkg\n'),
+                                ('source0.tar.gz', os.urandom(5000)),
+                                ('a.patch', b'')]:
+            path = os.path.join(self.tmpdir, name)
+            with open(path, 'wb') as f:
+                f.write(content)
+            self.files.append(srpm.SrpmFile(name, path))
+        self.srpm_path = os.path.join(self.tmpdir, 'testpkg-1-1.src.rpm')
+        self.entries = [(1000, srpm.STRING, ['testpkg']),
+                        (1001, srpm.STRING, ['1']),
+                        (1002, srpm.STRING, ['1'])]
+
+    def test_write_srpm(self):
+        srpm.write_srpm(self.srpm_path, self.entries, self.files, 'sha512')
+        with open(self.srpm_path, 'rb') as f:
+            data = f.read()
+
+        self.assertEqual(data[:4], srpm.LEAD_MAGIC)
+        self.assertEqual(data[10:10 + len(b'testpkg-1-1\0')], b'testpkg-1-1\0')
+        (signature, end) = read_header(data, 96)
+        header_start = end + srpm._padding(end, 8)
+        (header, end) = read_header(data, header_start)
+        self.assertEqual(signature[srpm.SIGTAG_SHA256][0],
+                         hashlib.sha256(data[header_start:end]).hexdigest())
+
+        payload = data[end:]
+        self.assertEqual(header[srpm.PAYLOADDIGEST][0],
+                         hashlib.sha256(payload).hexdigest())
+        archive = gzip.GzipFile(fileobj=io.BytesIO(payload)).read()
+        self.assertEqual(signature[srpm.SIGTAG_PAYLOADSIZE][0], len(archive))
+        files = read_cpio(archive)
+
+        self.assertEqual(header[1000], ['testpkg'])
+        self.assertEqual(header[srpm.BASENAMES],
+                         ['a.patch', 'source0.tar.gz', 'testpkg.spec'])
+        self.assertEqual(header[srpm.FILEDIGESTALGO], [10])
+        for (name, digest) in zip(header[srpm.BASENAMES],
+                                  header[srpm.FILEDIGESTS]):
+            with open(os.path.join(self.tmpdir, name), 'rb') as f:
+                content = f.read()
+            self.assertEqual(files[name], content)
+            self.assertEqual(digest, hashlib.sha512(content).hexdigest())
+
+    def test_unsupported_hashtype(self):
+        with self.assertRaises(UnsupportedSrpmException):
+            srpm.write_srpm(self.srpm_path, self.entries, self.files, 'crc32')
+        self.assertFalse(os.path.exists(self.srpm_path))
+
+
+@unittest.skipUnless(rpm and have_rpmbuild(), 'needs rpm and rpmbuild')
+class TestSrpmWriterMatchesRpmbuild(base.TestCase):
+    TAGS = ['name', 'version', 'release', 'summary', 'license', 'source',
+            'patch', 'requirename', 'basenames', 'filesizes', 'filemodes',
+            'filedigests', 'fileflags']
+
+    def build(self, native):
+        outdir = os.path.join(self.tmpdir, 'native' if native else 'rpmbuild')
+        os.mkdir(outdir)
+        cmd = rpkglib.Commands(self.tmpdir, 'lookaside', 'sha512',
+                               'lookaside_cgi', 'gitbaseurl', 'anongiturl',
+                               branchre='.*', kojiconfig='',
+                               build_client=None, quiet=True)
+        cmd.native_srpm = native
+        cmd.srpm(outdir)
+        (srpm_path,) = [os.path.join(outdir, filename)
+                        for filename in os.listdir(outdir)]
+
+        ts = rpm.ts()
+        with open(srpm_path, 'rb') as f:
+            header = ts.hdrFromFdno(f.fileno())
+        listing = subprocess.check_output(
+            'rpm2cpio {} | cpio -t --quiet'.format(srpm_path), shell=True)
+        return (dict((tag, header[tag]) for tag in self.TAGS),
+                sorted(listing.split()))
+
+    def test_same_as_rpmbuild(self):
+        self.dump_spec(SPEC_WITH_PATCH_TEMPLATE, source0='source0.tar.gz',
+                       patch0='patch0.patch')
+        with open(os.path.join(self.tmpdir, 'source0.tar.gz'), 'wb') as f:
+            f.write(os.urandom(10000))
+        self.touch_file('patch0.patch')
+        self.assertEqual(self.build(native=True), self.build(native=False))
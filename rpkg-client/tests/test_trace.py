@@ -0,0 +1,55 @@
+import json
+import os
+import time
+
+import base
+from rpkglib.trace import Tracer
+
+
+class TestTracer(base.TestCase):
+    def setUp(self):
+        super(TestTracer, self).setUp()
+        self.tracer = Tracer()
+        self.tracer.enabled = True
+
+    def test_disabled(self):
+        self.tracer.enabled = False
+        with self.tracer.span('pack') as trace:
+            trace['bytes'] = 10
+        self.assertEqual(self.tracer.events, [])
+
+    def test_span(self):
+        with self.tracer.span('lookaside.download', file='a.tar.gz') as trace:
+            trace['bytes'] = 1024
+            time.sleep(0.01)
+        with self.assertRaises(ValueError):
+            with self.tracer.span('spec.parse'):
+                raise ValueError('bad spec')
+
+        (download, parse) = self.tracer.events
+        self.assertEqual(download['name'], 'lookaside.download')
+        self.assertEqual(download['args']['file'], 'a.tar.gz')
+        self.assertIn('throughput', download['args'])
+        self.assertEqual(parse['args'], {'error': 'bad spec'})
+
+    def test_write_json_lines(self):
+        with self.tracer.span('rpmbuild'):
+            pass
+        path = os.path.join(self.tmpdir, 'trace.jsonl')
+        self.tracer.write(path)
+        with open(path) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual([event['name'] for event in events], ['rpmbuild'])
+
+    def test_write_chrome_trace(self):
+        with self.tracer.span('sources'):
+            with self.tracer.span('sources.file'):
+                pass
+        path = os.path.join(self.tmpdir, 'trace.json')
+        self.tracer.write(path)
+        with open(path) as f:
+            events = json.load(f)['traceEvents']
+        self.assertEqual([(event['name'], event['ph']) for event in events],
+                         [('thread_name', 'M'), ('sources', 'X'),
+                          ('sources.file', 'X')])
+        self.assertEqual(events[1]['cat'], 'sources')